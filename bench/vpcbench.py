@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""Control-plane benchmark for vpcctl.
+
+Runs a scripted scale scenario through the real CLI, one process per
+command as a user would: create N VPCs x M subnets, peer them full mesh,
+apply a K-rule policy to every subnet, test each VPC and cleanup-all.
+Each command is traced (--trace) to count the commands it issued and the
+processes it forked. Results are JSON, and `compare` flags operations that
+got slower or spawn more processes than a baseline run.
+
+    python3 bench/vpcbench.py run --vpcs 8 --subnets 4 --rules 50 -o new.json
+    python3 bench/vpcbench.py compare baseline.json new.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from vpcctl_lib.state import log, Colors
+
+VPCCTL = ROOT / 'vpcctl'
+OPERATIONS = ('create', 'subnet-add', 'peer', 'policy-apply', 'test', 'cleanup-all')
+PERCENTILES = (50, 95, 99)
+# Second octet of the first VPC; VPC i gets 10.(BASE_OCTET + i).0.0/16
+BASE_OCTET = 100
+
+def percentile(values, pct):
+    """Linearly interpolated percentile of a non-empty list"""
+    values = sorted(values)
+    rank = (len(values) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+def vpc_name(i):
+    return f"bench-{i}"
+
+def write_policy(path, subnet_cidr, vpc_cidr, rules):
+    """K ingress rules on distinct ports, alternating allow and deny"""
+    ingress = [{'port': 10000 + k, 'protocol': 'tcp', 'source': vpc_cidr,
+                'action': 'allow' if k % 2 == 0 else 'deny'} for k in range(rules)]
+    with open(path, 'w') as f:
+        json.dump({'subnet': subnet_cidr, 'ingress': ingress}, f)
+
+def scenario(vpcs, subnets, rules, workdir):
+    """The benchmark as (operation, argv) pairs in execution order"""
+    steps = []
+    for i in range(vpcs):
+        steps.append(('create', ['create', vpc_name(i), f"10.{BASE_OCTET + i}.0.0/16"]))
+    for i in range(vpcs):
+        for j in range(subnets):
+            steps.append(('subnet-add', ['subnet-add', vpc_name(i), f"s{j}", f"10.{BASE_OCTET + i}.{j + 1}.0/24"]))
+    for i in range(vpcs):
+        for k in range(i + 1, vpcs):
+            steps.append(('peer', ['peer', vpc_name(i), vpc_name(k)]))
+    for i in range(vpcs):
+        for j in range(subnets):
+            path = workdir / f"policy-{i}-{j}.json"
+            write_policy(path, f"10.{BASE_OCTET + i}.{j + 1}.0/24", f"10.{BASE_OCTET + i}.0.0/16", rules)
+            steps.append(('policy-apply', ['policy-apply', vpc_name(i), f"s{j}", str(path)]))
+    for i in range(vpcs):
+        steps.append(('test', ['test', vpc_name(i), '--format', 'json', '--count', '1', '--timeout', '5']))
+    steps.append(('cleanup-all', ['cleanup-all']))
+    return steps
+
+def read_trace(path):
+    """(commands issued, processes forked, in-process seconds) from one command's trace"""
+    try:
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+    except (OSError, ValueError, KeyError):
+        return 0, 0, None
+    execs = [e for e in events if e.get('cat') == 'exec']
+    forks = [e for e in execs if not e['name'].startswith('netlink')]
+    ops = [e['dur'] / 1e6 for e in events if e.get('cat') == 'operation']
+    return len(execs), len(forks), ops[0] if ops else None
+
+def run_step(argv, options, env, trace_path):
+    cmd = [sys.executable, str(VPCCTL), '--backend', options.backend, '--firewall', options.firewall,
+           '--trace', str(trace_path)] + argv
+    started = time.perf_counter()
+    result = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - started
+    commands, processes, inproc = read_trace(trace_path)
+    return {'wall_s': wall, 'inproc_s': inproc, 'commands': commands, 'processes': processes,
+            'ok': result.returncode == 0, 'stderr': result.stderr.strip()[-300:]}
+
+def summarise(samples):
+    summary = {}
+    for op in OPERATIONS:
+        runs = samples.get(op)
+        if not runs:
+            continue
+        walls = [r['wall_s'] * 1000 for r in runs]
+        inprocs = [r['inproc_s'] * 1000 for r in runs if r['inproc_s'] is not None]
+        entry = {'samples': len(runs), 'failures': sum(not r['ok'] for r in runs)}
+        for pct in PERCENTILES:
+            entry[f"p{pct}_ms"] = round(percentile(walls, pct), 3)
+        if inprocs:
+            entry['inproc_p50_ms'] = round(percentile(inprocs, 50), 3)
+        entry['commands_per_op'] = round(sum(r['commands'] for r in runs) / len(runs), 2)
+        entry['processes_per_op'] = round(sum(r['processes'] for r in runs) / len(runs), 2)
+        entry['processes_total'] = sum(r['processes'] for r in runs)
+        summary[op] = entry
+    return summary
+
+def run(options):
+    live = options.backend != 'record'
+    if live and os.geteuid() != 0:
+        log('ERROR', f"The {options.backend} backend creates real namespaces and needs root "
+                     f"(use --backend record to benchmark unprivileged)")
+        return 1
+    if options.vpcs + BASE_OCTET > 255 or options.subnets > 254:
+        log('ERROR', "Too many VPCs or subnets for the benchmark address plan")
+        return 1
+
+    samples = {}
+    with tempfile.TemporaryDirectory(prefix='vpcbench-') as tmp:
+        workdir = Path(tmp)
+        # A private state directory: cleanup-all only ever sees the benchmark's VPCs. It is
+        # kept between recorded steps, so each step plans on top of the previous ones
+        env = dict(os.environ, VPCCTL_STATE_DIR=str(workdir / 'state'), VPCCTL_NO_DAEMON='1',
+                   VPCCTL_RECORD_STATE='keep')
+        env.pop('VPCCTL_METRICS', None)
+        steps = scenario(options.vpcs, options.subnets, options.rules, workdir)
+        log('INFO', f"{len(steps)} command(s) per round, {options.repeat} round(s), backend {options.backend}")
+        for round_no in range(options.repeat):
+            started = time.perf_counter()
+            for n, (op, argv) in enumerate(steps):
+                sample = run_step(argv, options, env, workdir / f"trace-{n}.json")
+                samples.setdefault(op, []).append(sample)
+                if not sample['ok']:
+                    log('WARNING', f"{' '.join(argv)} failed: {sample['stderr'] or 'non-zero exit'}")
+            log('INFO', f"Round {round_no + 1}/{options.repeat} done in {time.perf_counter() - started:.2f}s")
+
+    results = {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'kernel': platform.release(),
+            'python': platform.python_version(),
+            'backend': options.backend,
+            'firewall': options.firewall,
+            'vpcs': options.vpcs,
+            'subnets': options.subnets,
+            'rules': options.rules,
+            'repeat': options.repeat,
+        },
+        'operations': summarise(samples),
+    }
+    print_summary(results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        log('SUCCESS', f"Results written to {options.output}")
+    if options.baseline:
+        with open(options.baseline) as f:
+            return 1 if print_comparison(json.load(f), results, options.threshold, options.min_ms) else 0
+    return 0
+
+def print_summary(results):
+    meta = results['meta']
+    print(f"\n{'='*78}")
+    print(f"vpcctl bench: {meta['vpcs']} VPC(s) x {meta['subnets']} subnet(s), {meta['rules']} rule(s), "
+          f"backend {meta['backend']}, firewall {meta['firewall']}")
+    print(f"{'='*78}")
+    print(f"{'OPERATION':<14} {'N':>5} {'FAIL':>5} {'P50 ms':>9} {'P95 ms':>9} {'P99 ms':>9} "
+          f"{'CMDS/OP':>8} {'PROCS/OP':>9}")
+    for op, entry in results['operations'].items():
+        print(f"{op:<14} {entry['samples']:>5} {entry['failures']:>5} {entry['p50_ms']:>9.1f} "
+              f"{entry['p95_ms']:>9.1f} {entry['p99_ms']:>9.1f} {entry['commands_per_op']:>8.1f} "
+              f"{entry['processes_per_op']:>9.1f}")
+    if meta['backend'] == 'record':
+        print("\nrecord backend: PROCS/OP counts the processes the subprocess backend would fork")
+
+def compare(baseline, current, threshold, min_ms):
+    """Regressions as (operation, metric, baseline, current) tuples.
+
+    A latency percentile regresses when it grew by more than threshold
+    (a fraction) and by at least min_ms; any growth in processes per
+    operation is a regression, since it does not depend on the machine.
+    """
+    regressions = []
+    for op, entry in current['operations'].items():
+        base = baseline['operations'].get(op)
+        if base is None:
+            continue
+        for pct in PERCENTILES:
+            key = f"p{pct}_ms"
+            if entry[key] > base[key] * (1 + threshold) and entry[key] - base[key] >= min_ms:
+                regressions.append((op, key, base[key], entry[key]))
+        if entry['processes_per_op'] > base['processes_per_op']:
+            regressions.append((op, 'processes_per_op', base['processes_per_op'], entry['processes_per_op']))
+    return regressions
+
+def print_comparison(baseline, current, threshold, min_ms):
+    """Print current against baseline; returns the regressions"""
+    keys = ('vpcs', 'subnets', 'rules', 'backend', 'firewall')
+    differing = [k for k in keys if baseline['meta'].get(k) != current['meta'].get(k)]
+    if differing:
+        log('WARNING', f"Baseline was run with different {', '.join(differing)}; the comparison may not be meaningful")
+
+    print(f"\n{'OPERATION':<14} {'METRIC':<18} {'BASELINE':>10} {'CURRENT':>10} {'CHANGE':>9}")
+    for op, entry in current['operations'].items():
+        base = baseline['operations'].get(op)
+        if base is None:
+            continue
+        for key in [f"p{pct}_ms" for pct in PERCENTILES] + ['processes_per_op']:
+            change = f"{(entry[key] - base[key]) / base[key] * 100:+.1f}%" if base[key] else 'n/a'
+            print(f"{op:<14} {key:<18} {base[key]:>10.1f} {entry[key]:>10.1f} {change:>9}")
+
+    regressions = compare(baseline, current, threshold, min_ms)
+    if regressions:
+        print(f"\n{Colors.RED}{len(regressions)} regression(s):{Colors.RESET}")
+        for op, key, before, after in regressions:
+            print(f"  {Colors.RED}✗{Colors.RESET} {op} {key}: {before} -> {after}")
+    else:
+        print(f"\n{Colors.GREEN}✓{Colors.RESET} No regressions (threshold {threshold:.0%}, {min_ms} ms)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(prog='vpcbench', description='vpcctl control-plane benchmark')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the scale scenario')
+    run_parser.add_argument('--vpcs', type=int, default=4, help='VPCs to create (N)')
+    run_parser.add_argument('--subnets', type=int, default=2, help='Subnets per VPC (M)')
+    run_parser.add_argument('--rules', type=int, default=20, help='Policy rules per subnet (K)')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Rounds of the whole scenario')
+    run_parser.add_argument('--backend', choices=['record', 'subprocess', 'netlink'], default='record',
+                            help='record runs unprivileged; the others need root and real namespaces')
+    run_parser.add_argument('--firewall', choices=['iptables', 'nft'], default='iptables')
+    run_parser.add_argument('-o', '--output', help='Write results JSON here')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two results files')
+    compare_parser.add_argument('baseline', help='Baseline results JSON')
+    compare_parser.add_argument('current', help='Results JSON to check')
+
+    run_parser.add_argument('--baseline', help='Compare against this results JSON after the run')
+    for sub in (run_parser, compare_parser):
+        sub.add_argument('--threshold', type=float, default=0.2,
+                         help='Relative latency growth that counts as a regression (default 0.2)')
+        sub.add_argument('--min-ms', type=float, default=5.0,
+                         help='Ignore latency growth smaller than this (default 5 ms)')
+
+    options = parser.parse_args()
+    if options.command == 'run':
+        sys.exit(run(options))
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    with open(options.current) as f:
+        current = json.load(f)
+    sys.exit(1 if print_comparison(baseline, current, options.threshold, options.min_ms) else 0)
+
+if __name__ == '__main__':
+    main()
@@ -35,16 +35,11 @@ for iface in $(ip link show | grep -E "vb|vn|peer-|veth-" | awk -F: '{print $2}'
 done
 
 echo -e "${YELLOW}[4/6] Removing VPC bridges...${NC}"
-# Only remove bridges from our state files
-if [ -d "/var/lib/vpcctl" ]; then
-    for statefile in /var/lib/vpcctl/*.json; do
-        if [ -f "$statefile" ]; then
-            bridge=$(grep -oP '"bridge":\s*"\K[^"]+' "$statefile")
-            if [ -n "$bridge" ]; then
-                echo "  Deleting bridge: $bridge"
-                ip link del "$bridge" 2>/dev/null
-            fi
-        fi
+# Only remove bridges recorded in our state database
+if [ -f "/var/lib/vpcctl/state.db" ]; then
+    for bridge in $(python3 -c "import sqlite3; [print(r[0]) for r in sqlite3.connect('/var/lib/vpcctl/state.db').execute('SELECT bridge FROM vpcs')]"); do
+        echo "  Deleting bridge: $bridge"
+        ip link del "$bridge" 2>/dev/null
     done
 fi
 
@@ -65,9 +60,20 @@ iptables -t nat -S POSTROUTING | grep MASQUERADE | sed 's/-A/-D/' | while read r
     iptables -t nat $rule 2>/dev/null
 done
 
+# Remove the transit hub chain and membership set
+iptables -D FORWARD -j VPC-TRANSIT 2>/dev/null
+iptables -F VPC-TRANSIT 2>/dev/null
+iptables -X VPC-TRANSIT 2>/dev/null
+ipset destroy vpcctl-transit 2>/dev/null
+
+# Remove per-VPC nftables tables
+nft list tables 2>/dev/null | awk '$2 == "ip" && $3 ~ /^vpcctl-/ {print $3}' | while read table; do
+    nft delete table ip "$table" 2>/dev/null
+done
+
 echo -e "${YELLOW}[6/6] Cleaning state files...${NC}"
 if [ -d "/var/lib/vpcctl" ]; then
-    rm -rf /var/lib/vpcctl/*.json
+    rm -rf /var/lib/vpcctl/*.json /var/lib/vpcctl/state.db* /var/lib/vpcctl/locks
     echo "  State files removed"
 fi
 
@@ -81,4 +87,4 @@ echo ""
 echo "Verification:"
 echo "  Namespaces: $(ip netns list | wc -l)"
 echo "  Bridges: $(ip link show type bridge | grep br- | wc -l)"
-echo "  VPCs: $(ls /var/lib/vpcctl/*.json 2>/dev/null | wc -l)"
\ No newline at end of file
+echo "  State databases: $(ls /var/lib/vpcctl/state.db 2>/dev/null | wc -l)"
\ No newline at end of file
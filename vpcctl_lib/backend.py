@@ -0,0 +1,567 @@
+import os
+import shlex
+import subprocess
+import threading
+import time
+from vpcctl_lib.state import log
+from vpcctl_lib.trace import record_command
+
+SYSFS_NET = '/sys/class/net'
+NETNS_DIR = '/var/run/netns'
+IFF_UP = 0x1
+
+
+class UnsupportedCommand(Exception):
+    """Raised when the netlink engine cannot translate a command"""
+
+
+def parse_ip_command(argv, netns=None):
+    """Translate an `ip ...` argv into a list of (operation, netns, args) tuples.
+
+    Only the subset of iproute2 that vpcctl itself issues is understood;
+    anything else raises UnsupportedCommand so callers can fall back.
+    """
+    args = list(argv)
+    if args and args[0] == 'ip':
+        args = args[1:]
+    while args and args[0].startswith('-'):
+        if args[0] == '-n' and len(args) > 1:
+            netns = args[1]
+            args = args[2:]
+        else:
+            raise UnsupportedCommand(args[0])
+    if len(args) < 2:
+        raise UnsupportedCommand(' '.join(argv))
+
+    obj, action, rest = args[0], args[1], args[2:]
+
+    if obj == 'netns':
+        if action == 'exec' and len(rest) > 2 and rest[1] == 'ip':
+            return parse_ip_command(rest[1:], netns=rest[0])
+        if action in ('add', 'del', 'delete') and len(rest) == 1 and netns is None:
+            return [('netns_' + action[:3], None, {'name': rest[0]})]
+        raise UnsupportedCommand(' '.join(argv))
+
+    if obj in ('link', 'l'):
+        return [_parse_link(action, rest, netns, argv)]
+    if obj in ('addr', 'address', 'a'):
+        return [_parse_addr(action, rest, netns, argv)]
+    if obj in ('route', 'r', 'ro'):
+        return [_parse_route(action, rest, netns, argv)]
+    raise UnsupportedCommand(' '.join(argv))
+
+
+def _parse_link(action, rest, netns, argv):
+    if rest and rest[0] in ('dev', 'name'):
+        rest = rest[1:]
+    if not rest:
+        raise UnsupportedCommand(' '.join(argv))
+    name, rest = rest[0], rest[1:]
+
+    if action in ('del', 'delete') and not rest:
+        return ('link_del', netns, {'name': name})
+
+    if action == 'add':
+        opts = {'name': name, 'kind': None, 'peer': None, 'attrs': {}}
+        while rest:
+            key = rest[0]
+            if key == 'type' and len(rest) > 1:
+                opts['kind'] = rest[1]
+                rest = rest[2:]
+            elif key == 'peer' and len(rest) > 2 and rest[1] == 'name':
+                opts['peer'] = rest[2]
+                rest = rest[3:]
+            elif key in ('mtu', 'txqueuelen', 'numtxqueues', 'numrxqueues') and len(rest) > 1:
+                opts['attrs'][key] = int(rest[1])
+                rest = rest[2:]
+            else:
+                raise UnsupportedCommand(' '.join(argv))
+        if opts['kind'] not in ('bridge', 'veth'):
+            raise UnsupportedCommand(' '.join(argv))
+        return ('link_add', netns, opts)
+
+    if action == 'set':
+        opts = {'name': name}
+        while rest:
+            key = rest[0]
+            if key in ('up', 'down'):
+                opts['up'] = key == 'up'
+                rest = rest[1:]
+            elif key == 'nomaster':
+                opts['master'] = ''
+                rest = rest[1:]
+            elif key in ('master', 'netns', 'name') and len(rest) > 1:
+                opts['new_name' if key == 'name' else key] = rest[1]
+                rest = rest[2:]
+            elif key in ('mtu', 'txqueuelen') and len(rest) > 1:
+                opts['txqlen' if key == 'txqueuelen' else key] = int(rest[1])
+                rest = rest[2:]
+            else:
+                raise UnsupportedCommand(' '.join(argv))
+        return ('link_set', netns, opts)
+
+    raise UnsupportedCommand(' '.join(argv))
+
+
+def _parse_addr(action, rest, netns, argv):
+    if action not in ('add', 'replace', 'del', 'delete') or len(rest) != 3 or rest[1] != 'dev':
+        raise UnsupportedCommand(' '.join(argv))
+    return ('addr', netns, {'action': action[:3] if action != 'replace' else action,
+                            'cidr': rest[0], 'dev': rest[2]})
+
+
+def _parse_route(action, rest, netns, argv):
+    if action not in ('add', 'replace', 'del', 'delete') or not rest:
+        raise UnsupportedCommand(' '.join(argv))
+    opts = {'action': action[:3] if action != 'replace' else action,
+            'dst': rest[0], 'via': None, 'dev': None}
+    rest = rest[1:]
+    while rest:
+        if rest[0] in ('via', 'dev') and len(rest) > 1:
+            opts[rest[0]] = rest[1]
+            rest = rest[2:]
+        else:
+            raise UnsupportedCommand(' '.join(argv))
+    return ('route', netns, opts)
+
+
+def _batch_command(netns=None):
+    cmd = ['ip']
+    if netns:
+        cmd.extend(['-n', netns])
+    cmd.extend(['-batch', '-'])
+    return cmd
+
+
+def _batch_argvs(cmd, input):
+    """Split an `ip [-n ns] -batch -` invocation into per-line argvs"""
+    netns = None
+    if len(cmd) == 5 and cmd[1] == '-n':
+        netns = cmd[2]
+    return netns, [shlex.split(line) for line in (input or '').splitlines() if line.strip()]
+
+
+def _rename_netns_command(old, new):
+    """iproute2 has no rename: bind the namespace at the new path, then unmount and remove the old"""
+    old_path, new_path = (shlex.quote(os.path.join(NETNS_DIR, n)) for n in (old, new))
+    return ['sh', '-c', f"touch {new_path} && mount --bind {old_path} {new_path} && "
+                        f"umount -l {old_path} && rm {old_path}"]
+
+
+def _uses_xtables(cmd):
+    return any(os.path.basename(arg).startswith(('iptables', 'ip6tables')) for arg in cmd[:6])
+
+
+# iptables-legacy fails instead of waiting when another thread holds the xtables lock
+_XTABLES_LOCK = threading.Lock()
+
+
+def _read_sysfs(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _sysfs_link(name):
+    path = os.path.join(SYSFS_NET, name)
+    index = int(_read_sysfs(os.path.join(path, 'ifindex')))
+    if os.path.isdir(os.path.join(path, 'bridge')):
+        kind = 'bridge'
+    elif int(_read_sysfs(os.path.join(path, 'iflink'))) != index:
+        kind = 'veth'
+    else:
+        kind = 'other'
+    master = os.path.join(path, 'master')
+    return {'index': index, 'kind': kind,
+            'master': os.path.basename(os.readlink(master)) if os.path.islink(master) else None,
+            'up': bool(int(_read_sysfs(os.path.join(path, 'flags')), 16) & IFF_UP)}
+
+
+def _is_batch(cmd):
+    return cmd[:1] == ['ip'] and cmd[-2:] == ['-batch', '-'] and len(cmd) in (3, 5)
+
+
+class SubprocessBackend:
+    """Runs every command as a child process (the historical behaviour)"""
+
+    name = 'subprocess'
+    # Inventory reads (sysfs, netns dir, netlink dumps) reflect the real host
+    live = True
+
+    def __init__(self):
+        self.spawned = 0
+
+    def execute(self, cmd, input=None, timeout=None):
+        self.spawned += 1
+        started = time.perf_counter()
+        try:
+            if _uses_xtables(cmd):
+                with _XTABLES_LOCK:
+                    result = subprocess.run(cmd, capture_output=True, text=True, input=input, timeout=timeout)
+            else:
+                result = subprocess.run(cmd, capture_output=True, text=True, input=input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            record_command(cmd, started, time.perf_counter(), 'timeout')
+            raise
+        record_command(cmd, started, time.perf_counter(), result.returncode, result.stderr)
+        return result
+
+    def run(self, cmd, check=True, input=None, quiet=False):
+        if not quiet:
+            log('INFO', f"Running: {' '.join(cmd)}")
+        result = self.execute(cmd, input=input)
+        if result.returncode != 0:
+            if check:
+                log('ERROR', f"Command failed: {result.stderr}")
+                raise subprocess.CalledProcessError(result.returncode, cmd,
+                                                    result.stdout, result.stderr)
+            return False
+        return True
+
+    def capture(self, cmd, input=None, timeout=None):
+        return self.execute(cmd, input=input, timeout=timeout)
+
+    def batch(self, lines, netns=None, check=True):
+        for line in lines:
+            log('INFO', f"  batch{f' [{netns}]' if netns else ''}: ip {line}")
+        return self.run(_batch_command(netns), check=check, input='\n'.join(lines) + '\n')
+
+    def link_exists(self, name):
+        return self.capture(['ip', 'link', 'show', name]).returncode == 0
+
+    def link_table(self):
+        """Every host link with kind, master and state, read from sysfs without forking"""
+        links = {}
+        for name in os.listdir(SYSFS_NET):
+            try:
+                links[name] = _sysfs_link(name)
+            except (OSError, ValueError):
+                continue  # removed while we were reading it
+        return links
+
+    def namespace_names(self):
+        try:
+            return set(os.listdir(NETNS_DIR))
+        except FileNotFoundError:
+            return set()
+
+    def rename_netns(self, old, new):
+        return self.run(_rename_netns_command(old, new))
+
+    def write_file(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def spawn(self, cmd, **kwargs):
+        self.spawned += 1
+        return subprocess.Popen(cmd, **kwargs)
+
+
+class NetlinkBackend(SubprocessBackend):
+    """Talks rtnetlink directly for ip link/addr/route/netns operations.
+
+    Commands it cannot translate (iptables, ping, ...) still go through
+    SubprocessBackend.
+    """
+
+    name = 'netlink'
+
+    def __init__(self):
+        super().__init__()
+        from vpcctl_lib import netlink
+        self.netlink = netlink
+        self.local = threading.local()
+
+    def _socket(self, netns):
+        if netns is None:
+            if getattr(self.local, 'host', None) is None:
+                self.local.host = self.netlink.RtNetlink()
+            return self.local.host
+        return self.netlink.RtNetlink(netns)
+
+    def _apply(self, ops):
+        sockets = {}
+        try:
+            for op, netns, opts in ops:
+                if op == 'netns_add':
+                    self.netlink.netns_add(opts['name'])
+                    continue
+                if op == 'netns_del':
+                    self.netlink.netns_del(opts['name'])
+                    continue
+                if netns not in sockets:
+                    sockets[netns] = self._socket(netns)
+                nl = sockets[netns]
+                if op == 'link_add':
+                    attrs = {self._LINK_ATTRS[k]: v for k, v in opts['attrs'].items()}
+                    nl.link_add(opts['name'], opts['kind'], peer=opts['peer'], attrs=attrs)
+                elif op == 'link_del':
+                    nl.link_del(opts['name'])
+                elif op == 'link_set':
+                    name = opts.pop('name')
+                    nl.link_set(name, **opts)
+                elif op == 'addr':
+                    nl.addr(opts['action'], opts['cidr'], opts['dev'])
+                elif op == 'route':
+                    nl.route(opts['action'], opts['dst'], via=opts['via'], dev=opts['dev'])
+        finally:
+            for netns, nl in sockets.items():
+                if netns is not None:
+                    nl.close()
+
+    @property
+    def _LINK_ATTRS(self):
+        return {'mtu': self.netlink.IFLA_MTU, 'txqueuelen': self.netlink.IFLA_TXQLEN,
+                'numtxqueues': self.netlink.IFLA_NUM_TX_QUEUES,
+                'numrxqueues': self.netlink.IFLA_NUM_RX_QUEUES}
+
+    def execute(self, cmd, input=None, timeout=None):
+        try:
+            if _is_batch(cmd):
+                netns, argvs = _batch_argvs(cmd, input)
+                ops = [op for argv in argvs for op in parse_ip_command(argv, netns=netns)]
+            else:
+                ops = parse_ip_command(cmd)
+        except (UnsupportedCommand, ValueError):
+            return super().execute(cmd, input=input, timeout=timeout)
+
+        started = time.perf_counter()
+        try:
+            self._apply(ops)
+        except OSError as e:
+            record_command(['netlink'] + cmd, started, time.perf_counter(), 2, e.strerror)
+            return subprocess.CompletedProcess(cmd, 2, '', f"{e.strerror}\n")
+        record_command(['netlink'] + cmd, started, time.perf_counter(), 0)
+        return subprocess.CompletedProcess(cmd, 0, '', '')
+
+    def link_exists(self, name):
+        return self._socket(None).link_exists(name)
+
+    def rename_netns(self, old, new):
+        log('INFO', f"Renaming namespace {old} to {new}")
+        started = time.perf_counter()
+        self.netlink.netns_rename(old, new)
+        record_command(['netlink', 'netns', 'rename', old, new], started, time.perf_counter(), 0)
+        return True
+
+
+class RecordingBackend:
+    """Captures the command plan without touching the kernel.
+
+    Links, namespaces, iptables rules, ipset members and nftables tables created by the
+    plan are tracked so existence checks behave as they would on a real host.
+    """
+
+    name = 'record'
+    live = False
+
+    def __init__(self, internet_iface='eth0'):
+        self.plan = []
+        self.files = {}
+        self.links = set()
+        self.namespaces = set()
+        self.rules = set()
+        self.chains = set()
+        self.nft_tables = set()
+        self.sets = {}
+        self.internet_iface = internet_iface
+        self.spawned = 0
+
+    def _track(self, argv, netns=None):
+        try:
+            ops = parse_ip_command(argv, netns=netns)
+        except (UnsupportedCommand, ValueError):
+            return
+        for op, ns, opts in ops:
+            if op == 'netns_add':
+                self.namespaces.add(opts['name'])
+            elif op == 'netns_del':
+                self.namespaces.discard(opts['name'])
+            elif ns is None and op == 'link_add':
+                self.links.update(n for n in (opts['name'], opts['peer']) if n)
+            elif ns is None and op == 'link_del':
+                self.links.discard(opts['name'])
+            elif ns is None and op == 'link_set' and 'netns' in opts:
+                self.links.discard(opts['name'])
+
+    def _track_iptables(self, cmd):
+        """Model iptables -N/-X/-A/-D/-C so idempotent insertion plans correctly"""
+        args = list(cmd[1:])
+        table = 'filter'
+        if args[:1] == ['-t'] and len(args) > 1:
+            table, args = args[1], args[2:]
+        if len(args) == 2 and args[0] in ('-N', '-X'):
+            (self.chains.add if args[0] == '-N' else self.chains.discard)((table, args[1]))
+            return 0
+        if len(args) < 2 or args[0] not in ('-A', '-D', '-C'):
+            return 0
+        rule = (table, args[1], tuple(args[2:]))
+        if args[0] == '-A':
+            self.rules.add(rule)
+        elif args[0] == '-D':
+            self.rules.discard(rule)
+        return 0 if rule in self.rules else 1
+
+    def _track_ipset(self, args):
+        """Model ipset create/add/del, from argv or `ipset restore` lines"""
+        if len(args) < 2:
+            return
+        if args[0] == 'create':
+            self.sets.setdefault(args[1], set())
+        elif args[0] in ('add', 'del') and len(args) > 2:
+            members = self.sets.setdefault(args[1], set())
+            (members.add if args[0] == 'add' else members.discard)(args[2])
+
+    def _ipset_save(self, name):
+        if name not in self.sets:
+            return None
+        return ''.join([f"create {name} hash:net\n"] + [f"add {name} {m}\n" for m in sorted(self.sets[name])])
+
+    def _track_nft(self, document):
+        """Model the ip-family tables an `nft -f` document declares and deletes"""
+        for line in document.splitlines():
+            parts = line.split()
+            if parts[:2] == ['table', 'ip'] and len(parts) > 2:
+                self.nft_tables.add(parts[2])
+            elif parts[:3] == ['delete', 'table', 'ip'] and len(parts) > 3:
+                self.nft_tables.discard(parts[3])
+
+    def execute(self, cmd, input=None, timeout=None):
+        now = time.perf_counter()
+        if cmd[:1] == ['iptables'] and '-C' in cmd:
+            returncode = self._track_iptables(cmd)
+            record_command(cmd, now, now, returncode)
+            return subprocess.CompletedProcess(cmd, returncode, '', '')
+        if cmd[:2] == ['ipset', 'save'] and len(cmd) > 2:
+            saved = self._ipset_save(cmd[2])
+            record_command(cmd, now, now, 0 if saved is not None else 1)
+            return subprocess.CompletedProcess(cmd, 0 if saved is not None else 1, saved or '', '')
+        record_command(cmd, now, now, 0)
+        self.plan.append((list(cmd), input))
+        if cmd[:1] == ['iptables']:
+            self._track_iptables(cmd)
+        elif cmd == ['nft', '-f', '-'] and input:
+            self._track_nft(input)
+        elif cmd[:2] == ['ipset', 'restore'] and input:
+            for line in input.splitlines():
+                self._track_ipset(line.split())
+        elif cmd[:1] == ['ipset']:
+            self._track_ipset(cmd[1:])
+        if _is_batch(cmd):
+            netns, argvs = _batch_argvs(cmd, input)
+            for argv in argvs:
+                self._track(argv, netns=netns)
+        else:
+            self._track(cmd)
+        stdout = ''
+        if cmd == ['ip', 'route', 'show', 'default'] and self.internet_iface:
+            stdout = f"default via 192.0.2.1 dev {self.internet_iface}\n"
+        elif cmd == ['ip', 'netns', 'list']:
+            stdout = ''.join(f"{ns}\n" for ns in sorted(self.namespaces))
+        elif cmd[:1] == ['iptables-save']:
+            stdout = self._iptables_save()
+        elif cmd == ['nft', 'list', 'tables']:
+            stdout = ''.join(f"table ip {name}\n" for name in sorted(self.nft_tables))
+        return subprocess.CompletedProcess(cmd, 0, stdout, '')
+
+    def run(self, cmd, check=True, input=None, quiet=False):
+        if not quiet:
+            log('INFO', f"Recording: {' '.join(cmd)}")
+        return self.execute(cmd, input=input).returncode == 0
+
+    def capture(self, cmd, input=None, timeout=None):
+        return self.execute(cmd, input=input)
+
+    def batch(self, lines, netns=None, check=True):
+        return self.run(_batch_command(netns), check=check, input='\n'.join(lines) + '\n')
+
+    def link_exists(self, name):
+        return name in self.links
+
+    def link_table(self):
+        return {name: {'index': None, 'kind': 'bridge' if name.startswith('br-') else 'veth',
+                       'master': None, 'up': True} for name in self.links}
+
+    def namespace_names(self):
+        return set(self.namespaces)
+
+    def rename_netns(self, old, new):
+        self.run(_rename_netns_command(old, new))
+        self.namespaces.discard(old)
+        self.namespaces.add(new)
+        return True
+
+    def _iptables_save(self):
+        lines = []
+        for table in ('filter', 'nat'):
+            lines.append(f"*{table}")
+            lines.extend(f":{chain} - [0:0]" for t, chain in sorted(self.chains) if t == table)
+            lines.extend(f"-A {chain} {' '.join(spec)}"
+                         for t, chain, spec in sorted(self.rules) if t == table)
+            lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, path, content):
+        self.files[path] = content
+
+    def spawn(self, cmd, **kwargs):
+        self.execute(cmd)
+        return None
+
+    def dump(self):
+        """Render the recorded plan as shell lines"""
+        lines = []
+        for cmd, input in self.plan:
+            if input is not None and _is_batch(cmd):
+                lines.append(f"{shlex.join(cmd)} <<'EOF'\n{input}EOF")
+            elif input is not None:
+                lines.append(f"{shlex.join(cmd)} <<'EOF'\n{input.rstrip()}\nEOF")
+            else:
+                lines.append(shlex.join(cmd))
+        for path, content in self.files.items():
+            lines.append(f"cat > {shlex.quote(path)} <<'EOF'\n{content.rstrip()}\nEOF")
+        return lines
+
+
+BACKENDS = {
+    SubprocessBackend.name: SubprocessBackend,
+    NetlinkBackend.name: NetlinkBackend,
+    RecordingBackend.name: RecordingBackend,
+}
+
+_backend = None
+
+
+def set_backend(backend):
+    """Select the engine used by every manager, by name or instance"""
+    global _backend
+    if isinstance(backend, str):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend} (choose from {', '.join(BACKENDS)})")
+        backend = BACKENDS[backend]()
+    _backend = backend
+    return _backend
+
+
+def get_backend():
+    if _backend is None:
+        set_backend(os.environ.get('VPCCTL_BACKEND', SubprocessBackend.name))
+    return _backend
+
+
+def run_cmd(cmd, check=True, input=None, quiet=False):
+    return get_backend().run(cmd, check=check, input=input, quiet=quiet)
+
+
+def run_batch(lines, netns=None, check=True):
+    """Run several ip commands in a single batch (one process or one netlink session)"""
+    return get_backend().batch(lines, netns=netns, check=check)
+
+
+def capture(cmd, input=None, timeout=None):
+    return get_backend().capture(cmd, input=input, timeout=timeout)
+
+
+def rename_netns(old, new):
+    """Rename a named network namespace; its links, addresses and processes stay in it"""
+    return get_backend().rename_netns(old, new)
@@ -0,0 +1,107 @@
+import hashlib
+from vpcctl_lib.state import log
+from vpcctl_lib.backend import run_cmd
+
+# iptables chain names are limited to 28 characters
+MAX_CHAIN_NAME = 28
+# Host chain each table's VPC chain is jumped to from
+HOOKS = {'filter': 'FORWARD', 'nat': 'POSTROUTING'}
+
+def chain_name(vpc_name, kind):
+    """Name of a VPC-owned chain, e.g. VPC-myvpc-FWD"""
+    name = f"VPC-{vpc_name}-{kind}"
+    if len(name) > MAX_CHAIN_NAME:
+        digest = hashlib.md5(vpc_name.encode()).hexdigest()[:12]
+        name = f"VPC-{digest}-{kind}"
+    return name
+
+class VPCChains:
+    """Dedicated FORWARD and POSTROUTING chains owned by a single VPC.
+
+    The host chains only carry one jump per VPC; every VPC rule lives in
+    the VPC's own chains and is inserted idempotently, so deleting a VPC
+    is a flush-and-delete of its chains.
+    """
+
+    state_key = 'chains'
+
+    def __init__(self, vpc_name, bridge):
+        self.vpc_name = vpc_name
+        self.bridge = bridge
+        self.fwd_chain = chain_name(vpc_name, 'FWD')
+        self.nat_chain = chain_name(vpc_name, 'NAT')
+
+    def as_state(self):
+        return {'filter': self.fwd_chain, 'nat': self.nat_chain}
+
+    def expected_rules(self, state, states, internet_iface):
+        """Rule specs the VPC chains should hold, as iptables-save prints them.
+
+        Returns {(table, chain): [spec, ...]}. Public subnet rules need the
+        internet interface, peer rules the peer's state (states by VPC name).
+        """
+        bridge = self.bridge
+        filter_rules = [f"-i {bridge} -o {bridge} -j ACCEPT"]
+        nat_rules = []
+        public = [s['cidr'] for s in state['subnets'].values() if s.get('type') == 'public']
+        if public and internet_iface:
+            filter_rules += [f"-i {bridge} -o {internet_iface} -j ACCEPT",
+                             f"-i {internet_iface} -o {bridge} -m state --state RELATED,ESTABLISHED -j ACCEPT"]
+            nat_rules += [f"-s {cidr} -o {internet_iface} -j MASQUERADE" for cidr in public]
+        for peer in state.get('peerings', {}):
+            if peer in states:
+                filter_rules.append(f"-i {bridge} -o {states[peer]['bridge']} -j ACCEPT")
+        return {('filter', self.fwd_chain): filter_rules, ('nat', self.nat_chain): nat_rules}
+
+    @staticmethod
+    def _ensure_rule(table, chain, spec):
+        """Append a rule unless an identical one is already present"""
+        if run_cmd(['iptables', '-t', table, '-C', chain] + spec, check=False, quiet=True):
+            return False
+        run_cmd(['iptables', '-t', table, '-A', chain] + spec, check=False)
+        return True
+
+    @staticmethod
+    def _remove_rule(table, chain, spec):
+        run_cmd(['iptables', '-t', table, '-D', chain] + spec, check=False)
+
+    def ensure(self):
+        """Create the VPC chains and hook them into FORWARD and POSTROUTING"""
+        log('INFO', f"Ensuring chains {self.fwd_chain} and {self.nat_chain}")
+        run_cmd(['iptables', '-t', 'filter', '-N', self.fwd_chain], check=False, quiet=True)
+        run_cmd(['iptables', '-t', 'nat', '-N', self.nat_chain], check=False, quiet=True)
+        self._ensure_rule('filter', 'FORWARD', ['-j', self.fwd_chain])
+        self._ensure_rule('nat', 'POSTROUTING', ['-j', self.nat_chain])
+
+    def allow_intra_bridge(self):
+        """Allow forwarding between subnets on the VPC bridge"""
+        self._ensure_rule('filter', self.fwd_chain,
+                          ['-i', self.bridge, '-o', self.bridge, '-j', 'ACCEPT'])
+
+    def enable_nat(self, subnet_cidr, internet_iface):
+        """Masquerade a public subnet and allow its traffic to and from the internet"""
+        self._ensure_rule('nat', self.nat_chain,
+                          ['-s', subnet_cidr, '-o', internet_iface, '-j', 'MASQUERADE'])
+        self._ensure_rule('filter', self.fwd_chain,
+                          ['-i', self.bridge, '-o', internet_iface, '-j', 'ACCEPT'])
+        self._ensure_rule('filter', self.fwd_chain,
+                          ['-i', internet_iface, '-o', self.bridge, '-m', 'state',
+                           '--state', 'RELATED,ESTABLISHED', '-j', 'ACCEPT'])
+
+    def allow_peer(self, peer_bridge):
+        """Allow traffic from this VPC's bridge towards a peered bridge"""
+        self._ensure_rule('filter', self.fwd_chain,
+                          ['-i', self.bridge, '-o', peer_bridge, '-j', 'ACCEPT'])
+
+    def remove_peer(self, peer_bridge):
+        self._remove_rule('filter', self.fwd_chain,
+                          ['-i', self.bridge, '-o', peer_bridge, '-j', 'ACCEPT'])
+
+    def destroy(self):
+        """Unhook, flush and delete the VPC chains"""
+        log('INFO', f"Removing chains {self.fwd_chain} and {self.nat_chain}")
+        for table, hook, chain in (('filter', 'FORWARD', self.fwd_chain),
+                                   ('nat', 'POSTROUTING', self.nat_chain)):
+            self._remove_rule(table, hook, ['-j', chain])
+            run_cmd(['iptables', '-t', table, '-F', chain], check=False)
+            run_cmd(['iptables', '-t', table, '-X', chain], check=False)
@@ -1,50 +1,44 @@
-import subprocess
 from vpcctl_lib.state import log
+from vpcctl_lib.backend import run_cmd as _run_cmd, capture
+from vpcctl_lib.reconcile import Snapshot
+from vpcctl_lib.nft import firewall_of, vpc_firewall
 
 def run_cmd(cmd, check=True):
-    try:
-        result = subprocess.run(cmd, check=check, capture_output=True, text=True)
-        return result.returncode == 0
-    except subprocess.CalledProcessError as e:
-        if check:
-            raise
-        return False
+    return _run_cmd(cmd, check=check, quiet=True)
 
 class CleanupManager:
     
     @staticmethod
-    def verify_cleanup(vpc_name, state):
+    def verify_cleanup(vpc_name, state, snapshot=None):
         """Verify all resources are cleaned up"""
         log('INFO', f"Verifying cleanup for {vpc_name}")
         
         issues = []
         
+        # One read of links and namespaces covers every check below
+        if snapshot is None:
+            snapshot = Snapshot.collect(full=False)
+        
         # Check if bridge still exists
-        result = subprocess.run(['ip', 'link', 'show', state['bridge']], 
-                              capture_output=True, check=False)
-        if result.returncode == 0:
+        if state['bridge'] in snapshot.links:
             issues.append(f"Bridge {state['bridge']} still exists")
         
         # Check if namespaces still exist
         for subnet_name, subnet_data in state['subnets'].items():
             ns_name = subnet_data['namespace']
-            result = subprocess.run(['ip', 'netns', 'list'], 
-                                  capture_output=True, text=True)
-            if ns_name in result.stdout:
+            if ns_name in snapshot.namespaces:
                 issues.append(f"Namespace {ns_name} still exists")
         
         # Check for leftover veth interfaces
-        result = subprocess.run(['ip', 'link', 'show'], 
-                              capture_output=True, text=True)
         for subnet_name, subnet_data in state['subnets'].items():
             veth_br = subnet_data['veth_br']
-            if veth_br in result.stdout:
+            if veth_br in snapshot.links:
                 issues.append(f"Veth interface {veth_br} still exists")
         
         # Check for peering interfaces
         if 'peerings' in state:
             for peer_vpc, peer_data in state['peerings'].items():
-                if peer_data['veth'] in result.stdout:
+                if peer_data['veth'] in snapshot.links:
                     issues.append(f"Peering interface {peer_data['veth']} still exists")
         
         if issues:
@@ -65,9 +59,7 @@ class CleanupManager:
         for subnet_name, subnet_data in state['subnets'].items():
             ns_name = subnet_data['namespace']
             log('INFO', f"Killing processes in {ns_name}")
-            run_cmd(['ip', 'netns', 'pids', ns_name], check=False)
-            result = subprocess.run(['ip', 'netns', 'pids', ns_name], 
-                                  capture_output=True, text=True, check=False)
+            result = capture(['ip', 'netns', 'pids', ns_name])
             for pid in result.stdout.split():
                 run_cmd(['kill', '-9', pid], check=False)
         
@@ -92,5 +84,9 @@ class CleanupManager:
         # Delete bridge
         log('INFO', f"Deleting bridge {state['bridge']}")
         run_cmd(['ip', 'link', 'del', state['bridge']], check=False)
+
+        # Delete the VPC's nftables table
+        if firewall_of(state) == 'nft':
+            vpc_firewall(vpc_name, state).destroy()
         
         log('SUCCESS', f"Force cleanup completed for {vpc_name}")
\ No newline at end of file
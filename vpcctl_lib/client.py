@@ -0,0 +1,106 @@
+# Client side of the vpcctld socket API: JSON lines over a Unix stream socket,
+# one {"id", "argv", "cwd"} request per line, answered by {"id", "stdout"|"stderr"}
+# chunks and a final {"id", "exit"}. Imports nothing else from vpcctl_lib so
+# `vpcctl` can hand a command over before loading the rest of the tool.
+import json
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.environ.get('VPCCTL_SOCKET', os.path.join(
+    os.environ.get('VPCCTL_STATE_DIR', '/var/lib/vpcctl'), 'vpcctld.sock'))
+# Global options that choose engines or write files for this run only; the daemon keeps its own
+LOCAL_OPTIONS = ('--backend', '--firewall', '--trace', '--metrics', '--watch')
+# Commands that run until interrupted, which only the local process sees
+LOCAL_COMMANDS = ('daemon', 'top')
+
+class DaemonClient:
+    """Pipelined connection to vpcctld"""
+
+    def __init__(self, path=SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.reader = self.sock.makefile('r', encoding='utf-8')
+        self.next_id = 0
+        self.pending = {}
+
+    def submit(self, argv, cwd=None):
+        """Send a command without waiting for it; returns its request id"""
+        self.next_id += 1
+        request = {'id': self.next_id, 'argv': list(argv), 'cwd': cwd or os.getcwd()}
+        self.sock.sendall((json.dumps(request) + '\n').encode())
+        self.pending[self.next_id] = {'stdout': [], 'stderr': [], 'exit': None}
+        return self.next_id
+
+    def _receive(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("vpcctld closed the connection")
+        return json.loads(line)
+
+    def wait(self, request_id, stdout=None, stderr=None):
+        """Collect one request's result; returns (exit status, stdout, stderr).
+
+        With stdout/stderr streams given, that request's output is written
+        through as it arrives. Output of other requests is buffered.
+        """
+        result = self.pending[request_id]
+        streams = {'stdout': stdout, 'stderr': stderr}
+        for name, stream in streams.items():
+            if stream is not None:
+                stream.write(''.join(result[name]))
+        while result['exit'] is None:
+            message = self._receive()
+            entry = self.pending.get(message.get('id'))
+            if entry is None:
+                continue
+            for name in ('stdout', 'stderr'):
+                if name in message:
+                    if entry is result and streams[name] is not None:
+                        streams[name].write(message[name])
+                        streams[name].flush()
+                    else:
+                        entry[name].append(message[name])
+            if 'exit' in message:
+                entry['exit'] = message['exit']
+        del self.pending[request_id]
+        return result['exit'], ''.join(result['stdout']), ''.join(result['stderr'])
+
+    def run_many(self, argvs, cwd=None):
+        """Pipeline several commands; results come back in submission order"""
+        ids = [self.submit(argv, cwd=cwd) for argv in argvs]
+        return [self.wait(request_id) for request_id in ids]
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+def forward(argv):
+    """Run argv in vpcctld and exit with its status.
+
+    Returns without doing anything when the command should run in-process:
+    no daemon is listening, VPCCTL_NO_DAEMON is set, the command is the
+    daemon itself or runs until interrupted, or the run picks its own
+    backend or firewall engine or traces itself.
+    """
+    if (not argv or argv[0] in LOCAL_COMMANDS or os.environ.get('VPCCTL_NO_DAEMON')
+            or os.environ.get('VPCCTL_BACKEND') == 'record'
+            or any(arg.split('=')[0] in LOCAL_OPTIONS for arg in argv)):
+        return
+    try:
+        client = DaemonClient()
+    except OSError:
+        return
+    try:
+        status, _, _ = client.wait(client.submit(argv), stdout=sys.stdout, stderr=sys.stderr)
+    except (OSError, ValueError) as e:
+        # The command may already have run, so it is not retried in-process
+        sys.stderr.write(f"vpcctld connection lost: {e}\n")
+        status = 1
+    finally:
+        client.close()
+    sys.exit(status)
@@ -0,0 +1,142 @@
+import csv
+import io
+import json
+import re
+import subprocess
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from vpcctl_lib.state import StateManager, log, Colors, worker_pool
+from vpcctl_lib.backend import capture
+
+_LOSS_RE = re.compile(r'(\d+) packets transmitted, (\d+) (?:packets )?received')
+_RTT_RE = re.compile(r'= ([\d.]+)/([\d.]+)/([\d.]+)')
+
+def _unreachable(probe, count, status):
+    return dict(probe, reachable=False, sent=count, received=0, loss_pct=100.0,
+                rtt_min_ms=None, rtt_avg_ms=None, rtt_max_ms=None, status=status)
+
+class ConnectivityTester:
+    """Runs the subnet reachability matrix concurrently"""
+
+    @staticmethod
+    def build_matrix(vpc_name, subnet_name=None):
+        """List the (source, target) probes for a VPC, including peered VPCs"""
+        manager = StateManager()
+        state = manager.load(vpc_name)
+
+        if not state:
+            log('ERROR', f"VPC {vpc_name} not found")
+            return None
+
+        if subnet_name:
+            if subnet_name not in state['subnets']:
+                log('ERROR', f"Subnet {subnet_name} not found in VPC {vpc_name}")
+                return None
+            sources = {subnet_name: state['subnets'][subnet_name]}
+        else:
+            sources = state['subnets']
+
+        targets = [(vpc_name, name, subnet) for name, subnet in state['subnets'].items()]
+        for peer_vpc in state.get('peerings', {}):
+            peer_state = manager.load(peer_vpc)
+            if peer_state:
+                targets.extend((peer_vpc, name, subnet) for name, subnet in peer_state['subnets'].items())
+
+        probes = []
+        for name, subnet in sources.items():
+            source = f"{vpc_name}/{name}"
+            if 'gateway_ip' in subnet:
+                probes.append({'source': source, 'namespace': subnet['namespace'],
+                               'target': f"{source} gateway", 'ip': subnet['gateway_ip']})
+            for target_vpc, target_name, target in targets:
+                if (target_vpc, target_name) == (vpc_name, name) or 'namespace_ip' not in target:
+                    continue
+                probes.append({'source': source, 'namespace': subnet['namespace'],
+                               'target': f"{target_vpc}/{target_name}", 'ip': target['namespace_ip']})
+        return probes
+
+    @staticmethod
+    def probe(probe, count=2, timeout=None):
+        """Ping one target from a namespace and parse loss and RTT statistics"""
+        cmd = ['ip', 'netns', 'exec', probe['namespace'],
+               'ping', '-c', str(count), '-i', '0.2', '-W', '1', '-q', probe['ip']]
+        result = _unreachable(probe, count, 'unreachable')
+        try:
+            completed = capture(cmd, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return _unreachable(probe, count, 'timeout')
+
+        loss = _LOSS_RE.search(completed.stdout or '')
+        if loss:
+            sent, received = int(loss.group(1)), int(loss.group(2))
+            result.update(sent=sent, received=received,
+                          loss_pct=round(100.0 * (sent - received) / sent, 1) if sent else 100.0)
+        elif completed.returncode == 0:
+            result.update(received=count, loss_pct=0.0)
+        rtt = _RTT_RE.search(completed.stdout or '')
+        if rtt:
+            result.update(rtt_min_ms=float(rtt.group(1)), rtt_avg_ms=float(rtt.group(2)),
+                          rtt_max_ms=float(rtt.group(3)))
+        if completed.returncode == 0:
+            result.update(reachable=True, status='ok')
+        return result
+
+    @staticmethod
+    def run(probes, workers=16, timeout=30.0, count=2):
+        """Run probes on a bounded pool; anything not done within timeout is reported as such"""
+        deadline = time.monotonic() + timeout
+        results = [None] * len(probes)
+        with worker_pool(max(1, workers)) as pool:
+            pending = {}
+            for index, probe in enumerate(probes):
+                future = pool.submit(ConnectivityTester._probe_until, probe, count, deadline)
+                pending[future] = index
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+            for future, index in pending.items():
+                future.cancel()
+                results[index] = _unreachable(probes[index], count, 'timeout')
+        return results
+
+    @staticmethod
+    def _probe_until(probe, count, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return _unreachable(probe, count, 'timeout')
+        return ConnectivityTester.probe(probe, count=count, timeout=remaining)
+
+    FIELDS = ('source', 'target', 'ip', 'status', 'sent', 'received', 'loss_pct',
+              'rtt_min_ms', 'rtt_avg_ms', 'rtt_max_ms')
+
+    @staticmethod
+    def render(results, output_format='table', elapsed=None):
+        if output_format == 'json':
+            print(json.dumps({'elapsed_s': elapsed,
+                              'results': [{k: r[k] for k in ConnectivityTester.FIELDS} for r in results]},
+                             indent=2))
+            return
+        if output_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=ConnectivityTester.FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(results)
+            print(buffer.getvalue(), end='')
+            return
+
+        source = None
+        for r in results:
+            if r['source'] != source:
+                source = r['source']
+                print(f"\n• Testing subnet: {source}")
+            if r['reachable']:
+                rtt = f" ({r['rtt_avg_ms']} ms avg)" if r['rtt_avg_ms'] is not None else ''
+                print(f"  {Colors.GREEN}✓{Colors.RESET} {r['target']} ({r['ip']}) reachable{rtt}")
+            else:
+                print(f"  {Colors.RED}✗{Colors.RESET} {r['target']} ({r['ip']}) {r['status']}")
+        if elapsed is not None:
+            print(f"\n{len(results)} probe(s) in {elapsed:.2f}s")
@@ -0,0 +1,194 @@
+import contextvars
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from vpcctl_lib.state import log, route_output, current_output
+from vpcctl_lib.client import SOCKET_PATH
+
+# Orders a request after every earlier one on its connection, and every later one after it
+ALL = '*'
+
+class RoutedStream:
+    """Stands in for sys.stdout/sys.stderr: writes go to the calling thread's request"""
+
+    def __init__(self, name, stream):
+        self.name = name
+        self.stream = stream
+
+    def write(self, text):
+        sink = current_output()
+        if sink is None:
+            return self.stream.write(text)
+        sink.write(self.name, text)
+        return len(text)
+
+    def flush(self):
+        if current_output() is None:
+            self.stream.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+class Discard:
+    def write(self, name, text):
+        pass
+
+class RequestOutput:
+    """Streams one request's output back to its client a line at a time"""
+
+    def __init__(self, connection, request_id):
+        self.connection = connection
+        self.request_id = request_id
+        self.buffers = {'stdout': '', 'stderr': ''}
+        self.lock = threading.Lock()
+
+    def write(self, name, text):
+        with self.lock:
+            complete, newline, rest = (self.buffers[name] + text).rpartition('\n')
+            self.buffers[name] = rest
+        if newline:
+            self.connection.send({'id': self.request_id, name: complete + newline})
+
+    def close(self, status):
+        for name, text in self.buffers.items():
+            if text:
+                self.connection.send({'id': self.request_id, name: text})
+        self.connection.send({'id': self.request_id, 'exit': status})
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.last = {}
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode()
+        with self.lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass  # the client went away; the command still runs to completion
+
+    def order(self, keys, future_factory):
+        """Submit a request after the earlier ones on this connection that share a key"""
+        self.last = {key: f for key, f in self.last.items() if not f.done()}
+        if ALL in keys:
+            deps = list(self.last.values())
+        else:
+            deps = [self.last[key] for key in set(keys) | {ALL} if key in self.last]
+        future = future_factory(deps)
+        if ALL in keys:
+            self.last = {ALL: future}
+        else:
+            self.last.update((key, future) for key in keys)
+        return future
+
+class Daemon:
+    """vpcctld: runs vpcctl commands received on a Unix socket.
+
+    handler(argv, cwd) runs one command in the calling thread and returns
+    its exit status; keys(argv) names the VPCs it touches. Requests on a
+    connection are pipelined: each starts as soon as earlier requests
+    sharing one of its VPCs have finished, so a client may send a create
+    and its subnet-adds back to back. Across connections, mutations of the
+    same VPC serialise on the usual state locks and reads run
+    concurrently. Worker threads keep their SQLite connection and netlink
+    socket open between requests.
+    """
+
+    def __init__(self, handler, keys, path=SOCKET_PATH, workers=16):
+        self.handler = handler
+        self.keys = keys
+        self.path = path
+        self.workers = max(1, workers)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.listener = None
+        self.stopping = threading.Event()
+
+    def _bind(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise RuntimeError(f"vpcctld is already listening on {self.path}")
+            except OSError:
+                os.unlink(self.path)  # left behind by a daemon that died
+            finally:
+                probe.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        # The API runs root-only commands, so only root may connect
+        os.chmod(self.path, 0o600)
+        self.listener.listen(128)
+
+    def stop(self, *_):
+        self.stopping.set()
+        if self.listener is not None:
+            self.listener.shutdown(socket.SHUT_RDWR)
+
+    def serve_forever(self):
+        self._bind()
+        sys.stdout = RoutedStream('stdout', sys.stdout)
+        sys.stderr = RoutedStream('stderr', sys.stderr)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        log('SUCCESS', f"vpcctld listening on {self.path} with {self.workers} worker(s)")
+        try:
+            while not self.stopping.is_set():
+                try:
+                    sock, _ = self.listener.accept()
+                except OSError:
+                    continue
+                threading.Thread(target=self._serve_connection, args=(sock,), daemon=True).start()
+        finally:
+            self.listener.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            log('INFO', "vpcctld waiting for running commands")
+            self.pool.shutdown(wait=True)
+            sys.stdout, sys.stderr = sys.stdout.stream, sys.stderr.stream
+
+    def _serve_connection(self, sock):
+        connection = Connection(sock)
+        with sock, sock.makefile('r', encoding='utf-8') as reader:
+            for line in reader:
+                try:
+                    request = json.loads(line)
+                    argv = request['argv']
+                    if not isinstance(argv, list) or not all(isinstance(a, str) for a in argv):
+                        raise ValueError("argv must be a list of strings")
+                except (ValueError, KeyError, TypeError) as e:
+                    connection.send({'id': None, 'stderr': f"Bad request: {e}\n", 'exit': 2})
+                    continue
+                connection.order(self._keys(argv), lambda deps, request=request:
+                                 self.pool.submit(self._run, connection, request, deps))
+            # Keep the socket open until every pipelined answer has been sent
+            wait(list(connection.last.values()))
+
+    def _keys(self, argv):
+        route_output(Discard())  # argparse complaints are reported when the request runs
+        try:
+            return self.keys(argv) or [ALL]
+        except BaseException:
+            return [ALL]
+        finally:
+            route_output(None)
+
+    def _run(self, connection, request, deps):
+        wait(deps)
+        output = RequestOutput(connection, request.get('id'))
+        route_output(output)
+        try:
+            # A request's own settings (log format, operation) end with it
+            status = contextvars.copy_context().run(self.handler, request['argv'], request.get('cwd') or '/')
+        except BaseException as e:
+            log('ERROR', f"Unexpected error: {e}")
+            status = 1
+        finally:
+            route_output(None)
+        output.close(status)
@@ -0,0 +1,260 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from vpcctl_lib import state as state_store
+from vpcctl_lib.state import StateManager, log, Colors
+from vpcctl_lib.backend import get_backend
+
+FORWARDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dns_forwarder.py')
+DEFAULT_DOMAIN = 'internal'
+DEFAULT_CACHE_SIZE = 4096
+# Used when the host's resolv.conf names no usable server, and by subnets without a forwarder
+FALLBACK_UPSTREAMS = ('8.8.8.8', '8.8.4.4')
+HOST_RESOLV_CONF = '/etc/resolv.conf'
+# How long a forwarder may take to bind its addresses
+READY_TIMEOUT = 5.0
+
+def host_upstreams(path=HOST_RESOLV_CONF):
+    """Nameservers of the host, which the forwarder (running on the host) can reach"""
+    servers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) > 1 and parts[0] == 'nameserver' and ':' not in parts[1]:
+                    servers.append(parts[1])
+    except OSError:
+        pass
+    return servers or list(FALLBACK_UPSTREAMS)
+
+def _alive(pid):
+    """Whether pid is still a forwarder, not a process that reused its number"""
+    try:
+        with open(f"/proc/{pid}/cmdline", 'rb') as f:
+            return b'dns_forwarder' in f.read()
+    except OSError:
+        return False
+
+class DnsManager:
+    """Per-VPC caching DNS forwarder listening on every subnet gateway.
+
+    The forwarder (dns_forwarder.py) runs on the host, so it reaches the
+    upstreams directly and private subnets can resolve too. It answers
+    <subnet>.<vpc>.<domain> and <namespace>.<vpc>.<domain> from VPC state
+    and caches everything else. Its config is rewritten and reloaded with
+    SIGHUP whenever a subnet is added.
+    """
+
+    @staticmethod
+    def dns_dir():
+        # Looked up per call: record runs move STATE_DIR to a scratch copy
+        return state_store.STATE_DIR / 'dns'
+
+    @staticmethod
+    def paths(vpc_name):
+        dns_dir = DnsManager.dns_dir()
+        return dns_dir / f"{vpc_name}.json", dns_dir / f"{vpc_name}.stats.json", dns_dir / f"{vpc_name}.log"
+
+    @staticmethod
+    def zone(vpc_name, state):
+        return f"{vpc_name}.{state['dns']['domain']}".lower()
+
+    @staticmethod
+    def records(vpc_name, state):
+        zone = DnsManager.zone(vpc_name, state)
+        records = {}
+        for name, subnet in state['subnets'].items():
+            if subnet.get('namespace_ip'):
+                records[f"{name}.{zone}"] = subnet['namespace_ip']
+                records[f"{subnet['namespace']}.{zone}"] = subnet['namespace_ip']
+        return records
+
+    @staticmethod
+    def config(vpc_name, state):
+        dns = state['dns']
+        return {'zone': DnsManager.zone(vpc_name, state), 'records': DnsManager.records(vpc_name, state),
+                'listen': sorted(s['gateway_ip'] for s in state['subnets'].values() if s.get('gateway_ip')),
+                'port': dns.get('port', 53), 'upstreams': dns['upstreams'], 'cache_size': dns['cache_size'],
+                'stats': str(DnsManager.paths(vpc_name)[1])}
+
+    @staticmethod
+    def resolv_conf(vpc_name, state, subnet):
+        """resolv.conf for a subnet: its gateway when the VPC runs a forwarder, public resolvers otherwise"""
+        if 'dns' in state and subnet.get('gateway_ip'):
+            return (f"nameserver {subnet['gateway_ip']}\n"
+                    f"search {DnsManager.zone(vpc_name, state)}\n")
+        return ''.join(f"nameserver {server}\n" for server in FALLBACK_UPSTREAMS)
+
+    @staticmethod
+    def write_resolv_conf(vpc_name, state, subnet):
+        get_backend().write_file(f"/etc/netns/{subnet['namespace']}/resolv.conf",
+                                 DnsManager.resolv_conf(vpc_name, state, subnet))
+
+    @staticmethod
+    def _write_config(vpc_name, state):
+        config_path = DnsManager.paths(vpc_name)[0]
+        get_backend().write_file(str(config_path), json.dumps(DnsManager.config(vpc_name, state), indent=2) + '\n')
+        return config_path
+
+    @staticmethod
+    def _wait_ready(vpc_name, process, listen):
+        """Wait until the forwarder's stats show it bound to every gateway"""
+        stats_path = DnsManager.paths(vpc_name)[1]
+        wanted = {f"{address}:{port}" for address, port in listen}
+        deadline = time.monotonic() + READY_TIMEOUT
+        while time.monotonic() < deadline:
+            stats = DnsManager.read_stats(vpc_name, stats_path)
+            if stats and stats.get('pid') == process.pid and wanted <= set(stats.get('listen', [])):
+                return True
+            # Not _alive(): until the child has exec'd, its cmdline is still ours
+            if process.poll() is not None:
+                return False
+            time.sleep(0.05)
+        return False
+
+    @staticmethod
+    def read_stats(vpc_name, path=None):
+        try:
+            with open(path or DnsManager.paths(vpc_name)[1]) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def start(vpc_name, state):
+        """(Re)start the forwarder of a VPC; records its pid in state['dns']"""
+        DnsManager.stop(vpc_name, state, remove=False)
+        config_path = DnsManager._write_config(vpc_name, state)
+        log_path = DnsManager.paths(vpc_name)[2]
+        cmd = [sys.executable, FORWARDER, 'serve', '--config', str(config_path)]
+        backend = get_backend()
+        if not backend.live:
+            backend.spawn(cmd)
+            return True
+        with open(log_path, 'a') as log_file:
+            process = backend.spawn(cmd, stdin=subprocess.DEVNULL, stdout=log_file, stderr=log_file,
+                                    start_new_session=True)
+        state['dns']['pid'] = process.pid
+        config = DnsManager.config(vpc_name, state)
+        if not DnsManager._wait_ready(vpc_name, process, [(a, config['port']) for a in config['listen']]):
+            log('ERROR', f"DNS forwarder for {vpc_name} did not start, see {log_path}")
+            return False
+        log('SUCCESS', f"DNS forwarder for {vpc_name} listening on {', '.join(config['listen']) or 'no gateway yet'}")
+        return True
+
+    @staticmethod
+    def stop(vpc_name, state, remove=True):
+        """Stop a VPC's forwarder; with remove, also delete its config, stats and log"""
+        pid = state.get('dns', {}).pop('pid', None)
+        if not get_backend().live:
+            return True  # the pid and files belong to the real forwarder
+        if pid and _alive(pid):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        if remove:
+            for path in DnsManager.paths(vpc_name):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+        return True
+
+    @staticmethod
+    def refresh(vpc_name, state):
+        """Rewrite the forwarder config from state and make it reload (new subnets, records)"""
+        if 'dns' not in state:
+            return True
+        DnsManager._write_config(vpc_name, state)
+        if not get_backend().live:
+            return True
+        pid = state['dns'].get('pid')
+        if not pid or not _alive(pid):
+            log('WARNING', f"DNS forwarder for {vpc_name} is not running; restart it with `vpcctl dns enable {vpc_name}`")
+            return False
+        os.kill(pid, signal.SIGHUP)
+        return True
+
+    @staticmethod
+    def enable(vpc_name, upstreams=None, cache_size=DEFAULT_CACHE_SIZE, domain=DEFAULT_DOMAIN, port=53):
+        manager = StateManager()
+        state = manager.load(vpc_name)
+        if not state:
+            log('ERROR', f"VPC {vpc_name} not found")
+            return False
+        DnsManager.dns_dir().mkdir(parents=True, exist_ok=True)
+        previous = state.get('dns', {})
+        state['dns'] = {'upstreams': list(upstreams or previous.get('upstreams') or host_upstreams()),
+                        'cache_size': cache_size, 'domain': domain, 'port': port}
+        if previous.get('pid'):
+            state['dns']['pid'] = previous['pid']
+        log('INFO', f"Starting DNS forwarder for {vpc_name} (zone {DnsManager.zone(vpc_name, state)}, "
+                    f"upstreams {', '.join(state['dns']['upstreams'])})")
+        ok = DnsManager.start(vpc_name, state)
+        if ok and port == 53:
+            # resolv.conf cannot name a port, so only the standard one is handed to workloads
+            for subnet in state['subnets'].values():
+                DnsManager.write_resolv_conf(vpc_name, state, subnet)
+        manager.save(vpc_name, state)
+        return ok
+
+    @staticmethod
+    def disable(vpc_name):
+        manager = StateManager()
+        state = manager.load(vpc_name)
+        if not state:
+            log('ERROR', f"VPC {vpc_name} not found")
+            return False
+        if 'dns' not in state:
+            log('INFO', f"VPC {vpc_name} has no DNS forwarder")
+            return True
+        DnsManager.stop(vpc_name, state)
+        del state['dns']
+        for subnet in state['subnets'].values():
+            DnsManager.write_resolv_conf(vpc_name, state, subnet)
+        manager.save(vpc_name, state)
+        log('SUCCESS', f"DNS forwarder for {vpc_name} stopped")
+        return True
+
+    @staticmethod
+    def status(vpc_names=None):
+        manager = StateManager()
+        rows = []
+        for vpc_name in vpc_names or manager.list_all():
+            state = manager.load(vpc_name)
+            if not state:
+                log('ERROR', f"VPC {vpc_name} not found")
+                return None
+            if 'dns' not in state:
+                continue
+            pid = state['dns'].get('pid')
+            running = bool(pid) and _alive(pid)
+            rows.append({'vpc': vpc_name, 'zone': DnsManager.zone(vpc_name, state), 'running': running,
+                         'upstreams': state['dns']['upstreams'],
+                         'stats': DnsManager.read_stats(vpc_name) if running else None})
+        return rows
+
+    @staticmethod
+    def render(rows, output_format='table'):
+        if output_format == 'json':
+            print(json.dumps({'forwarders': rows}, indent=2))
+            return
+        print(f"\n{'='*92}")
+        print(f"{'VPC':<14} {'ZONE':<22} {'STATE':<8} {'QUERIES':>8} {'LOCAL':>7} {'HIT RATE':>9} "
+              f"{'CACHED':>7} {'MISS P50/P99 MS':>16}")
+        print(f"{'='*92}")
+        if not rows:
+            print("  No VPC runs a DNS forwarder (vpcctl dns enable <vpc>)")
+        for row in rows:
+            stats = row['stats'] or {}
+            state = f"{Colors.GREEN}running{Colors.RESET}" if row['running'] else f"{Colors.RED}stopped{Colors.RESET}"
+            hit_rate = f"{stats['hit_rate'] * 100:.1f}%" if stats.get('hit_rate') is not None else '-'
+            miss = (stats.get('latency_ms') or {}).get('miss')
+            latency = f"{miss['p50']:.2f}/{miss['p99']:.2f}" if miss else '-'
+            print(f"{row['vpc']:<14} {row['zone']:<22} {state:<17} {stats.get('queries', 0):>8} "
+                  f"{stats.get('local', 0):>7} {hit_rate:>9} {stats.get('cache_entries', 0):>7} {latency:>16}")
+        print()
@@ -0,0 +1,466 @@
+# Caching DNS forwarder for `vpcctl dns`, one per VPC, started on the host with
+# `python3 dns_forwarder.py serve --config <file>`. It runs as a script, so it
+# imports nothing from vpcctl_lib. Names under the VPC zone are answered from
+# the config; everything else goes to the upstreams through a bounded LRU/TTL
+# cache. SIGHUP re-reads the config (new records and listen addresses), and
+# counters go to the stats file every STATS_INTERVAL seconds. The `stub` and
+# `query` roles answer and ask, so it can be tried without network access.
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import signal
+import socket
+import struct
+import sys
+import time
+
+QTYPE_A = 1
+QTYPE_OPT = 41
+QTYPE_ANY = 255
+CLASS_IN = 1
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+# Largest UDP reply for a client that did not advertise EDNS
+CLASSIC_UDP_SIZE = 512
+STATS_INTERVAL = 2.0
+UPSTREAM_TIMEOUT = 2.0
+# Cache lifetime of NXDOMAIN/NODATA answers, unless their SOA says less
+NEGATIVE_TTL = 30
+# TTL of zone records; short, so renamed or new subnets show up quickly
+LOCAL_TTL = 5
+LATENCY_SAMPLES = 2048
+
+_HEADER = struct.Struct('!HHHHHH')
+
+def _log(message):
+    sys.stderr.write(f"dns_forwarder: {message}\n")
+    sys.stderr.flush()
+
+def _hostport(text, default_port=53):
+    host, _, port = text.rpartition(':') if text.count(':') == 1 else (text, '', '')
+    return (host, int(port)) if port else (text, default_port)
+
+def _skip_name(message, offset):
+    """Offset just past a (possibly compressed) name"""
+    while True:
+        length = message[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+
+def parse_question(message):
+    """(qname, qtype, qclass, end offset) of the only question; raises ValueError if malformed"""
+    try:
+        flags, qdcount = struct.unpack_from('!2xHH', message)
+        if flags & FLAG_QR or qdcount != 1:
+            raise ValueError('not a single-question query')
+        labels, offset = [], 12
+        while message[offset]:
+            length = message[offset]
+            if length & 0xC0:
+                raise ValueError('compressed name in question')
+            labels.append(message[offset + 1:offset + 1 + length].decode('ascii').lower())
+            offset += 1 + length
+        qtype, qclass = struct.unpack_from('!HH', message, offset + 1)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(str(e))
+    return '.'.join(labels), qtype, qclass, offset + 5
+
+def ttl_offsets(message):
+    """Offsets of the TTL field of every resource record, leaving out EDNS OPT records"""
+    _, _, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(message)
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(message, offset) + 4
+    offsets = []
+    for _ in range(ancount + nscount + arcount):
+        offset = _skip_name(message, offset)
+        rtype, _, _, rdlength = struct.unpack_from('!HHIH', message, offset)
+        if rtype != QTYPE_OPT:
+            offsets.append(offset + 4)
+        offset += 10 + rdlength
+    return offsets
+
+def answers(message):
+    """A-record addresses and their TTLs in a response's answer section"""
+    _, _, qdcount, ancount, _, _ = _HEADER.unpack_from(message)
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(message, offset) + 4
+    found = []
+    for _ in range(ancount):
+        offset = _skip_name(message, offset)
+        rtype, _, ttl, rdlength = struct.unpack_from('!HHIH', message, offset)
+        if rtype == QTYPE_A and rdlength == 4:
+            found.append((socket.inet_ntoa(message[offset + 10:offset + 14]), ttl))
+        offset += 10 + rdlength
+    return found
+
+def reply(query, end, rcode, records=(), authoritative=False, ttl=LOCAL_TTL):
+    """A response to query carrying its question and an A record per address in records"""
+    query_id, flags = struct.unpack_from('!HH', query)
+    flags = FLAG_QR | FLAG_RA | (flags & FLAG_RD) | (FLAG_AA if authoritative else 0) | rcode
+    body = b''.join(struct.pack('!HHHIH', 0xC00C, QTYPE_A, CLASS_IN, ttl, 4) + socket.inet_aton(address)
+                    for address in records)
+    return _HEADER.pack(query_id, flags, 1, len(records), 0, 0) + bytes(query[12:end]) + body
+
+def truncated(query, end):
+    query_id, flags = struct.unpack_from('!HH', query)
+    return _HEADER.pack(query_id, FLAG_QR | FLAG_RA | FLAG_TC | (flags & FLAG_RD), 1, 0, 0, 0) + bytes(query[12:end])
+
+class Cache:
+    """LRU of upstream responses keyed on the question; an entry lives as long as its lowest TTL"""
+
+    def __init__(self, size, max_ttl):
+        self.size = size
+        self.max_ttl = max_ttl
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        response, stored, expires, offsets = entry
+        if now >= expires:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        # Count the TTLs down by the time spent in the cache
+        age = int(now - stored)
+        message = bytearray(response)
+        for offset in offsets:
+            (ttl,) = struct.unpack_from('!I', message, offset)
+            struct.pack_into('!I', message, offset, max(ttl - age, 0))
+        return message
+
+    def put(self, key, response, now):
+        flags, ancount = struct.unpack_from('!2xH2xH', response)
+        if flags & FLAG_TC or flags & 0xF not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            return
+        try:
+            offsets = ttl_offsets(response)
+        except (IndexError, struct.error):
+            return
+        ttls = [struct.unpack_from('!I', response, offset)[0] for offset in offsets]
+        ttl = min(ttls) if ancount and ttls else min(ttls + [NEGATIVE_TTL])
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0 or self.size <= 0:
+            return
+        self.entries[key] = (bytes(response), now, now + ttl, offsets)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+class Upstream(asyncio.DatagramProtocol):
+    """One unconnected UDP socket for every forwarded query; replies are matched on a fresh ID"""
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        waiter = self.pending.get(struct.unpack_from('!H', data)[0])
+        if waiter and waiter[1] == addr[:2] and not waiter[0].done():
+            waiter[0].set_result(data)
+
+    async def query(self, message, server, timeout):
+        query_id = random.getrandbits(16)
+        while query_id in self.pending:
+            query_id = random.getrandbits(16)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[query_id] = (future, server)
+        try:
+            self.transport.sendto(struct.pack('!H', query_id) + bytes(message[2:]), server)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(query_id, None)
+
+async def _tcp_exchange(message, server):
+    reader, writer = await asyncio.open_connection(*server)
+    try:
+        writer.write(struct.pack('!H', len(message)) + bytes(message))
+        await writer.drain()
+        (length,) = struct.unpack('!H', await reader.readexactly(2))
+        return await reader.readexactly(length)
+    finally:
+        writer.close()
+
+class Forwarder:
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self.cache = None
+        self.upstream = None
+        self.counters = collections.Counter()
+        self.latencies = {kind: collections.deque(maxlen=LATENCY_SAMPLES) for kind in ('local', 'hit', 'miss')}
+        self.started = time.time()
+        self.listeners = {}
+        self.tasks = set()
+        self.load()
+
+    def load(self):
+        with open(self.config_path) as f:
+            config = json.load(f)
+        self.config = config
+        self.zone = config['zone'].lower().rstrip('.')
+        self.records = {name.lower().rstrip('.'): address for name, address in config['records'].items()}
+        self.upstreams = [_hostport(u) for u in config['upstreams']]
+        if self.cache is None or self.cache.size != config['cache_size']:
+            self.cache = Cache(config['cache_size'], config.get('max_ttl', 3600))
+        self.cache.max_ttl = config.get('max_ttl', 3600)
+
+    def _observe(self, kind, started):
+        self.counters[kind] += 1
+        self.latencies[kind].append(time.perf_counter() - started)
+
+    async def resolve(self, query, tcp=False):
+        started = time.perf_counter()
+        try:
+            qname, qtype, qclass, end = parse_question(query)
+        except ValueError:
+            self.counters['malformed'] += 1
+            return None
+        self.counters['queries'] += 1
+
+        if qname == self.zone or qname.endswith('.' + self.zone):
+            address = self.records.get(qname)
+            if address is None:
+                response = reply(query, end, RCODE_NXDOMAIN, authoritative=True)
+            else:
+                wanted = qtype in (QTYPE_A, QTYPE_ANY) and qclass == CLASS_IN
+                response = reply(query, end, RCODE_NOERROR, [address] if wanted else [], authoritative=True)
+            self._observe('local', started)
+            return response
+
+        key = (qname, qtype, qclass)
+        response = self.cache.get(key, time.monotonic())
+        if response is not None:
+            response[0:2] = query[0:2]
+            kind = 'hit'
+        else:
+            response = await self.forward(query, tcp)
+            if response is None:
+                self.counters['servfail'] += 1
+                return reply(query, end, RCODE_SERVFAIL)
+            self.cache.put(key, response, time.monotonic())
+            kind = 'miss'
+        self._observe(kind, started)
+        # A client without EDNS (no additional records) only takes classic-size UDP replies
+        if not tcp and len(response) > CLASSIC_UDP_SIZE and not struct.unpack_from('!10xH', query)[0]:
+            return truncated(query, end)
+        return bytes(response)
+
+    async def forward(self, query, tcp):
+        for server in self.upstreams:
+            try:
+                if tcp:
+                    response = await asyncio.wait_for(_tcp_exchange(query, server), UPSTREAM_TIMEOUT)
+                else:
+                    response = await self.upstream.query(query, server, UPSTREAM_TIMEOUT)
+                return bytearray(query[0:2]) + response[2:]
+            except (asyncio.TimeoutError, OSError, asyncio.IncompleteReadError, struct.error):
+                self.counters['upstream_errors'] += 1
+        return None
+
+    # Listeners
+
+    async def listen(self):
+        """Bind every configured address not bound yet and close the ones no longer configured"""
+        loop = asyncio.get_running_loop()
+        port = self.config.get('port', 53)
+        wanted = {(address, port) for address in self.config['listen']}
+        for key in list(self.listeners):
+            if key not in wanted:
+                for server in self.listeners.pop(key):
+                    server.close()
+        for key in sorted(wanted - set(self.listeners)):
+            try:
+                udp, _ = await loop.create_datagram_endpoint(lambda: UdpServer(self), local_addr=key)
+                tcp = await asyncio.start_server(self.serve_tcp, key[0], key[1], reuse_address=True)
+            except OSError as e:
+                _log(f"cannot listen on {key[0]}:{key[1]}: {e}")
+                continue
+            self.listeners[key] = (udp, tcp)
+
+    async def serve_tcp(self, reader, writer):
+        try:
+            while True:
+                (length,) = struct.unpack('!H', await reader.readexactly(2))
+                response = await self.resolve(await reader.readexactly(length), tcp=True)
+                if response is None:
+                    break
+                writer.write(struct.pack('!H', len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # Stats
+
+    def stats(self):
+        def percentiles(samples):
+            if not samples:
+                return None
+            ordered = sorted(samples)
+            pick = lambda p: round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 3)
+            return {'p50': pick(50), 'p99': pick(99), 'max': round(ordered[-1] * 1000, 3)}
+        cached = self.counters['hit'] + self.counters['miss']
+        return {'pid': os.getpid(), 'started': self.started, 'updated': time.time(),
+                'listen': [f"{host}:{port}" for host, port in sorted(self.listeners)],
+                'upstreams': [f"{host}:{port}" for host, port in self.upstreams],
+                'queries': self.counters['queries'], 'local': self.counters['local'],
+                'hits': self.counters['hit'], 'misses': self.counters['miss'],
+                'hit_rate': round(self.counters['hit'] / cached, 4) if cached else None,
+                'servfail': self.counters['servfail'], 'upstream_errors': self.counters['upstream_errors'],
+                'malformed': self.counters['malformed'],
+                'cache_entries': len(self.cache.entries), 'cache_size': self.cache.size,
+                'latency_ms': {kind: percentiles(samples) for kind, samples in self.latencies.items()}}
+
+    def write_stats(self):
+        path = self.config.get('stats')
+        if not path:
+            return
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.stats(), f)
+        os.replace(tmp, path)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        _, self.upstream = await loop.create_datagram_endpoint(Upstream, family=socket.AF_INET)
+        await self.listen()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+        loop.add_signal_handler(signal.SIGHUP, lambda: self.spawn(self.reload()))
+        self.write_stats()
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), STATS_INTERVAL)
+            except asyncio.TimeoutError:
+                self.write_stats()
+        for servers in self.listeners.values():
+            for server in servers:
+                server.close()
+
+    async def reload(self):
+        try:
+            self.load()
+        except (OSError, ValueError, KeyError) as e:
+            _log(f"keeping the old config, cannot load {self.config_path}: {e}")
+            return
+        await self.listen()
+        self.write_stats()
+
+class UdpServer(asyncio.DatagramProtocol):
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.forwarder.spawn(self.answer(data, addr))
+
+    async def answer(self, data, addr):
+        response = await self.forwarder.resolve(data)
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+# Offline roles
+
+class Stub(asyncio.DatagramProtocol):
+    """Upstream stand-in: every A query gets the same address"""
+
+    def __init__(self, address, ttl):
+        self.address = address
+        self.ttl = ttl
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            _, qtype, _, end = parse_question(data)
+        except ValueError:
+            return
+        records = [self.address] if qtype in (QTYPE_A, QTYPE_ANY) else []
+        self.transport.sendto(reply(data, end, RCODE_NOERROR, records, ttl=self.ttl), addr)
+
+async def stub(args):
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(lambda: Stub(args.address, args.ttl), local_addr=(args.listen, args.port))
+    print(json.dumps({'ready': True}), flush=True)
+    await asyncio.Event().wait()
+
+def query(args):
+    name = args.name.rstrip('.')
+    question = b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\0'
+    message = _HEADER.pack(random.getrandbits(16), FLAG_RD, 1, 0, 0, 0) + question + struct.pack('!HH', QTYPE_A, CLASS_IN)
+    started = time.perf_counter()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(args.timeout)
+        sock.sendto(message, (args.server, args.port))
+        response, _ = sock.recvfrom(65535)
+    elapsed = time.perf_counter() - started
+    rcode = struct.unpack_from('!2xH', response)[0] & 0xF
+    found = answers(response)
+    print(json.dumps({'name': name, 'rcode': {0: 'NOERROR', 2: 'SERVFAIL', 3: 'NXDOMAIN'}.get(rcode, rcode),
+                      'answers': [a for a, _ in found], 'ttl': min((t for _, t in found), default=None),
+                      'ms': round(elapsed * 1000, 3)}))
+    return 0 if rcode == RCODE_NOERROR else 1
+
+def main():
+    parser = argparse.ArgumentParser(prog='dns_forwarder')
+    roles = parser.add_subparsers(dest='role', required=True)
+    serve = roles.add_parser('serve', help='Run the forwarder')
+    serve.add_argument('--config', required=True, help='JSON config written by vpcctl dns')
+    stub_parser = roles.add_parser('stub', help='Answer every A query with one address')
+    stub_parser.add_argument('--listen', default='127.0.0.1')
+    stub_parser.add_argument('--port', type=int, default=5353)
+    stub_parser.add_argument('--address', default='192.0.2.1')
+    stub_parser.add_argument('--ttl', type=int, default=60)
+    query_parser = roles.add_parser('query', help='Ask one A query and print the answer as JSON')
+    query_parser.add_argument('name')
+    query_parser.add_argument('--server', default='127.0.0.1')
+    query_parser.add_argument('--port', type=int, default=53)
+    query_parser.add_argument('--timeout', type=float, default=3.0)
+    args = parser.parse_args()
+    try:
+        if args.role == 'serve':
+            asyncio.run(Forwarder(args.config).run())
+        elif args.role == 'stub':
+            asyncio.run(stub(args))
+        else:
+            sys.exit(query(args))
+    except KeyboardInterrupt:
+        pass
+    except (OSError, ValueError) as e:
+        _log(str(e))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
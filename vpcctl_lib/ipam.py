@@ -0,0 +1,175 @@
+import ipaddress
+from vpcctl_lib.state import log
+
+class _Node:
+    """Binary trie node covering one prefix of the VPC range.
+
+    `largest_free` is the shortest prefix length that is entirely free
+    somewhere in this subtree (None when nothing is free), which lets
+    allocation descend straight to a suitable block.
+    """
+
+    __slots__ = ('children', 'allocated', 'used', 'largest_free')
+
+    def __init__(self, prefixlen):
+        self.children = [None, None]
+        self.allocated = False
+        self.used = False
+        self.largest_free = prefixlen
+
+# Tries of recently changed VPCs, by (state database, VPC): (state revision, IPAM)
+_indexes = {}
+
+class IPAM:
+    """Prefix allocator for a single VPC.
+
+    Allocated subnets are kept in a radix trie over the VPC CIDR, so overlap
+    checks, inserts and carving the next free block all cost O(prefix
+    length) regardless of how many subnets exist. Building the trie from
+    state is O(subnets); a long-running process (the daemon) keeps it per
+    VPC with checkout()/checkin() and only rebuilds when the state revision
+    moved underneath it.
+    """
+
+    def __init__(self, vpc_cidr, subnets=None):
+        self.network = ipaddress.ip_network(vpc_cidr)
+        self.bits = self.network.max_prefixlen
+        self.root = _Node(self.network.prefixlen)
+        self.owners = {}
+        for subnet_name, subnet_data in (subnets or {}).items():
+            self.add(subnet_data['cidr'], subnet_name)
+
+    @classmethod
+    def checkout(cls, key, revision, vpc_cidr, subnets):
+        """The cached trie for key if it is at revision, else one built from subnets.
+
+        The caller owns the trie until checkin(), so a failed change never
+        leaves a half-updated trie behind. Callers hold the VPC's lock.
+        """
+        cached = _indexes.pop(key, None)
+        if cached is not None and revision is not None and cached[0] == revision:
+            return cached[1]
+        return cls(vpc_cidr, subnets)
+
+    def checkin(self, key, revision):
+        """Keep this trie for key, describing the state saved as revision"""
+        if revision is not None:
+            _indexes[key] = (revision, self)
+
+    @staticmethod
+    def gateway_ip(cidr):
+        """First usable address of a subnet, in constant time"""
+        network = ipaddress.ip_network(cidr)
+        if network.num_addresses < 4:
+            raise ValueError(f"Subnet {cidr} is too small for a gateway and a namespace")
+        return str(network.network_address + 1)
+
+    @staticmethod
+    def namespace_ip(cidr):
+        """Second usable address of a subnet, in constant time"""
+        IPAM.gateway_ip(cidr)
+        return str(ipaddress.ip_network(cidr).network_address + 2)
+
+    def _bit(self, address, prefixlen):
+        return (int(address) >> (self.bits - prefixlen - 1)) & 1
+
+    @staticmethod
+    def _refresh(node, prefixlen):
+        if node.allocated:
+            node.largest_free = None
+            node.used = True
+            return
+        node.used = any(child is not None and child.used for child in node.children)
+        if not node.used:
+            node.largest_free = prefixlen
+            return
+        candidates = []
+        for child in node.children:
+            if child is None:
+                candidates.append(prefixlen + 1)
+            elif child.largest_free is not None:
+                candidates.append(child.largest_free)
+        node.largest_free = min(candidates) if candidates else None
+
+    def find_overlap(self, cidr):
+        """Return the name of an allocated subnet overlapping cidr, or None"""
+        network = ipaddress.ip_network(cidr)
+        if network.version != self.network.version or not network.overlaps(self.network):
+            return None
+        if network.prefixlen <= self.network.prefixlen:
+            return self._first_owner(self.network, self.root) if self.root.used else None
+        node = self.root
+        for prefixlen in range(self.network.prefixlen, network.prefixlen):
+            if node.allocated:
+                return self.owners.get(self._prefix_of(network, prefixlen))
+            node = node.children[self._bit(network.network_address, prefixlen)]
+            if node is None:
+                return None
+        if node.allocated or node.used:
+            return self._first_owner(network, node)
+        return None
+
+    def _prefix_of(self, network, prefixlen):
+        return str(network.supernet(new_prefix=prefixlen))
+
+    def _first_owner(self, network, node):
+        """Walk down to the first allocated prefix under node"""
+        prefixlen = network.prefixlen
+        address = int(network.network_address)
+        while not node.allocated:
+            bit = 0 if node.children[0] is not None and node.children[0].used else 1
+            address |= bit << (self.bits - prefixlen - 1)
+            node = node.children[bit]
+            prefixlen += 1
+        return self.owners.get(str(ipaddress.ip_network((address, prefixlen))))
+
+    def add(self, cidr, owner=None):
+        """Record an allocated prefix; raises ValueError on overlap"""
+        network = ipaddress.ip_network(cidr)
+        if not network.subnet_of(self.network):
+            raise ValueError(f"Subnet {cidr} is not within VPC CIDR {self.network}")
+        clash = self.find_overlap(network)
+        if clash is not None:
+            raise ValueError(f"Subnet {cidr} overlaps with existing subnet {clash}")
+        path = [self.root]
+        node = self.root
+        for prefixlen in range(self.network.prefixlen, network.prefixlen):
+            bit = self._bit(network.network_address, prefixlen)
+            if node.children[bit] is None:
+                node.children[bit] = _Node(prefixlen + 1)
+            node = node.children[bit]
+            path.append(node)
+        node.allocated = True
+        self.owners[str(network)] = owner
+        for depth in range(len(path) - 1, -1, -1):
+            self._refresh(path[depth], self.network.prefixlen + depth)
+
+    def carve(self, prefixlen, owner=None):
+        """Allocate the lowest free block of the given prefix length"""
+        if prefixlen < self.network.prefixlen or prefixlen > self.bits:
+            raise ValueError(f"/{prefixlen} does not fit in VPC CIDR {self.network}")
+        node = self.root
+        if node.largest_free is None or node.largest_free > prefixlen:
+            raise ValueError(f"No free /{prefixlen} left in VPC CIDR {self.network}")
+        address = int(self.network.network_address)
+        depth = self.network.prefixlen
+        while depth < prefixlen and node.used:
+            for bit in (0, 1):
+                child = node.children[bit]
+                free = depth + 1 if child is None else child.largest_free
+                if free is not None and free <= prefixlen:
+                    address |= bit << (self.bits - depth - 1)
+                    depth += 1
+                    node = child if child is not None else _Node(depth)
+                    break
+        cidr = str(ipaddress.ip_network((address, prefixlen)))
+        self.add(cidr, owner)
+        return cidr
+
+def parse_size(size):
+    """Accept '/24' or '24' and return the prefix length"""
+    try:
+        return int(str(size).lstrip('/'))
+    except ValueError:
+        log('ERROR', f"Invalid subnet size: {size}")
+        return None
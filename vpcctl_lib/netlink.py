@@ -0,0 +1,396 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import threading
+import ipaddress
+
+# Netlink / rtnetlink constants (linux/netlink.h, linux/rtnetlink.h, linux/if_link.h)
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_MASTER = 10
+IFLA_TXQLEN = 13
+IFLA_LINKINFO = 18
+IFLA_NET_NS_FD = 28
+IFLA_NUM_TX_QUEUES = 31
+IFLA_NUM_RX_QUEUES = 32
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+NLA_F_NESTED = 0x8000
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RTN_UNICAST = 1
+
+IFF_UP = 0x1
+
+CLONE_NEWNET = 0x40000000
+MS_BIND = 4096
+MS_REC = 16384
+MS_SHARED = 1 << 20
+MNT_DETACH = 2
+
+NETNS_RUN_DIR = "/var/run/netns"
+
+_IFINFOMSG = struct.Struct('BxHiII')
+_IFADDRMSG = struct.Struct('BBBBI')
+_RTMSG = struct.Struct('BBBBBBBBI')
+_NLMSGHDR = struct.Struct('IHHII')
+_NLATTR = struct.Struct('HH')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+def _check_libc(ret):
+    if ret != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+class NetlinkError(OSError):
+    """A negative acknowledgement from the kernel"""
+
+
+def _attr(attr_type, payload):
+    length = _NLATTR.size + len(payload)
+    padding = b'\0' * ((4 - length % 4) % 4)
+    return _NLATTR.pack(length, attr_type) + payload + padding
+
+
+def _attr_str(attr_type, value):
+    return _attr(attr_type, value.encode() + b'\0')
+
+
+def _attr_u32(attr_type, value):
+    return _attr(attr_type, struct.pack('I', value))
+
+
+def _parse_attrs(data):
+    attrs = {}
+    offset = 0
+    while offset + _NLATTR.size <= len(data):
+        length, attr_type = _NLATTR.unpack_from(data, offset)
+        if length < _NLATTR.size:
+            break
+        attrs[attr_type & ~NLA_F_NESTED] = data[offset + _NLATTR.size:offset + length]
+        offset += (length + 3) & ~3
+    return attrs
+
+
+def netns_path(name):
+    return os.path.join(NETNS_RUN_DIR, name)
+
+
+class _InNetns:
+    """Temporarily move the calling thread into a named network namespace"""
+
+    def __init__(self, name):
+        self.name = name
+        self.saved_fd = None
+
+    def __enter__(self):
+        if self.name is None:
+            return self
+        libc = _get_libc()
+        self.saved_fd = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+        target_fd = os.open(netns_path(self.name), os.O_RDONLY)
+        try:
+            _check_libc(libc.setns(target_fd, CLONE_NEWNET))
+        except OSError:
+            os.close(self.saved_fd)
+            raise
+        finally:
+            os.close(target_fd)
+        return self
+
+    def __exit__(self, *exc):
+        if self.saved_fd is not None:
+            try:
+                _check_libc(_get_libc().setns(self.saved_fd, CLONE_NEWNET))
+            finally:
+                os.close(self.saved_fd)
+        return False
+
+
+class RtNetlink:
+    """Minimal rtnetlink client for link, address, route and netns operations.
+
+    A socket opened for a namespace stays bound to it, so only socket
+    creation has to happen inside the namespace.
+    """
+
+    def __init__(self, netns=None):
+        self.netns = netns
+        self.seq = 0
+        with _InNetns(netns):
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _request(self, msg_type, flags, payload, ack=True):
+        self.seq += 1
+        flags |= NLM_F_REQUEST | (NLM_F_ACK if ack else 0)
+        header = _NLMSGHDR.pack(_NLMSGHDR.size + len(payload), msg_type, flags, self.seq, 0)
+        self.sock.send(header + payload)
+        replies = []
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                length, reply_type, _, seq, _ = _NLMSGHDR.unpack_from(data, offset)
+                body = data[offset + _NLMSGHDR.size:offset + length]
+                offset += (length + 3) & ~3
+                if seq != self.seq:
+                    continue
+                if reply_type == NLMSG_ERROR:
+                    code = struct.unpack_from('i', body)[0]
+                    if code:
+                        raise NetlinkError(-code, os.strerror(-code))
+                    return replies
+                if reply_type == NLMSG_DONE:
+                    return replies
+                replies.append((reply_type, body))
+
+    # Links
+
+    def link_index(self, name):
+        payload = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + _attr_str(IFLA_IFNAME, name)
+        for reply_type, body in self._request(RTM_GETLINK, 0, payload):
+            if reply_type == RTM_NEWLINK:
+                return _IFINFOMSG.unpack_from(body)[2]
+        raise NetlinkError(errno.ENODEV, os.strerror(errno.ENODEV))
+
+    def link_exists(self, name):
+        try:
+            self.link_index(name)
+            return True
+        except NetlinkError:
+            return False
+
+    def link_add(self, name, kind, peer=None, attrs=None):
+        attrs = attrs or {}
+        info_data = b''
+        if kind == 'veth' and peer:
+            peer_msg = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + _attr_str(IFLA_IFNAME, peer)
+            for attr_type, value in attrs.items():
+                peer_msg += _attr_u32(attr_type, value)
+            info_data = _attr(IFLA_INFO_DATA | NLA_F_NESTED, _attr(VETH_INFO_PEER, peer_msg))
+        linkinfo = _attr_str(IFLA_INFO_KIND, kind) + info_data
+        payload = (_IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+                   + _attr_str(IFLA_IFNAME, name)
+                   + _attr(IFLA_LINKINFO | NLA_F_NESTED, linkinfo))
+        for attr_type, value in attrs.items():
+            payload += _attr_u32(attr_type, value)
+        self._request(RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, payload)
+
+    def link_del(self, name):
+        index = self.link_index(name)
+        self._request(RTM_DELLINK, 0, _IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, 0, 0))
+
+    def link_set(self, name, up=None, master=None, netns=None, mtu=None, txqlen=None, new_name=None):
+        index = self.link_index(name)
+        flags = change = 0
+        if up is not None:
+            flags = IFF_UP if up else 0
+            change = IFF_UP
+        payload = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, flags, change)
+        if master is not None:
+            payload += _attr_u32(IFLA_MASTER, self.link_index(master) if master else 0)
+        if mtu is not None:
+            payload += _attr_u32(IFLA_MTU, mtu)
+        if txqlen is not None:
+            payload += _attr_u32(IFLA_TXQLEN, txqlen)
+        if new_name is not None:
+            payload += _attr_str(IFLA_IFNAME, new_name)
+        ns_fd = None
+        try:
+            if netns is not None:
+                ns_fd = os.open(netns_path(netns), os.O_RDONLY)
+                payload += _attr_u32(IFLA_NET_NS_FD, ns_fd)
+            self._request(RTM_NEWLINK, 0, payload)
+        finally:
+            if ns_fd is not None:
+                os.close(ns_fd)
+
+    # Addresses
+
+    def addr(self, action, cidr, dev):
+        iface = ipaddress.ip_interface(cidr)
+        family = socket.AF_INET if iface.version == 4 else socket.AF_INET6
+        packed = iface.ip.packed
+        payload = (_IFADDRMSG.pack(family, iface.network.prefixlen, 0, RT_SCOPE_UNIVERSE, self.link_index(dev))
+                   + _attr(IFA_LOCAL, packed) + _attr(IFA_ADDRESS, packed))
+        if action == 'del':
+            self._request(RTM_DELADDR, 0, payload)
+        elif action == 'replace':
+            self._request(RTM_NEWADDR, NLM_F_CREATE | NLM_F_REPLACE, payload)
+        else:
+            self._request(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, payload)
+
+    def addresses(self, family=socket.AF_INET):
+        """Dump (ifname, 'addr/prefix') for every address in the namespace"""
+        result = []
+        payload = _IFADDRMSG.pack(family, 0, 0, 0, 0)
+        for reply_type, body in self._request(RTM_GETADDR, NLM_F_DUMP, payload, ack=False):
+            if reply_type != RTM_NEWADDR:
+                continue
+            addr_family, prefixlen, _, _, _ = _IFADDRMSG.unpack_from(body)
+            attrs = _parse_attrs(body[_IFADDRMSG.size:])
+            packed = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+            if packed is None:
+                continue
+            label = attrs.get(IFA_LABEL, b'').rstrip(b'\0').decode()
+            result.append((label, f"{ipaddress.ip_address(packed)}/{prefixlen}"))
+        return result
+
+    # Routes
+
+    def routes(self, family=socket.AF_INET, table=RT_TABLE_MAIN):
+        """Dump main-table routes as dicts with dst ('default' or CIDR), gateway and oif"""
+        result = []
+        payload = _RTMSG.pack(family, 0, 0, 0, 0, 0, 0, 0, 0)
+        for reply_type, body in self._request(RTM_GETROUTE, NLM_F_DUMP, payload, ack=False):
+            if reply_type != RTM_NEWROUTE:
+                continue
+            fields = _RTMSG.unpack_from(body)
+            attrs = _parse_attrs(body[_RTMSG.size:])
+            route_table = struct.unpack('I', attrs[RTA_TABLE])[0] if RTA_TABLE in attrs else fields[4]
+            if route_table != table:
+                continue
+            dst_len = fields[1]
+            dst = 'default'
+            if RTA_DST in attrs:
+                dst = f"{ipaddress.ip_address(attrs[RTA_DST])}/{dst_len}"
+            gateway = str(ipaddress.ip_address(attrs[RTA_GATEWAY])) if RTA_GATEWAY in attrs else None
+            oif = struct.unpack('i', attrs[RTA_OIF])[0] if RTA_OIF in attrs else None
+            result.append({'dst': dst, 'gateway': gateway, 'oif': oif})
+        return result
+
+    def route(self, action, dst, via=None, dev=None):
+        network = ipaddress.ip_network('0.0.0.0/0' if dst == 'default' else dst, strict=False)
+        family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+        scope = RT_SCOPE_UNIVERSE if via else RT_SCOPE_LINK
+        payload = _RTMSG.pack(family, network.prefixlen, 0, 0, RT_TABLE_MAIN,
+                              RTPROT_BOOT, scope, RTN_UNICAST, 0)
+        if network.prefixlen:
+            payload += _attr(RTA_DST, network.network_address.packed)
+        if via:
+            payload += _attr(RTA_GATEWAY, ipaddress.ip_address(via).packed)
+        if dev:
+            payload += _attr_u32(RTA_OIF, self.link_index(dev))
+        if action == 'del':
+            self._request(RTM_DELROUTE, 0, payload)
+        elif action == 'replace':
+            self._request(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_REPLACE, payload)
+        else:
+            self._request(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, payload)
+
+
+def _prepare_netns_dir():
+    """Make the netns run directory a shared mount, like iproute2 does"""
+    libc = _get_libc()
+    os.makedirs(NETNS_RUN_DIR, mode=0o755, exist_ok=True)
+    run_dir = NETNS_RUN_DIR.encode()
+    if libc.mount(b"", run_dir, b"none", MS_SHARED | MS_REC, None) == 0:
+        return
+    if ctypes.get_errno() != errno.EINVAL:
+        _check_libc(-1)
+    _check_libc(libc.mount(run_dir, run_dir, b"none", MS_BIND | MS_REC, None))
+    _check_libc(libc.mount(b"", run_dir, b"none", MS_SHARED | MS_REC, None))
+
+
+def netns_add(name):
+    """Create a named network namespace without forking"""
+    _prepare_netns_dir()
+    path = netns_path(name)
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0)
+    os.close(fd)
+    errors = []
+
+    # unshare() only moves the calling thread, so do it on a throwaway thread
+    def worker():
+        libc = _get_libc()
+        try:
+            _check_libc(libc.unshare(CLONE_NEWNET))
+            _check_libc(libc.mount(b"/proc/thread-self/ns/net", path.encode(), b"none", MS_BIND, None))
+        except OSError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    if errors:
+        os.unlink(path)
+        raise errors[0]
+
+
+def netns_del(name):
+    path = netns_path(name)
+    _get_libc().umount2(path.encode(), MNT_DETACH)
+    os.unlink(path)
+
+
+def netns_rename(old, new):
+    """Give a named namespace a new name: bind its mount at the new path, then drop the old one"""
+    old_path, new_path = netns_path(old), netns_path(new)
+    fd = os.open(new_path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0)
+    os.close(fd)
+    try:
+        _check_libc(_get_libc().mount(old_path.encode(), new_path.encode(), b"none", MS_BIND, None))
+    except OSError:
+        os.unlink(new_path)
+        raise
+    netns_del(old)
+
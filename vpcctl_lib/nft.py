@@ -0,0 +1,138 @@
+import os
+from vpcctl_lib.state import log
+from vpcctl_lib.backend import run_cmd
+from vpcctl_lib.chains import VPCChains
+
+FIREWALLS = ('iptables', 'nft')
+TABLE_FAMILY = 'ip'
+TABLE_PREFIX = 'vpcctl-'
+
+_firewall = None
+
+def set_firewall(name):
+    """Select the engine new VPCs are created with"""
+    global _firewall
+    if name not in FIREWALLS:
+        raise ValueError(f"Unknown firewall {name} (choose from {', '.join(FIREWALLS)})")
+    _firewall = name
+    return _firewall
+
+def get_firewall():
+    if _firewall is None:
+        set_firewall(os.environ.get('VPCCTL_FIREWALL', 'iptables'))
+    return _firewall
+
+def firewall_of(state):
+    """Engine a VPC was created with; VPCs predating the choice use iptables"""
+    return state.get('firewall', 'iptables')
+
+def vpc_firewall(vpc_name, state):
+    """Forwarding and NAT owner of a VPC: VPCChains or NftVPC, which share one interface"""
+    if firewall_of(state) == 'nft':
+        return NftVPC(vpc_name, state['bridge'], state.get('nft'))
+    return VPCChains(vpc_name, state['bridge'])
+
+def table_name(vpc_name):
+    return f"{TABLE_PREFIX}{vpc_name}"
+
+def replace_table(name, body=None, family=TABLE_FAMILY):
+    """Lines that atomically replace (or, without a body, delete) a table.
+
+    Declaring the table first makes the delete succeed whether or not it
+    existed, so the document loads in one transaction either way.
+    """
+    lines = [f"table {family} {name} {{}}", f"delete table {family} {name}"]
+    if body is not None:
+        lines.append(f"table {family} {name} {{")
+        lines.extend(f"\t{line}" for line in body)
+        lines.append('}')
+    return lines
+
+def load(lines, netns=None):
+    """Load an nft document with `nft -f -`: every statement commits or none does"""
+    cmd = ['nft', '-f', '-']
+    if netns:
+        cmd = ['ip', 'netns', 'exec', netns] + cmd
+    return run_cmd(cmd, input='\n'.join(lines) + '\n')
+
+def named_set(kind, name, key, elements, interval=False):
+    """Body lines of a named set or map"""
+    lines = [f"{kind} {name} {{", f"\ttype {key}"]
+    if interval:
+        lines.append('\tflags interval')
+    if elements:
+        lines.append(f"\telements = {{ {', '.join(elements)} }}")
+    lines.append('}')
+    return lines
+
+class NftVPC:
+    """Forwarding and NAT of one VPC as its own nftables table.
+
+    Peered bridges and public subnets are set elements, so each packet is
+    one set lookup however many peerings and subnets the VPC has. Every
+    change rewrites the whole table with a single `nft -f` transaction,
+    which also makes each method idempotent.
+    """
+
+    state_key = 'nft'
+
+    def __init__(self, vpc_name, bridge, model=None):
+        model = model or {}
+        self.vpc_name = vpc_name
+        self.bridge = bridge
+        self.table = table_name(vpc_name)
+        self.peers = set(model.get('peers', []))
+        self.public = set(model.get('public', []))
+        self.internet_iface = model.get('internet_iface')
+
+    def as_state(self):
+        return {'table': self.table, 'peers': sorted(self.peers), 'public': sorted(self.public),
+                'internet_iface': self.internet_iface}
+
+    def document(self):
+        bridge = f'"{self.bridge}"'
+        forward = ['type filter hook forward priority 0; policy accept;',
+                   f"iifname {bridge} oifname {bridge} accept",
+                   f"iifname {bridge} oifname @peers accept"]
+        postrouting = ['type nat hook postrouting priority 100; policy accept;']
+        if self.public and self.internet_iface:
+            iface = f'"{self.internet_iface}"'
+            forward += [f"iifname {bridge} oifname {iface} accept",
+                        f"iifname {iface} oifname {bridge} ct state established,related accept"]
+            postrouting.append(f"oifname {iface} ip saddr @public masquerade")
+
+        body = named_set('set', 'peers', 'ifname', [f'"{p}"' for p in sorted(self.peers)])
+        body += named_set('set', 'public', 'ipv4_addr', sorted(self.public), interval=True)
+        for chain, lines in (('forward', forward), ('postrouting', postrouting)):
+            body.append(f"chain {chain} {{")
+            body.extend(f"\t{line}" for line in lines)
+            body.append('}')
+        return replace_table(self.table, body)
+
+    def load(self):
+        return load(self.document())
+
+    def ensure(self):
+        """Create (or re-sync) the VPC table"""
+        log('INFO', f"Loading nftables table {TABLE_FAMILY} {self.table}")
+        self.load()
+
+    def allow_intra_bridge(self):
+        """Intra-bridge forwarding is part of every table document"""
+
+    def enable_nat(self, subnet_cidr, internet_iface):
+        self.public.add(subnet_cidr)
+        self.internet_iface = internet_iface
+        self.load()
+
+    def allow_peer(self, peer_bridge):
+        self.peers.add(peer_bridge)
+        self.load()
+
+    def remove_peer(self, peer_bridge):
+        self.peers.discard(peer_bridge)
+        self.load()
+
+    def destroy(self):
+        log('INFO', f"Removing nftables table {TABLE_FAMILY} {self.table}")
+        run_cmd(['nft', '-f', '-'], input='\n'.join(replace_table(self.table)) + '\n', check=False)
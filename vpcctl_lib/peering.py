@@ -1,17 +1,8 @@
-import subprocess
 import ipaddress
 from vpcctl_lib.state import StateManager, log
-
-def run_cmd(cmd, check=True):
-    try:
-        log('INFO', f"Running: {' '.join(cmd)}")
-        result = subprocess.run(cmd, check=check, capture_output=True, text=True)
-        return result.returncode == 0
-    except subprocess.CalledProcessError as e:
-        log('ERROR', f"Command failed: {e.stderr}")
-        if check:
-            raise
-        return False
+from vpcctl_lib.backend import run_cmd
+from vpcctl_lib.nft import vpc_firewall
+from vpcctl_lib.tuning import Tuning
 
 class PeeringManager:
     
@@ -50,8 +41,11 @@ class PeeringManager:
             veth1 = f"peer-{vpc1_name}-{vpc2_name}"
             veth2 = f"peer-{vpc2_name}-{vpc1_name}"
             
+            tuning1, tuning2 = Tuning.of(state1), Tuning.of(state2)
             log('INFO', f"Creating veth pair: {veth1} <-> {veth2}")
-            run_cmd(['ip', 'link', 'add', veth1, 'type', 'veth', 'peer', 'name', veth2])
+            run_cmd(['ip'] + Tuning.peering(tuning1, tuning2).veth_add(veth1, veth2).split())
+            tuning1.tune_offloads(veth1)
+            tuning2.tune_offloads(veth2)
             
             # Attach each end to respective bridges
             log('INFO', f"Attaching {veth1} to {state1['bridge']}")
@@ -64,10 +58,14 @@ class PeeringManager:
 
             # Allow forwarding between the two VPC bridges
             log('INFO', f"Enabling forwarding between {state1['bridge']} and {state2['bridge']}")
-            run_cmd(['iptables', '-A', 'FORWARD', '-i', state1['bridge'], 
-                    '-o', state2['bridge'], '-j', 'ACCEPT'], check=False)
-            run_cmd(['iptables', '-A', 'FORWARD', '-i', state2['bridge'], 
-                    '-o', state1['bridge'], '-j', 'ACCEPT'], check=False)
+            firewall1 = vpc_firewall(vpc1_name, state1)
+            firewall2 = vpc_firewall(vpc2_name, state2)
+            firewall1.ensure()
+            firewall2.ensure()
+            firewall1.allow_peer(state2['bridge'])
+            firewall2.allow_peer(state1['bridge'])
+            state1[firewall1.state_key] = firewall1.as_state()
+            state2[firewall2.state_key] = firewall2.as_state()
             
             # Add routes from VPC1 subnets to VPC2 CIDR (via their own local gateway)
             for subnet_name, subnet_data in state1['subnets'].items():
@@ -94,8 +92,10 @@ class PeeringManager:
             state1['peerings'][vpc2_name] = {'veth': veth1, 'peer_veth': veth2}
             state2['peerings'][vpc1_name] = {'veth': veth2, 'peer_veth': veth1}
             
-            manager.save(vpc1_name, state1)
-            manager.save(vpc2_name, state2)
+            # Both sides of the peering are recorded atomically
+            with manager.transaction():
+                manager.save(vpc1_name, state1)
+                manager.save(vpc2_name, state2)
             
             log('SUCCESS', f"Peering established between {vpc1_name} and {vpc2_name}")
             return True
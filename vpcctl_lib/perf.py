@@ -0,0 +1,168 @@
+import json
+import os
+import select
+import subprocess
+import sys
+import time
+from vpcctl_lib.state import StateManager, log, Colors
+from vpcctl_lib.backend import capture, get_backend
+from vpcctl_lib.perf_agent import MODES, UDP_IDLE
+
+AGENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf_agent.py')
+# How long a server may take to start listening
+READY_TIMEOUT = 5.0
+
+def _last_json(text):
+    for line in reversed((text or '').strip().splitlines()):
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+    return None
+
+class PerfTester:
+    """Data-plane throughput and latency between two subnets.
+
+    Each mode starts perf_agent.py as a server in the destination namespace
+    and as a client in the source namespace, so traffic crosses the same
+    bridge, peering veth or NAT path workloads use. Both processes are
+    reaped before the next mode starts, also on errors and timeouts.
+    """
+
+    @staticmethod
+    def resolve(endpoint):
+        """vpc/subnet -> (label, subnet state), logging what is wrong with it"""
+        vpc_name, _, subnet_name = endpoint.partition('/')
+        if not vpc_name or not subnet_name:
+            log('ERROR', f"Endpoint {endpoint} must be <vpc>/<subnet>")
+            return None
+        state = StateManager().load(vpc_name)
+        if not state:
+            log('ERROR', f"VPC {vpc_name} not found")
+            return None
+        subnet = state['subnets'].get(subnet_name)
+        if subnet is None:
+            log('ERROR', f"Subnet {subnet_name} not found in VPC {vpc_name}")
+            return None
+        return endpoint, subnet
+
+    @staticmethod
+    def _agent(namespace, role, mode, options):
+        return ['ip', 'netns', 'exec', namespace, sys.executable, AGENT, role, '--mode', mode,
+                '--port', str(options['port']), '--streams', str(options['streams']),
+                '--duration', str(options['duration']), '--size', str(options['size'])]
+
+    @staticmethod
+    def _wait_ready(server):
+        """Block until the server prints its ready line; False if it died or took too long"""
+        deadline = time.monotonic() + READY_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([server.stdout], [], [], remaining)[0]:
+                return False
+            line = server.stdout.readline()
+            if not line:
+                return False
+            if _last_json(line) == {'ready': True}:
+                return True
+
+    @staticmethod
+    def _stop(server):
+        if server.poll() is None:
+            server.terminate()
+            try:
+                server.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+        for stream in (server.stdout, server.stderr):
+            stream.close()
+
+    @staticmethod
+    def run_mode(mode, src, dst, options):
+        """One measurement; returns a result dict (status 'ok' or an error)"""
+        result = {'mode': mode, 'source': src[0], 'target': dst[0], 'streams': options['streams'],
+                  'status': 'ok'}
+        server_cmd = PerfTester._agent(dst[1]['namespace'], 'server', mode, options)
+        client_cmd = PerfTester._agent(src[1]['namespace'], 'client', mode, options)
+        client_cmd[client_cmd.index('--port'):client_cmd.index('--port')] = ['--host', dst[1]['namespace_ip']]
+
+        log('INFO', f"perf {mode}: {src[0]} -> {dst[0]} ({dst[1]['namespace_ip']}:{options['port']}), "
+                    f"{options['streams']} stream(s), {options['duration']}s")
+        server = get_backend().spawn(server_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if server is None:
+            # Recording backend: the plan shows the commands, there is nothing to measure
+            capture(client_cmd)
+            return dict(result, status='recorded')
+        try:
+            if not PerfTester._wait_ready(server):
+                return dict(result, status='server did not start')
+            try:
+                client = capture(client_cmd, timeout=options['duration'] + 15)
+            except subprocess.TimeoutExpired:
+                return dict(result, status='timeout')
+            try:
+                server_out, _ = server.communicate(timeout=UDP_IDLE + 5)
+            except subprocess.TimeoutExpired:
+                server_out = None
+        finally:
+            PerfTester._stop(server)
+
+        sent, received = _last_json(client.stdout), _last_json(server_out)
+        if client.returncode != 0 or not sent or 'error' in sent:
+            error = (sent or {}).get('error') or client.stderr.strip() or 'client failed'
+            return dict(result, status=error)
+        return dict(result, **PerfTester._summarise(mode, sent, received or {}))
+
+    @staticmethod
+    def _summarise(mode, sent, received):
+        if mode == 'stream':
+            seconds = received.get('seconds') or sent['seconds']
+            rx_bytes = received.get('bytes', 0)
+            return {'sent_gbps': round(sent['bytes'] * 8 / sent['seconds'] / 1e9, 3),
+                    'gbps': round(rx_bytes * 8 / seconds / 1e9, 3) if seconds else 0.0,
+                    'zero_copy': sent.get('zero_copy', False)}
+        if mode == 'udp':
+            seconds = received.get('seconds') or sent['seconds']
+            rx_packets = received.get('packets', 0)
+            loss = 100.0 * (sent['packets'] - rx_packets) / sent['packets'] if sent['packets'] else 100.0
+            return {'sent_pps': round(sent['packets'] / sent['seconds']),
+                    'pps': round(rx_packets / seconds) if seconds else 0,
+                    'loss_pct': round(max(loss, 0.0), 2)}
+        summary = {'transactions_per_s': round(sent['transactions'] / sent['seconds'])}
+        summary.update((key, sent.get(key)) for key in ('p50_us', 'p90_us', 'p99_us', 'max_us'))
+        return summary
+
+    @staticmethod
+    def run(source, target, modes=MODES, streams=1, duration=5.0, port=5201, size=64):
+        src, dst = PerfTester.resolve(source), PerfTester.resolve(target)
+        if src is None or dst is None:
+            return None
+        if 'namespace_ip' not in dst[1]:
+            log('ERROR', f"{target} has no namespace address to serve on")
+            return None
+        options = {'streams': max(1, streams), 'duration': duration, 'port': port, 'size': max(1, size)}
+        return [PerfTester.run_mode(mode, src, dst, options) for mode in modes]
+
+    @staticmethod
+    def render(results, output_format='table'):
+        if output_format == 'json':
+            print(json.dumps({'results': results}, indent=2))
+            return
+        print(f"\n{'='*72}")
+        print(f"{'MODE':<8} {'STREAMS':>7}  RESULT")
+        print(f"{'='*72}")
+        for r in results:
+            if r['status'] != 'ok':
+                color = Colors.YELLOW if r['status'] == 'recorded' else Colors.RED
+                print(f"{r['mode']:<8} {r['streams']:>7}  {color}{r['status']}{Colors.RESET}")
+            elif r['mode'] == 'stream':
+                copy = ', zero-copy' if r['zero_copy'] else ''
+                print(f"{r['mode']:<8} {r['streams']:>7}  {r['gbps']:.2f} Gbps received "
+                      f"({r['sent_gbps']:.2f} Gbps sent{copy})")
+            elif r['mode'] == 'udp':
+                print(f"{r['mode']:<8} {r['streams']:>7}  {r['pps']:,} pps received "
+                      f"({r['sent_pps']:,} pps sent, {r['loss_pct']}% loss)")
+            else:
+                print(f"{r['mode']:<8} {r['streams']:>7}  {r['transactions_per_s']:,} trans/s, "
+                      f"p50 {r['p50_us']} us, p90 {r['p90_us']} us, p99 {r['p99_us']} us, max {r['max_us']} us")
@@ -0,0 +1,261 @@
+# Traffic generator for `vpcctl perf`, started inside subnet namespaces with
+# `ip netns exec <ns> python3 perf_agent.py server|client ...`. It runs as a
+# script, so it imports nothing from vpcctl_lib. The server prints a ready
+# line once listening; both sides print one JSON result line when done.
+import argparse
+import json
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+MODES = ('stream', 'udp', 'rr')
+# Payload per send on TCP streams; socket buffers are sized to match
+STREAM_BUFFER = 4 * 1024 * 1024
+# A UDP server gives up once it has heard nothing for this long
+UDP_IDLE = 1.0
+
+def _emit(message):
+    sys.stdout.write(json.dumps(message) + '\n')
+    sys.stdout.flush()
+
+def _tune(sock, size=STREAM_BUFFER):
+    # The kernel caps these at net.core.{r,w}mem_max
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError:
+            pass
+
+def _run_threads(target, count):
+    results = [None] * count
+    def run(index):
+        results[index] = target(index)
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def _listen(port, kind=socket.SOCK_STREAM, reuseport=False):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    _tune(sock)
+    sock.bind(('0.0.0.0', port))
+    if kind == socket.SOCK_STREAM:
+        sock.listen(64)
+    return sock
+
+def _accept(listener, count, deadline):
+    connections = []
+    while len(connections) < count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([listener], [], [], remaining)[0]:
+            break
+        conn, _ = listener.accept()
+        _tune(conn)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connections.append(conn)
+    return connections
+
+def _recv_exact(conn, view):
+    got = 0
+    while got < len(view):
+        n = conn.recv_into(view[got:])
+        if not n:
+            return False
+        got += n
+    return True
+
+# Servers
+
+def stream_server(args, listener, deadline):
+    connections = _accept(listener, args.streams, deadline)
+
+    def drain(index):
+        conn, buffer = connections[index], bytearray(STREAM_BUFFER)
+        total, first, last = 0, None, None
+        with conn:
+            while True:
+                n = conn.recv_into(buffer)
+                if not n:
+                    break
+                last = time.perf_counter()
+                first = first or last
+                total += n
+        return total, first, last
+
+    results = [r for r in _run_threads(drain, len(connections)) if r[1] is not None]
+    if not results:
+        return {'streams': len(connections), 'bytes': 0, 'seconds': 0.0}
+    seconds = max(r[2] for r in results) - min(r[1] for r in results)
+    return {'streams': len(connections), 'bytes': sum(r[0] for r in results), 'seconds': seconds}
+
+def rr_server(args, listener, deadline):
+    connections = _accept(listener, args.streams, deadline)
+
+    def echo(index):
+        conn, buffer = connections[index], bytearray(args.size)
+        view, count = memoryview(buffer), 0
+        with conn:
+            while _recv_exact(conn, view):
+                conn.sendall(view)
+                count += 1
+        return count
+
+    return {'streams': len(connections), 'transactions': sum(_run_threads(echo, len(connections)))}
+
+def udp_server(args, sockets, deadline):
+    def count(index):
+        sock, buffer = sockets[index], bytearray(65535)
+        packets, first, last = 0, None, None
+        while True:
+            # Wait for the first packet until the deadline, then only while traffic keeps coming
+            wait = UDP_IDLE if first else deadline - time.monotonic()
+            if wait <= 0 or not select.select([sock], [], [], wait)[0]:
+                break
+            try:
+                while True:
+                    sock.recv_into(buffer, 0, socket.MSG_DONTWAIT)
+                    packets += 1
+            except BlockingIOError:
+                pass
+            last = time.perf_counter()
+            first = first or last
+        return packets, first, last
+
+    results = [r for r in _run_threads(count, len(sockets)) if r[1] is not None]
+    seconds = max(r[2] for r in results) - min(r[1] for r in results) if results else 0.0
+    return {'packets': sum(r[0] for r in results), 'seconds': seconds}
+
+def serve(args):
+    # Clients connect within a few seconds of the ready line; the rest of the
+    # deadline covers the run itself
+    deadline = time.monotonic() + args.duration + 10
+    if args.mode == 'udp':
+        sockets = [_listen(args.port, socket.SOCK_DGRAM, reuseport=True) for _ in range(args.streams)]
+        _emit({'ready': True})
+        result = udp_server(args, sockets, deadline)
+    else:
+        listener = _listen(args.port)
+        _emit({'ready': True})
+        with listener:
+            accept_deadline = time.monotonic() + 10
+            handler = stream_server if args.mode == 'stream' else rr_server
+            result = handler(args, listener, min(deadline, accept_deadline))
+    _emit(result)
+
+# Clients
+
+def _connect(args):
+    sock = socket.create_connection((args.host, args.port), timeout=10)
+    sock.settimeout(None)
+    _tune(sock)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def _payload_fd():
+    """A page-cache file of zeros that os.sendfile can send without copying it through userspace"""
+    try:
+        fd = os.memfd_create('vpcctl-perf')
+    except (AttributeError, OSError):
+        return None
+    os.ftruncate(fd, STREAM_BUFFER)
+    return fd
+
+def stream_client(args):
+    fd = _payload_fd()
+    buffer = memoryview(bytearray(STREAM_BUFFER))
+    end = time.perf_counter() + args.duration
+
+    def send(index):
+        total = 0
+        with _connect(args) as sock:
+            while time.perf_counter() < end:
+                if fd is not None:
+                    total += os.sendfile(sock.fileno(), fd, 0, STREAM_BUFFER)
+                else:
+                    sock.sendall(buffer)
+                    total += STREAM_BUFFER
+        return total
+
+    started = time.perf_counter()
+    sent = sum(_run_threads(send, args.streams))
+    return {'bytes': sent, 'seconds': time.perf_counter() - started, 'zero_copy': fd is not None}
+
+def udp_client(args):
+    payload = bytes(args.size)
+    end = time.perf_counter() + args.duration
+
+    def send(index):
+        sent = 0
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            _tune(sock)
+            sock.connect((args.host, args.port))
+            while time.perf_counter() < end:
+                for _ in range(256):
+                    try:
+                        sock.send(payload)
+                        sent += 1
+                    except (BlockingIOError, ConnectionRefusedError, OSError):
+                        pass
+        return sent
+
+    started = time.perf_counter()
+    sent = sum(_run_threads(send, args.streams))
+    return {'packets': sent, 'seconds': time.perf_counter() - started}
+
+def rr_client(args):
+    end = time.perf_counter() + args.duration
+
+    def transact(index):
+        latencies = []
+        request = bytes(args.size)
+        view = memoryview(bytearray(args.size))
+        with _connect(args) as sock:
+            while time.perf_counter() < end:
+                started = time.perf_counter_ns()
+                sock.sendall(request)
+                if not _recv_exact(sock, view):
+                    break
+                latencies.append(time.perf_counter_ns() - started)
+        return latencies
+
+    started = time.perf_counter()
+    latencies = sorted(ns for thread in _run_threads(transact, args.streams) for ns in thread)
+    seconds = time.perf_counter() - started
+    result = {'transactions': len(latencies), 'seconds': seconds}
+    if latencies:
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] / 1000, 1)
+        result.update(p50_us=pct(50), p90_us=pct(90), p99_us=pct(99), max_us=round(latencies[-1] / 1000, 1))
+    return result
+
+CLIENTS = {'stream': stream_client, 'udp': udp_client, 'rr': rr_client}
+
+def main():
+    parser = argparse.ArgumentParser(prog='perf_agent')
+    parser.add_argument('role', choices=['server', 'client'])
+    parser.add_argument('--mode', choices=MODES, required=True)
+    parser.add_argument('--host', help='Server address (client only)')
+    parser.add_argument('--port', type=int, default=5201)
+    parser.add_argument('--streams', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--size', type=int, default=64, help='UDP datagram and RR message bytes')
+    args = parser.parse_args()
+    try:
+        if args.role == 'server':
+            serve(args)
+        else:
+            _emit(CLIENTS[args.mode](args))
+    except OSError as e:
+        _emit({'error': str(e)})
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
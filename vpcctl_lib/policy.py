@@ -1,121 +1,463 @@
+import difflib
+import hashlib
+import ipaddress
 import json
-import subprocess
-from vpcctl_lib.state import StateManager, log
-
-def run_cmd(cmd, check=True):
-    try:
-        log('INFO', f"Running: {' '.join(cmd)}")
-        result = subprocess.run(cmd, check=check, capture_output=True, text=True)
-        return result.returncode == 0
-    except subprocess.CalledProcessError as e:
-        log('ERROR', f"Command failed: {e.stderr}")
-        if check:
-            raise
-        return False
+from vpcctl_lib.state import StateManager, log, worker_pool
+from vpcctl_lib.backend import run_cmd, capture
+from vpcctl_lib.nft import TABLE_FAMILY, firewall_of, replace_table, named_set
 
-class PolicyManager:
+# Protocols a rule may give ports for
+PORT_PROTOCOLS = ('tcp', 'udp', 'sctp')
+# iptables multiport accepts at most 15 ports
+MULTIPORT_LIMIT = 15
+
+def _as_list(value):
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+def _port_range(port):
+    """80, "80" or "8000-8100" (also "8000:8100") as a (low, high) tuple"""
+    text = str(port).replace(':', '-')
+    low, _, high = text.partition('-')
+    low, high = int(low), int(high or low)
+    if not 0 < low <= high <= 65535:
+        raise ValueError(f"Invalid port {port}")
+    return low, high
+
+def _overlaps(a, b):
+    return a[0] == b[0] and a[1].overlaps(b[1]) and a[2] <= b[3] and b[2] <= a[3]
+
+def _element(kind, key, verdict):
+    protocol, network, lo, hi = key
+    port = str(lo) if lo == hi else f"{lo}-{hi}"
+    fields = {'port': [protocol, str(network), port], 'proto': [protocol, str(network)],
+              'addr': [str(network)]}[kind]
+    return f"{' . '.join(fields)} : {verdict}"
+
+def _parse_restore(ruleset):
+    """Chain policy lines (without counters) and the rule specs of each chain"""
+    policies, chains = [], {}
+    for line in ruleset.splitlines():
+        if line.startswith(':'):
+            policies.append(line.split(' [')[0])
+        elif line.startswith('-A '):
+            chain, _, spec = line[3:].partition(' ')
+            chains.setdefault(chain, []).append(spec)
+    return policies, chains
+
+def _parse_nft(ruleset):
+    """Table lines without map elements, and the elements of each map"""
+    skeleton, maps, current = [], {}, None
+    for line in ruleset.splitlines():
+        text = line.strip()
+        if text.startswith('map '):
+            current = text.split()[1]
+            maps[current] = []
+        elif text.startswith('elements = {') and current:
+            maps[current] = [e.strip() for e in text[len('elements = {'):-1].split(',')]
+            continue
+        skeleton.append(line)
+    return skeleton, maps
+
+class PolicyCompiler:
+    """Turns a policy document into a single iptables-restore payload"""
+    
+    EMPTY_RULESET = ('*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n'
+                     ':OUTPUT ACCEPT [0:0]\nCOMMIT\n')
     
     @staticmethod
-    def apply_policy(vpc_name, subnet_name, policy_file):
+    def compile(policy):
+        """Compile a policy to an iptables-restore document for the filter table.
+        
+        Loaded as-is the document replaces the whole table atomically; with
+        --noflush it only sets the chain policies and appends the rules.
+        """
+        lines = ['*filter',
+                 ':INPUT DROP [0:0]',
+                 ':FORWARD DROP [0:0]',
+                 ':OUTPUT ACCEPT [0:0]']
+        lines.extend(PolicyCompiler.rules(policy))
+        lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+    
+    @staticmethod
+    def digest(ruleset):
+        """Content hash of a compiled ruleset, recorded per subnet once loaded"""
+        return hashlib.sha256(ruleset.encode()).hexdigest()
+
+    @staticmethod
+    def diff(old, new):
+        """iptables-restore --noflush document turning ruleset old into new; None if it cannot.
+
+        Rules only in old are deleted by spec, then rules only in new are
+        inserted at their final position, so unchanged rules keep their
+        place and counters. The document commits as one transaction.
+        """
+        old_policies, old_chains = _parse_restore(old)
+        new_policies, new_chains = _parse_restore(new)
+        if old_policies != new_policies:
+            return None
+        lines = ['*filter']
+        for chain in sorted(set(old_chains) | set(new_chains)):
+            before, after = old_chains.get(chain, []), new_chains.get(chain, [])
+            inserts = []
+            for op, i1, i2, j1, j2 in difflib.SequenceMatcher(None, before, after, autojunk=False).get_opcodes():
+                if op in ('delete', 'replace'):
+                    lines.extend(f"-D {chain} {spec}" for spec in before[i1:i2])
+                if op in ('insert', 'replace'):
+                    inserts.extend(range(j1, j2))
+            lines.extend(f"-I {chain} {j + 1} {after[j]}" for j in inserts)
+        lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def rules(policy):
+        """Return the ordered rule lines (-A ...) for a policy"""
+        rules = ['-A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT',
+                 '-A INPUT -i lo -j ACCEPT']
+        for rule in policy.get('ingress', []):
+            rules.extend(PolicyCompiler._ingress_rule(rule))
+        for rule in policy.get('egress', []):
+            rules.extend(PolicyCompiler._egress_rule(rule))
+        return rules
+
+    @staticmethod
+    def expand(rule, direction):
+        """Normalise one ingress or egress rule.
+
+        protocol(s), source(s) or destination(s) and port(s) each take a
+        single value or a list; ports may be ranges ("8000-8100"). Returns
+        (protocols, addresses, ports, action) with ports as (low, high)
+        tuples, an empty list meaning any port.
+        """
+        addr_key = 'source' if direction == 'ingress' else 'destination'
+        protocols = _as_list(rule.get('protocols', rule.get('protocol', 'tcp')))
+        addresses = _as_list(rule.get(f"{addr_key}s", rule.get(addr_key, '0.0.0.0/0')))
+        ports = [_port_range(port) for port in _as_list(rule.get('ports', rule.get('port'))) if port]
+        if ports and any(p not in PORT_PROTOCOLS for p in protocols):
+            raise ValueError(f"ports need protocol {', '.join(PORT_PROTOCOLS)}: {rule}")
+        for address in addresses:
+            ipaddress.ip_network(address)
+        return protocols, addresses, ports, rule.get('action', 'deny')
+
+    @staticmethod
+    def describe(policy):
+        """One readable line per ingress and egress rule, e.g. "Ingress: allow tcp/80 from 0.0.0.0/0"."""
+        lines = []
+        for direction in ('ingress', 'egress'):
+            for rule in policy.get(direction, []):
+                protocols, addresses, ports, action = PolicyCompiler.expand(rule, direction)
+                ports_text = ','.join(str(lo) if lo == hi else f"{lo}-{hi}" for lo, hi in ports) or 'any'
+                preposition = 'from' if direction == 'ingress' else 'to'
+                lines.append(f"{direction.capitalize()}: {action} {','.join(protocols)}/{ports_text} "
+                             f"{preposition} {','.join(addresses)}")
+        return lines
+
+    @staticmethod
+    def _ingress_rule(rule):
+        """Compile a single ingress rule"""
+        return PolicyCompiler._rule_lines('INPUT', '-s', *PolicyCompiler.expand(rule, 'ingress'))
+
+    @staticmethod
+    def _egress_rule(rule):
+        """Compile a single egress rule"""
+        return PolicyCompiler._rule_lines('OUTPUT', '-d', *PolicyCompiler.expand(rule, 'egress'))
+
+    @staticmethod
+    def _rule_lines(chain, addr_flag, protocols, addresses, ports, action):
+        """One line per protocol and address; several ports share a multiport match"""
+        iptables_action = 'ACCEPT' if action == 'allow' else 'DROP'
+        lines = []
+        for protocol in protocols:
+            for addr in addresses:
+                for match in PolicyCompiler._port_matches(ports):
+                    lines.append(f"-A {chain} -p {protocol} {addr_flag} {addr}{match} -j {iptables_action}")
+        return lines
+
+    @staticmethod
+    def _port_matches(ports):
+        if not ports:
+            return ['']
+        if len(ports) == 1:
+            lo, hi = ports[0]
+            return [f" --dport {lo}" if lo == hi else f" --dport {lo}:{hi}"]
+        # multiport takes at most MULTIPORT_LIMIT ports, a range counting as two
+        matches, group, weight = [], [], 0
+        for lo, hi in ports:
+            cost = 1 if lo == hi else 2
+            if weight + cost > MULTIPORT_LIMIT:
+                matches.append(group)
+                group, weight = [], 0
+            group.append(str(lo) if lo == hi else f"{lo}:{hi}")
+            weight += cost
+        matches.append(group)
+        return [f" -m multiport --dports {','.join(group)}" for group in matches]
+
+class NftPolicyCompiler:
+    """Turns a policy document into one nftables table for the subnet namespace.
+
+    Rules become elements of interval verdict maps keyed on (protocol,
+    address, port), so a packet costs one map lookup rather than a walk
+    over every rule. Rules are first-match, so a rule that overlaps one
+    already in the current map starts the next map; maps are consulted
+    in order. Every rule carries a counter for `vpcctl stats`; the last
+    one in input and forward counts what the chain policy drops.
+    """
+
+    TABLE = 'vpcctl-policy'
+    # Map key per kind of rule: with ports, protocol only, or any protocol
+    KEYS = {
+        'port': ('inet_proto . ipv4_addr . inet_service', 'meta l4proto . ip {addr} . th dport'),
+        'proto': ('inet_proto . ipv4_addr', 'meta l4proto . ip {addr}'),
+        'addr': ('ipv4_addr', 'ip {addr}'),
+    }
+
+    @staticmethod
+    def compile(policy):
+        """Compile a policy to an `nft -f` document that replaces the policy table"""
+        body = []
+        chains = {'input': ['type filter hook input priority 0; policy drop;',
+                            'ct state established,related counter accept',
+                            'iif "lo" counter accept'],
+                  'forward': ['type filter hook forward priority 0; policy drop;'],
+                  'output': ['type filter hook output priority 0; policy accept;']}
+        for direction, chain, addr in (('ingress', 'input', 'saddr'), ('egress', 'output', 'daddr')):
+            rules = [PolicyCompiler.expand(rule, direction) for rule in policy.get(direction, [])]
+            for index, (kind, elements) in enumerate(NftPolicyCompiler.verdict_maps(rules)):
+                key_type, key_expr = NftPolicyCompiler.KEYS[kind]
+                name = f"{direction}_{index}"
+                body += named_set('map', name, f"{key_type} : verdict", elements, interval=True)
+                chains[chain].append(f"{key_expr.format(addr=addr)} counter vmap @{name}")
+        for chain in ('input', 'forward'):
+            chains[chain].append('counter comment "policy drop"')
+        for chain, lines in chains.items():
+            body.append(f"chain {chain} {{")
+            body.extend(f"\t{line}" for line in lines)
+            body.append('}')
+        return '\n'.join(replace_table(NftPolicyCompiler.TABLE, body)) + '\n'
+
+    EMPTY_RULESET = '\n'.join(replace_table(TABLE)) + '\n'
+
+    @staticmethod
+    def diff(old, new):
+        """`nft -f` document turning ruleset old into new by map elements; None if it cannot.
+
+        Only possible when both have the same chains and maps, which holds
+        while rules change addresses, ports or verdicts within their maps.
+        """
+        old_skeleton, old_maps = _parse_nft(old)
+        new_skeleton, new_maps = _parse_nft(new)
+        if old_skeleton != new_skeleton:
+            return None
+        table = f"{TABLE_FAMILY} {NftPolicyCompiler.TABLE}"
+        lines = []
+        for name, after in new_maps.items():
+            before = old_maps.get(name, [])
+            removed = [e.partition(' : ')[0] for e in before if e not in after]
+            added = [e for e in after if e not in before]
+            if removed:
+                lines.append(f"delete element {table} {name} {{ {', '.join(removed)} }}")
+            if added:
+                lines.append(f"add element {table} {name} {{ {', '.join(added)} }}")
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def verdict_maps(rules):
+        """Group expanded rules into ordered (kind, elements) maps without overlapping keys"""
+        maps = []
+        for protocols, addresses, ports, action in rules:
+            verdict = 'accept' if action == 'allow' else 'drop'
+            for protocol in protocols:
+                kind = 'port' if ports else ('addr' if protocol == 'all' else 'proto')
+                for address in addresses:
+                    for lo, hi in ports or [(0, 65535)]:
+                        key = (protocol, ipaddress.ip_network(address), lo, hi)
+                        if maps and maps[-1][0] == kind:
+                            keys = maps[-1][1]
+                            if any(key == other for other, _ in keys):
+                                continue  # an identical earlier rule already decides
+                            if not any(_overlaps(key, other) for other, _ in keys):
+                                keys.append((key, verdict))
+                                continue
+                        maps.append((kind, [(key, verdict)]))
+        return [(kind, [_element(kind, key, verdict) for key, verdict in keys]) for kind, keys in maps]
+
+# Per firewall engine: compiler, loader run inside the namespace, and listing
+COMPILERS = {'iptables': PolicyCompiler, 'nft': NftPolicyCompiler}
+LOADERS = {'iptables': ['iptables-restore'], 'nft': ['nft', '-f', '-']}
+LISTERS = {'iptables': ['iptables', '-L', '-v', '-n'],
+           'nft': ['nft', 'list', 'table', 'ip', NftPolicyCompiler.TABLE]}
+
+class PolicyManager:
+
+    @staticmethod
+    def apply_policy(vpc_name, subnet_name, policy_file, dry_run=False, noflush=False):
         """Apply security policy from JSON file to a subnet"""
+        return PolicyManager.rollout(policy_file, [vpc_name], subnet_name=subnet_name,
+                                     dry_run=dry_run, noflush=noflush)
+
+    @staticmethod
+    def _targets(manager, vpc_names, subnet_name, subnet_type):
+        """{vpc: state} and the (vpc, subnet) pairs a rollout covers; None if a named one is missing"""
+        states = {}
+        for vpc_name in vpc_names:
+            state = manager.load(vpc_name)
+            if not state:
+                log('ERROR', f"VPC {vpc_name} not found")
+                return None, None
+            states[vpc_name] = state
+        if subnet_name:
+            missing = [v for v, state in states.items() if subnet_name not in state['subnets']]
+            if missing:
+                log('ERROR', f"Subnet {subnet_name} not found in VPC {missing[0]}")
+                return None, None
+        targets = [(vpc_name, name) for vpc_name, state in sorted(states.items())
+                   for name, subnet in sorted(state['subnets'].items())
+                   if (subnet_name is None or name == subnet_name)
+                   and (subnet_type is None or subnet.get('type', 'private') == subnet_type)]
+        return states, targets
+
+    @staticmethod
+    def _plan(subnet, engine, ruleset, digest, noflush):
+        """(mode, document) to bring a namespace to ruleset.
+
+        'current' when its recorded hash already matches, 'diff' when the
+        ruleset loaded last is known and the change can be expressed as
+        rule or element edits, 'replace' otherwise; 'append' for --noflush.
+        """
+        if noflush:
+            return 'append', ruleset
+        if subnet.get('policy_hash') == digest:
+            return 'current', None
+        loaded = subnet.get('policy_ruleset')
+        if loaded and PolicyCompiler.digest(loaded) == subnet.get('policy_hash'):
+            document = COMPILERS[engine].diff(loaded, ruleset)
+            if document is not None:
+                return 'diff', document
+        return 'replace', ruleset
+
+    @staticmethod
+    def _load(ns_name, engine, mode, document, ruleset):
+        """Load one namespace; a diff that does not apply falls back to replacing the table"""
+        restore = ['ip', 'netns', 'exec', ns_name] + LOADERS[engine]
+        if mode in ('diff', 'append') and engine == 'iptables':
+            restore.append('--noflush')
+        log('INFO', f"Loading {'rule diff' if mode == 'diff' else 'compiled ruleset'} into {ns_name}")
+        if mode == 'diff':
+            if run_cmd(restore, input=document, check=False):
+                return mode
+            log('WARNING', f"Rules in {ns_name} differ from the recorded ruleset, replacing it")
+            return PolicyManager._load(ns_name, engine, 'replace', ruleset, ruleset)
+        run_cmd(restore, input=document)
+        return mode
+
+    @staticmethod
+    def rollout(policy_file, vpc_names=None, subnet_name=None, subnet_type=None,
+                dry_run=False, noflush=False, workers=8):
+        """Apply one policy to every selected subnet: all subnets of the given VPCs (every VPC by
+        default), narrowed to one subnet name or one subnet type.
+
+        The ruleset is compiled once per engine. Namespaces whose recorded
+        hash matches are skipped, the others get a rule diff where possible,
+        and loads run in parallel across namespaces.
+        """
         manager = StateManager()
-        state = manager.load(vpc_name)
-        
-        if not state:
-            log('ERROR', f"VPC {vpc_name} not found")
-            return False
-        
-        if subnet_name not in state['subnets']:
-            log('ERROR', f"Subnet {subnet_name} not found in VPC {vpc_name}")
+        states, targets = PolicyManager._targets(manager, vpc_names or manager.list_all(),
+                                                 subnet_name, subnet_type)
+        if states is None:
             return False
-        
+        if not targets:
+            log('WARNING', "No subnets match the selection")
+            return True
+
         try:
             with open(policy_file, 'r') as f:
                 policy = json.load(f)
         except Exception as e:
             log('ERROR', f"Failed to load policy file: {e}")
             return False
-        
-        subnet = state['subnets'][subnet_name]
-        ns_name = subnet['namespace']
-        
-        log('INFO', f"Applying security policy to {vpc_name}/{subnet_name}")
-        
-        try:
-            log('INFO', "Setting default policies to DROP")
-            run_cmd(['ip', 'netns', 'exec', ns_name, 'iptables', '-P', 'INPUT', 'DROP'], check=False)
-            run_cmd(['ip', 'netns', 'exec', ns_name, 'iptables', '-P', 'FORWARD', 'DROP'], check=False)
-            run_cmd(['ip', 'netns', 'exec', ns_name, 'iptables', '-P', 'OUTPUT', 'ACCEPT'], check=False)
-            
-            log('INFO', "Allowing established/related connections")
-            run_cmd(['ip', 'netns', 'exec', ns_name, 'iptables', '-A', 'INPUT',
-                    '-m', 'state', '--state', 'ESTABLISHED,RELATED', '-j', 'ACCEPT'], check=False)
-            
-            run_cmd(['ip', 'netns', 'exec', ns_name, 'iptables', '-A', 'INPUT',
-                    '-i', 'lo', '-j', 'ACCEPT'], check=False)
-            
-            if 'ingress' in policy:
-                for rule in policy['ingress']:
-                    PolicyManager._apply_ingress_rule(ns_name, rule)
-            
-            if 'egress' in policy:
-                for rule in policy['egress']:
-                    PolicyManager._apply_egress_rule(ns_name, rule)
-            
-            if 'policies' not in state['subnets'][subnet_name]:
-                state['subnets'][subnet_name]['policies'] = []
-            state['subnets'][subnet_name]['policies'].append(policy_file)
-            manager.save(vpc_name, state)
-            
-            log('SUCCESS', f"Policy applied to {vpc_name}/{subnet_name}")
+
+        engines = {firewall_of(states[vpc_name]) for vpc_name, _ in targets}
+        if noflush and engines != {'iptables'}:
+            log('ERROR', "--noflush is only supported by the iptables engine")
+            return False
+
+        rulesets = {}
+        for engine in sorted(engines):
+            log('INFO', f"Compiling security policy {policy_file} for {len(targets)} subnet(s) ({engine})")
+            try:
+                rulesets[engine] = COMPILERS[engine].compile(policy)
+            except ValueError as e:
+                log('ERROR', f"Invalid policy: {e}")
+                return False
+        if not dry_run:
+            for line in PolicyCompiler.describe(policy):
+                log('INFO', f"  {line}")
+
+        jobs = []
+        for vpc_name, name in targets:
+            engine = firewall_of(states[vpc_name])
+            subnet = states[vpc_name]['subnets'][name]
+            ruleset = rulesets[engine]
+            mode, document = PolicyManager._plan(subnet, engine, ruleset, PolicyCompiler.digest(ruleset),
+                                                 noflush)
+            if mode == 'current':
+                log('INFO', f"{vpc_name}/{name} is already up to date")
+            jobs.append((vpc_name, name, engine, mode, document))
+
+        if dry_run:
+            for vpc_name, name, engine, mode, document in jobs:
+                if len(jobs) > 1 or mode != 'replace':
+                    print(f"# {vpc_name}/{name}: {mode}")
+                print(document or '', end='')
             return True
-            
-        except Exception as e:
-            log('ERROR', f"Failed to apply policy: {e}")
+
+        def load(job):
+            vpc_name, name, engine, mode, document = job
+            if mode == 'current':
+                return mode
+            try:
+                return PolicyManager._load(states[vpc_name]['subnets'][name]['namespace'], engine, mode,
+                                           document, rulesets[engine])
+            except Exception as e:
+                log('ERROR', f"Failed to apply policy to {vpc_name}/{name}: {e}")
+                return None
+
+        pending = [job for job in jobs if job[3] != 'current']
+        with worker_pool(max(1, min(workers, len(pending)))) as pool:
+            results = list(pool.map(load, jobs))
+
+        changed = set()
+        for (vpc_name, name, engine, _, _), mode in zip(jobs, results):
+            if mode in (None, 'current'):
+                continue
+            subnet = states[vpc_name]['subnets'][name]
+            if mode == 'append':
+                # Appended on top of whatever was loaded; no longer a single known document
+                subnet.setdefault('policies', []).append(policy_file)
+                subnet.pop('policy_hash', None)
+                subnet.pop('policy_ruleset', None)
+            else:
+                subnet['policies'] = [policy_file]
+                subnet['policy_hash'] = PolicyCompiler.digest(rulesets[engine])
+                subnet['policy_ruleset'] = rulesets[engine]
+            changed.add(vpc_name)
+        for vpc_name in sorted(changed):
+            manager.save(vpc_name, states[vpc_name])
+
+        counts = {mode: results.count(mode) for mode in ('current', 'diff', 'replace', 'append')}
+        summary = ', '.join(f"{count} {mode}" for mode, count in counts.items() if count)
+        failed = results.count(None)
+        if failed:
+            log('ERROR', f"Policy failed on {failed} of {len(jobs)} subnet(s) ({summary or 'none applied'})")
             return False
-    
-    @staticmethod
-    def _apply_ingress_rule(ns_name, rule):
-        """Apply a single ingress rule"""
-        port = rule.get('port')
-        protocol = rule.get('protocol', 'tcp')
-        source = rule.get('source', '0.0.0.0/0')
-        action = rule.get('action', 'deny')
-        
-        iptables_action = 'ACCEPT' if action == 'allow' else 'DROP'
-        
-        log('INFO', f"  Ingress: {action} {protocol}/{port} from {source}")
-        
-        cmd = ['ip', 'netns', 'exec', ns_name, 'iptables', '-A', 'INPUT',
-               '-p', protocol, '-s', source]
-        
-        if port:
-            cmd.extend(['--dport', str(port)])
-        
-        cmd.extend(['-j', iptables_action])
-        run_cmd(cmd, check=False)
-    
-    @staticmethod
-    def _apply_egress_rule(ns_name, rule):
-        """Apply a single egress rule"""
-        port = rule.get('port')
-        protocol = rule.get('protocol', 'tcp')
-        destination = rule.get('destination', '0.0.0.0/0')
-        action = rule.get('action', 'deny')
-        
-        iptables_action = 'ACCEPT' if action == 'allow' else 'DROP'
-        
-        log('INFO', f"  Egress: {action} {protocol}/{port} to {destination}")
-        
-        cmd = ['ip', 'netns', 'exec', ns_name, 'iptables', '-A', 'OUTPUT',
-               '-p', protocol, '-d', destination]
-        
-        if port:
-            cmd.extend(['--dport', str(port)])
-        
-        cmd.extend(['-j', iptables_action])
-        run_cmd(cmd, check=False)
-    
+        if len(jobs) == 1:
+            log('SUCCESS', f"Policy applied to {jobs[0][0]}/{jobs[0][1]} ({summary})")
+        else:
+            log('SUCCESS', f"Policy rolled out to {len(jobs)} subnet(s) ({summary})")
+        return True
+
     @staticmethod
     def clear_policy(vpc_name, subnet_name):
         """Clear all firewall rules from a subnet"""
@@ -136,13 +478,14 @@ class PolicyManager:
         log('INFO', f"Clearing security policy from {vpc_name}/{subnet_name}")
         
         try:
-            run_cmd(['ip', 'netns', 'exec', ns_name, 'iptables', '-F'], check=False)
-            run_cmd(['ip', 'netns', 'exec', ns_name, 'iptables', '-P', 'INPUT', 'ACCEPT'], check=False)
-            run_cmd(['ip', 'netns', 'exec', ns_name, 'iptables', '-P', 'FORWARD', 'ACCEPT'], check=False)
-            run_cmd(['ip', 'netns', 'exec', ns_name, 'iptables', '-P', 'OUTPUT', 'ACCEPT'], check=False)
+            engine = firewall_of(state)
+            run_cmd(['ip', 'netns', 'exec', ns_name] + LOADERS[engine],
+                    input=COMPILERS[engine].EMPTY_RULESET, check=False)
             
             if 'policies' in state['subnets'][subnet_name]:
                 del state['subnets'][subnet_name]['policies']
+            state['subnets'][subnet_name].pop('policy_hash', None)
+            state['subnets'][subnet_name].pop('policy_ruleset', None)
             manager.save(vpc_name, state)
             
             log('SUCCESS', f"Policy cleared from {vpc_name}/{subnet_name}")
@@ -173,8 +516,5 @@ class PolicyManager:
         print(f"Firewall Rules: {vpc_name}/{subnet_name}")
         print(f"{'='*60}")
         
-        result = subprocess.run(
-            ['ip', 'netns', 'exec', ns_name, 'iptables', '-L', '-v', '-n'],
-            capture_output=True, text=True
-        )
+        result = capture(['ip', 'netns', 'exec', ns_name] + LISTERS[firewall_of(state)])
         print(result.stdout)
\ No newline at end of file
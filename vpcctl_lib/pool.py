@@ -0,0 +1,188 @@
+import json
+import os
+import re
+import secrets
+import time
+from vpcctl_lib.state import StateManager, log, Colors, worker_pool
+from vpcctl_lib.backend import run_cmd, run_batch, get_backend
+from vpcctl_lib.tuning import Tuning, PROFILES, DEFAULT_PROFILE
+
+POOL_PREFIX = 'vpool-'
+POOL_VETH_RE = re.compile(r'^vp[0-9a-f]{6}[bn]$')
+# Hard cap on pre-warmed entries; each holds a namespace and a veth pair
+MAX_SIZE = int(os.environ.get('VPCCTL_POOL_MAX', '64'))
+# Unclaimed entries older than this are garbage collected
+DEFAULT_MAX_AGE = 3600.0
+# An entry still being created or claimed after this long belongs to a run that died
+STALE_AFTER = 60.0
+
+def _entry(queues):
+    token = secrets.token_hex(3)
+    return {'namespace': f"{POOL_PREFIX}{token}", 'veth_br': f"vp{token}b", 'veth_ns': f"vp{token}n",
+            'queues': queues, 'created': time.time()}
+
+class NamespacePool:
+    """Pre-created subnet namespaces, so subnet-add skips the CIDR-independent work.
+
+    An entry is a namespace with lo up and a veth pair whose inner end is
+    already in it; both ends stay down. subnet-add claims the oldest entry
+    with the veth queue count its VPC's tuning profile needs, renames the
+    namespace and veths, and only adds addresses, routes and the bridge
+    port. Entries are rows in the state database, claimed in a transaction,
+    so concurrent subnet-adds never share one; the row goes once the
+    namespace is renamed.
+    """
+
+    @staticmethod
+    def queues_of(tuning):
+        return tuning.settings.get('veth_queues') or 0
+
+    @staticmethod
+    def _create(entry):
+        tuning = Tuning('pool', {'veth_queues': entry['queues']} if entry['queues'] else {})
+        try:
+            run_batch([
+                f"netns add {entry['namespace']}",
+                tuning.veth_add(entry['veth_br'], entry['veth_ns']),
+                f"link set {entry['veth_ns']} netns {entry['namespace']}",
+            ])
+            run_batch(["link set lo up"], netns=entry['namespace'])
+            return True
+        except Exception as e:
+            log('ERROR', f"Failed to create pool entry {entry['namespace']}: {e}")
+            NamespacePool._destroy(entry)
+            return False
+
+    @staticmethod
+    def _destroy(entry):
+        # Deleting the namespace deletes the veth pair with it, unless it never got moved there
+        run_cmd(['ip', 'netns', 'del', entry['namespace']], check=False, quiet=True)
+        if get_backend().link_exists(entry['veth_br']):
+            run_cmd(['ip', 'link', 'del', entry['veth_br']], check=False, quiet=True)
+
+    @staticmethod
+    def fill(size, profile=DEFAULT_PROFILE, workers=8):
+        """Top the pool up to size ready entries for a tuning profile's queue count"""
+        if profile not in PROFILES:
+            log('ERROR', f"Unknown tuning profile {profile} (choose from {', '.join(PROFILES)})")
+            return False
+        NamespacePool.gc()
+        manager = StateManager()
+        queues = NamespacePool.queues_of(Tuning(profile))
+        entries = manager.pool_entries()
+        missing = size - sum(1 for e in entries if e['queues'] == queues)
+        if missing > MAX_SIZE - len(entries):
+            missing = MAX_SIZE - len(entries)
+            log('WARNING', f"Pool is limited to {MAX_SIZE} entries (VPCCTL_POOL_MAX), adding {max(missing, 0)}")
+        if missing <= 0:
+            log('SUCCESS', f"Pool already holds {len(entries)} entr{'y' if len(entries) == 1 else 'ies'}")
+            return True
+
+        new = [_entry(queues) for _ in range(missing)]
+        manager.pool_reserve(new)
+        log('INFO', f"Pre-creating {missing} namespace(s) with veth pairs ({queues or 1} queue(s) each)")
+        started = time.perf_counter()
+        with worker_pool(min(workers, missing)) as pool:
+            results = list(pool.map(NamespacePool._create, new))
+        for entry, ok in zip(new, results):
+            if ok:
+                manager.pool_ready(entry['namespace'])
+        manager.pool_remove([e['namespace'] for e, ok in zip(new, results) if not ok])
+        created = results.count(True)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        log('SUCCESS' if created == missing else 'WARNING',
+            f"Added {created}/{missing} pool entr{'y' if missing == 1 else 'ies'} in {elapsed_ms:.1f} ms")
+        return created == missing
+
+    @staticmethod
+    def claim(tuning):
+        """Take a ready entry for a VPC with this tuning; None when the pool has none"""
+        manager = StateManager()
+        backend = get_backend()
+        queues = NamespacePool.queues_of(tuning)
+        while True:
+            entry = manager.pool_claim(queues)
+            if entry is None:
+                return None
+            if entry['namespace'] in backend.namespace_names() and backend.link_exists(entry['veth_br']):
+                log('INFO', f"Claimed pooled namespace {entry['namespace']}")
+                return entry
+            # Gone since it was created (a reboot clears /var/run/netns)
+            log('WARNING', f"Pool entry {entry['namespace']} no longer exists, discarding it")
+            NamespacePool._destroy(entry)
+            manager.pool_remove([entry['namespace']])
+
+    @staticmethod
+    def release(entry):
+        """Forget a claimed entry once its namespace has been renamed"""
+        StateManager().pool_remove([entry['namespace']])
+
+    @staticmethod
+    def gc(max_age=None, drain=False):
+        """Destroy ready entries older than max_age (all with drain), entries a fill or claim
+        left behind, entries whose namespace is gone, and pool links and namespaces nobody records"""
+        manager = StateManager()
+        backend = get_backend()
+        now = time.time()
+        # List the host first: anything a concurrent fill creates afterwards is already recorded
+        namespaces = backend.namespace_names()
+        links = backend.link_table()
+        entries = manager.pool_entries()
+        expired = [e for e in entries
+                   if (e['status'] != 'ready' and now - e['changed'] > STALE_AFTER)
+                   or (e['status'] == 'ready' and (drain or e['namespace'] not in namespaces
+                                                   or (max_age is not None and now - e['created'] > max_age)))]
+        removed = set(manager.pool_remove([e['namespace'] for e in expired]))
+        expired = [e for e in expired if e['namespace'] in removed]
+
+        recorded = {e['namespace'] for e in entries}
+        recorded_links = {e['veth_br'] for e in entries}
+        leftovers = sorted(n for n in namespaces if n.startswith(POOL_PREFIX) and n not in recorded)
+        stray_links = sorted(name for name in links
+                             if POOL_VETH_RE.match(name) and name.endswith('b') and name not in recorded_links)
+
+        for entry in expired:
+            NamespacePool._destroy(entry)
+        for name in leftovers:
+            run_cmd(['ip', 'netns', 'del', name], check=False, quiet=True)
+        for name in stray_links:
+            run_cmd(['ip', 'link', 'del', name], check=False, quiet=True)
+        total = len(expired) + len(leftovers) + len(stray_links)
+        if total:
+            log('INFO', f"Pool garbage collection removed {len(expired)} entr{'y' if len(expired) == 1 else 'ies'}, "
+                        f"{len(leftovers)} stray namespace(s) and {len(stray_links)} stray veth(s)")
+        return total
+
+    @staticmethod
+    def status():
+        """Entry counts per veth queue count and status, and the oldest entry's age"""
+        entries = StateManager().pool_entries()
+        by_queues = {}
+        for entry in entries:
+            counts = by_queues.setdefault(entry['queues'] or 1, {'ready': 0, 'creating': 0, 'claimed': 0})
+            counts[entry['status']] += 1
+        return {'size': len(entries), 'max': MAX_SIZE, 'by_queues': by_queues,
+                'oldest_s': round(time.time() - entries[0]['created'], 1) if entries else None}
+
+    @staticmethod
+    def describe(status):
+        if not status['size']:
+            return f"empty (max {status['max']})"
+        parts = []
+        for queues, counts in sorted(status['by_queues'].items()):
+            busy = ''.join(f", {counts[key]} {key}" for key in ('creating', 'claimed') if counts[key])
+            parts.append(f"{counts['ready']} ready{busy} with {queues} queue(s)")
+        return f"{'; '.join(parts)} (max {status['max']}, oldest {status['oldest_s']:.0f}s)"
+
+    @staticmethod
+    def show(output_format='table'):
+        status = NamespacePool.status()
+        if output_format == 'json':
+            print(json.dumps(status, indent=2))
+            return
+        print(f"\n{'='*60}")
+        print("Namespace Pool")
+        print(f"{'='*60}")
+        color = Colors.GREEN if status['size'] else Colors.YELLOW
+        print(f"  {color}•{Colors.RESET} {NamespacePool.describe(status)}")
+        print()
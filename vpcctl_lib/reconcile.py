@@ -0,0 +1,454 @@
+import json
+import re
+from collections import Counter
+from vpcctl_lib.state import StateManager, log, Colors
+from vpcctl_lib.backend import run_cmd, run_batch, capture, get_backend
+from vpcctl_lib.chains import VPCChains, HOOKS
+from vpcctl_lib.transit import TRANSIT_SET, TRANSIT_CHAIN, TRANSIT_RULE
+from vpcctl_lib.trace import span
+from vpcctl_lib.tuning import Tuning
+from vpcctl_lib.nft import NftVPC, TABLE_FAMILY, TABLE_PREFIX, get_firewall, firewall_of, replace_table, load
+
+# Host-side names vpcctl gives to what it creates
+SUBNET_VETH_RE = re.compile(r'^vb[0-9a-f]{4}$')
+PEER_VETH_PREFIX = 'peer-'
+NAMESPACE_PREFIX = 'ns-'
+OWNED_CHAIN_RE = re.compile(r'^VPC-.+-(FWD|NAT)$')
+
+def parse_iptables_save(text):
+    """Return (chains, rules) from iptables-save output.
+
+    chains is a set of (table, chain); rules maps (table, chain) to the
+    rule specs in order, exactly as iptables-save prints them.
+    """
+    chains = set()
+    rules = {}
+    table = None
+    for line in text.splitlines():
+        if line.startswith('*'):
+            table = line[1:].strip()
+        elif table is None:
+            continue
+        elif line.startswith(':'):
+            chains.add((table, line[1:].split()[0]))
+        elif line.startswith('-A '):
+            parts = line.split(None, 2)
+            chains.add((table, parts[1]))
+            rules.setdefault((table, parts[1]), []).append(parts[2] if len(parts) > 2 else '')
+    return chains, rules
+
+class Snapshot:
+    """A single read of the host's networking state.
+
+    Links and namespaces come from sysfs and the netns directory, addresses
+    and routes from netlink dumps, and iptables from one iptables-save, so
+    the number of processes does not grow with the number of VPCs.
+    Fields the backend cannot observe are None.
+    """
+
+    def __init__(self, links, namespaces, addresses=None, routes=None,
+                 chains=None, rules=None, internet_iface=None, transit_members=None, nft_tables=None):
+        self.links = links
+        self.namespaces = namespaces
+        self.addresses = addresses
+        self.routes = routes
+        self.chains = chains
+        self.rules = rules
+        self.internet_iface = internet_iface
+        self.transit_members = transit_members
+        self.nft_tables = nft_tables
+
+    @classmethod
+    def collect(cls, namespaces=(), full=True, transit=False, nft=False):
+        """Read the host; full=False only reads links and namespaces.
+
+        transit=True also reads the transit hub membership set, nft=True
+        the list of nftables tables.
+        """
+        with span('snapshot', full=full):
+            return cls._collect(namespaces, full, transit, nft)
+
+    @classmethod
+    def _collect(cls, namespaces, full, transit, nft):
+        backend = get_backend()
+        snapshot = cls(backend.link_table(), backend.namespace_names())
+        if not full:
+            return snapshot
+
+        if backend.live:
+            snapshot._read_netlink([ns for ns in namespaces if ns in snapshot.namespaces])
+        else:
+            snapshot.internet_iface = backend.internet_iface
+
+        result = capture(['iptables-save'])
+        if result.returncode == 0:
+            snapshot.chains, snapshot.rules = parse_iptables_save(result.stdout)
+
+        if transit:
+            result = capture(['ipset', 'save', TRANSIT_SET])
+            snapshot.transit_members = set() if result.returncode == 0 else None
+            for line in (result.stdout or '').splitlines():
+                parts = line.split()
+                if parts[:2] == ['add', TRANSIT_SET] and len(parts) > 2:
+                    snapshot.transit_members.add(parts[2])
+
+        if nft:
+            result = capture(['nft', 'list', 'tables'])
+            if result.returncode == 0:
+                snapshot.nft_tables = {parts[2] for parts in map(str.split, result.stdout.splitlines())
+                                       if parts[:2] == ['table', TABLE_FAMILY] and len(parts) > 2}
+        return snapshot
+
+    def _read_netlink(self, namespaces):
+        try:
+            from vpcctl_lib.netlink import RtNetlink
+            host = RtNetlink()
+        except OSError as e:
+            log('WARNING', f"Cannot read addresses and routes over netlink: {e}")
+            return
+        try:
+            self.addresses = {}
+            for ifname, cidr in host.addresses():
+                self.addresses.setdefault(ifname, set()).add(cidr)
+            names = {link['index']: name for name, link in self.links.items()}
+            for route in host.routes():
+                if route['dst'] == 'default' and route['oif'] in names:
+                    self.internet_iface = names[route['oif']]
+                    break
+        finally:
+            host.close()
+
+        self.routes = {}
+        for ns in namespaces:
+            try:
+                nl = RtNetlink(ns)
+            except OSError:
+                self.routes[ns] = None
+                continue
+            try:
+                self.routes[ns] = nl.routes()
+            finally:
+                nl.close()
+
+class RepairPlan:
+    """Repairs batched by engine: one host ip batch, one batch per namespace, one iptables-restore, one nft -f"""
+
+    def __init__(self):
+        self.host = []
+        self.netns = {}
+        self.new_chains = {table: [] for table in HOOKS}
+        self.iptables = {table: [] for table in HOOKS}
+        self.ipset = []
+        self.nft = []
+        self.bridges = []
+        self.states = {}
+
+    def ns(self, ns_name, line):
+        self.netns.setdefault(ns_name, []).append(line)
+
+    def restore_document(self):
+        lines = []
+        for table in HOOKS:
+            if not self.new_chains[table] and not self.iptables[table]:
+                continue
+            lines.append(f"*{table}")
+            lines.extend(f":{chain} - [0:0]" for chain in self.new_chains[table])
+            lines.extend(self.iptables[table])
+            lines.append('COMMIT')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def empty(self):
+        return not (self.host or self.netns or self.restore_document() or self.ipset or self.nft
+                    or self.bridges or self.states)
+
+    def apply(self, manager):
+        """Run every repair; process count follows the amount of drift, not the number of VPCs"""
+        ok = True
+        if self.host:
+            ok &= run_batch(self.host, check=False)
+        for bridge, tuning in self.bridges:
+            ok &= tuning.tune_bridge(bridge)
+        if self.ipset:
+            ok &= run_cmd(['ipset', 'restore', '-exist'], input='\n'.join(self.ipset) + '\n', check=False)
+        for ns_name, lines in self.netns.items():
+            ok &= run_batch(lines, netns=ns_name, check=False)
+        document = self.restore_document()
+        if document:
+            ok &= run_cmd(['iptables-restore', '--noflush'], input=document, check=False)
+        if self.nft:
+            ok &= load(self.nft)
+        if self.states:
+            with manager.transaction():
+                for vpc_name, state in self.states.items():
+                    manager.save(vpc_name, state)
+        return ok
+
+class Reconciler:
+    """Diffs the VPCs in the state store against a host snapshot"""
+
+    def __init__(self, manager, snapshot, states):
+        self.manager = manager
+        self.snapshot = snapshot
+        self.states = states
+        self.findings = []
+        self.plan = RepairPlan()
+
+    @classmethod
+    def for_host(cls, vpc_names=None):
+        manager = StateManager()
+        states = {name: manager.load(name) for name in manager.list_all()}
+        namespaces = [s['namespace'] for state in states.values() for s in state['subnets'].values()]
+        transit = any('transit' in state for state in states.values())
+        nft = get_firewall() == 'nft' or any(firewall_of(state) == 'nft' for state in states.values())
+        reconciler = cls(manager, Snapshot.collect(namespaces, transit=transit, nft=nft), states)
+        reconciler.diff(vpc_names)
+        return reconciler
+
+    def _finding(self, vpc_name, kind, resource, detail, repairable=True):
+        self.findings.append({'vpc': vpc_name, 'kind': kind, 'resource': resource,
+                              'detail': detail, 'repairable': repairable})
+
+    def diff(self, vpc_names=None):
+        for vpc_name in sorted(self.states):
+            if vpc_names and vpc_name not in vpc_names:
+                continue
+            state = self.states[vpc_name]
+            self._diff_links(vpc_name, state)
+            self._diff_routes(vpc_name, state)
+            if self.snapshot.rules is not None and 'chains' in state:
+                self._diff_rules(vpc_name, state)
+            if self.snapshot.nft_tables is not None and 'nft' in state:
+                self._diff_nft(vpc_name, state)
+        self._diff_transit(vpc_names)
+        if not vpc_names:
+            self._diff_orphans()
+        return self.findings
+
+    def _diff_links(self, vpc_name, state):
+        snapshot, plan = self.snapshot, self.plan
+        bridge = state['bridge']
+        link = snapshot.links.get(bridge)
+        gateways = [(name, f"{s['gateway_ip']}/{s['cidr'].split('/')[1]}")
+                    for name, s in state['subnets'].items() if s.get('gateway_ip')]
+
+        if link is None or link['kind'] != 'bridge':
+            self._finding(vpc_name, 'missing-bridge', bridge, "bridge does not exist")
+            tuning = Tuning.of(state)
+            plan.host += [f"link add name {bridge} type bridge"] + tuning.bridge_lines(bridge)
+            plan.host.append(f"link set {bridge} up")
+            if tuning.settings:
+                plan.bridges.append((bridge, tuning))
+            plan.host += [f"addr replace {cidr} dev {bridge}" for _, cidr in gateways]
+            link = None
+        else:
+            if not link['up']:
+                self._finding(vpc_name, 'bridge-down', bridge, "bridge is administratively down")
+                plan.host.append(f"link set {bridge} up")
+            if snapshot.addresses is not None:
+                present = snapshot.addresses.get(bridge, set())
+                for subnet_name, cidr in gateways:
+                    if cidr not in present:
+                        self._finding(vpc_name, 'missing-address', bridge,
+                                      f"gateway {cidr} of subnet {subnet_name} not configured")
+                        plan.host.append(f"addr replace {cidr} dev {bridge}")
+
+        for subnet_name, subnet in state['subnets'].items():
+            if subnet['namespace'] not in snapshot.namespaces:
+                self._finding(vpc_name, 'missing-namespace', subnet['namespace'],
+                              f"namespace of subnet {subnet_name} is gone; re-add the subnet",
+                              repairable=False)
+            self._check_port(vpc_name, subnet['veth_br'], bridge, link,
+                             f"subnet {subnet_name} veth", "re-add the subnet")
+
+        for peer_vpc, peering in state.get('peerings', {}).items():
+            if peer_vpc not in self.states:
+                self._finding(vpc_name, 'dangling-peering', peer_vpc,
+                              f"peered VPC {peer_vpc} no longer exists")
+                self._drop_peering(vpc_name, state, peer_vpc)
+                continue
+            self._check_port(vpc_name, peering['veth'], bridge, link,
+                             f"peering veth towards {peer_vpc}", "peer the VPCs again")
+
+    def _check_port(self, vpc_name, veth, bridge, bridge_link, what, remedy):
+        link = self.snapshot.links.get(veth)
+        if link is None:
+            self._finding(vpc_name, 'missing-veth', veth, f"{what} does not exist; {remedy}",
+                          repairable=False)
+        elif bridge_link is None or (link['master'] != bridge and link['index'] is not None):
+            # A recreated bridge needs its ports re-attached; recorded links carry no master
+            if bridge_link is not None:
+                self._finding(vpc_name, 'detached-veth', veth, f"{what} is not attached to {bridge}")
+            self.plan.host += [f"link set {veth} master {bridge}", f"link set {veth} up"]
+
+    def _drop_peering(self, vpc_name, state, peer_vpc):
+        peering = state['peerings'].pop(peer_vpc)
+        self.plan.states[vpc_name] = state
+        if peering.get('veth') in self.snapshot.links:
+            self.plan.host.append(f"link del {peering['veth']}")
+
+    def _expected_routes(self, state):
+        """Peer CIDRs (and the transit aggregate) each subnet should route via its gateway"""
+        expected = {self.states[peer]['cidr'] for peer in state.get('peerings', {}) if peer in self.states}
+        if 'transit' in state:
+            expected.add(state['transit']['aggregate'])
+        return expected
+
+    def _diff_routes(self, vpc_name, state):
+        if self.snapshot.routes is None:
+            return
+        expected = self._expected_routes(state)
+        for subnet_name, subnet in state['subnets'].items():
+            ns_name = subnet['namespace']
+            routes = self.snapshot.routes.get(ns_name)
+            gateway = subnet.get('gateway_ip')
+            if routes is None or not gateway:
+                continue
+            via_gateway = {r['dst'] for r in routes if r['gateway'] == gateway and r['dst'] != 'default'}
+            for dst in sorted(via_gateway - expected):
+                self._finding(vpc_name, 'stale-route', ns_name, f"{dst} via {gateway} has no peering")
+                self.plan.ns(ns_name, f"route del {dst} via {gateway}")
+            for dst in sorted(expected - via_gateway):
+                self._finding(vpc_name, 'missing-route', ns_name, f"{dst} via {gateway} for peering")
+                self.plan.ns(ns_name, f"route replace {dst} via {gateway}")
+            if not any(r['dst'] == 'default' for r in routes):
+                self._finding(vpc_name, 'missing-route', ns_name, f"default via {gateway}")
+                self.plan.ns(ns_name, f"route replace default via {gateway}")
+
+    def _diff_rules(self, vpc_name, state):
+        snapshot, plan = self.snapshot, self.plan
+        chains = VPCChains(vpc_name, state['bridge'])
+        expected = chains.expected_rules(state, self.states, snapshot.internet_iface)
+        for (table, chain), specs in expected.items():
+            hook = HOOKS[table]
+            jump = f"-j {chain}"
+            if (table, chain) not in snapshot.chains:
+                self._finding(vpc_name, 'missing-chain', chain, f"{table} chain does not exist")
+                plan.new_chains[table].append(chain)
+            hook_rules = snapshot.rules.get((table, hook), [])
+            if jump not in hook_rules:
+                self._finding(vpc_name, 'missing-rule', hook, f"{table} jump to {chain}")
+                plan.iptables[table].append(f"-A {hook} {jump}")
+            present = snapshot.rules.get((table, chain), [])
+            for spec in specs:
+                if spec not in present:
+                    self._finding(vpc_name, 'missing-rule', chain, spec)
+                    plan.iptables[table].append(f"-A {chain} {spec}")
+            for spec, count in sorted(Counter(present).items()):
+                if count > 1:
+                    self._finding(vpc_name, 'duplicate-rule', chain, f"{spec} (x{count})")
+                    plan.iptables[table] += [f"-D {chain} {spec}"] * (count - 1)
+            if hook_rules.count(jump) > 1:
+                self._finding(vpc_name, 'duplicate-rule', hook, f"{jump} (x{hook_rules.count(jump)})")
+                plan.iptables[table] += [f"-D {hook} {jump}"] * (hook_rules.count(jump) - 1)
+
+    def _diff_nft(self, vpc_name, state):
+        table = state['nft']['table']
+        if table not in self.snapshot.nft_tables:
+            self._finding(vpc_name, 'missing-table', table, f"nftables table {TABLE_FAMILY} {table} does not exist")
+            self.plan.nft += NftVPC(vpc_name, state['bridge'], state['nft']).document()
+
+    def _diff_transit(self, vpc_names=None):
+        members = self.snapshot.transit_members
+        attached = {name: state['cidr'] for name, state in self.states.items() if 'transit' in state}
+        if not attached:
+            return
+        plan = self.plan
+        if members is None:
+            self._finding(None, 'missing-set', TRANSIT_SET, "transit membership set does not exist")
+            plan.ipset.append(f"create {TRANSIT_SET} hash:net")
+            members = set()
+        for vpc_name, cidr in sorted(attached.items()):
+            if (not vpc_names or vpc_name in vpc_names) and cidr not in members:
+                self._finding(vpc_name, 'missing-member', TRANSIT_SET, f"{cidr} is not in the transit set")
+                plan.ipset.append(f"add {TRANSIT_SET} {cidr}")
+        if not vpc_names:
+            for cidr in sorted(members - set(attached.values())):
+                self._finding(None, 'stale-member', TRANSIT_SET, f"{cidr} belongs to no attached VPC")
+                plan.ipset.append(f"del {TRANSIT_SET} {cidr}")
+
+        rules = self.snapshot.rules
+        if rules is None:
+            return
+        if ('filter', TRANSIT_CHAIN) not in self.snapshot.chains:
+            self._finding(None, 'missing-chain', TRANSIT_CHAIN, "filter chain does not exist")
+            plan.new_chains['filter'].append(TRANSIT_CHAIN)
+        if f"-j {TRANSIT_CHAIN}" not in rules.get(('filter', 'FORWARD'), []):
+            self._finding(None, 'missing-rule', 'FORWARD', f"filter jump to {TRANSIT_CHAIN}")
+            plan.iptables['filter'].append(f"-A FORWARD -j {TRANSIT_CHAIN}")
+        rule = ' '.join(TRANSIT_RULE)
+        if rule not in rules.get(('filter', TRANSIT_CHAIN), []):
+            self._finding(None, 'missing-rule', TRANSIT_CHAIN, rule)
+            plan.iptables['filter'].append(f"-A {TRANSIT_CHAIN} {rule}")
+
+    def _diff_orphans(self):
+        snapshot, plan = self.snapshot, self.plan
+        owned_links = set()
+        owned_namespaces = set()
+        owned_chains = set()
+        owned_tables = set()
+        for vpc_name, state in self.states.items():
+            owned_links.add(state['bridge'])
+            for subnet in state['subnets'].values():
+                owned_links.add(subnet['veth_br'])
+                owned_namespaces.add(subnet['namespace'])
+            for peering in state.get('peerings', {}).values():
+                owned_links.update(v for v in (peering.get('veth'), peering.get('peer_veth')) if v)
+            chains = VPCChains(vpc_name, state['bridge'])
+            owned_chains.update((chains.fwd_chain, chains.nat_chain))
+            if 'nft' in state:
+                owned_tables.add(state['nft']['table'])
+
+        for name in sorted(snapshot.links):
+            if name in owned_links:
+                continue
+            if SUBNET_VETH_RE.match(name) or name.startswith(PEER_VETH_PREFIX):
+                self._finding(None, 'orphan-veth', name, "not referenced by any VPC")
+                plan.host.append(f"link del {name}")
+
+        for name in sorted(snapshot.namespaces - owned_namespaces):
+            if name.startswith(NAMESPACE_PREFIX):
+                self._finding(None, 'orphan-namespace', name, "not referenced by any VPC")
+                plan.host.append(f"netns del {name}")
+
+        for table in sorted(snapshot.nft_tables or ()):
+            if table.startswith(TABLE_PREFIX) and table not in owned_tables:
+                self._finding(None, 'orphan-table', table, "nftables table not owned by any VPC")
+                plan.nft += replace_table(table)
+
+        if snapshot.chains is None:
+            return
+        for table, chain in sorted(snapshot.chains):
+            if table not in HOOKS or chain in owned_chains or not OWNED_CHAIN_RE.match(chain):
+                continue
+            self._finding(None, 'orphan-chain', chain, f"{table} chain not owned by any VPC")
+            hook = HOOKS[table]
+            jumps = snapshot.rules.get((table, hook), []).count(f"-j {chain}")
+            plan.iptables[table] += [f"-D {hook} -j {chain}"] * jumps
+            plan.iptables[table] += [f"-F {chain}", f"-X {chain}"]
+
+    def repair(self):
+        if self.plan.empty():
+            return True
+        log('INFO', f"Repairing {sum(f['repairable'] for f in self.findings)} drift item(s)")
+        return self.plan.apply(self.manager)
+
+    def render(self, output_format='table', repaired=False):
+        if output_format == 'json':
+            print(json.dumps({'repaired': repaired, 'findings': self.findings}, indent=2))
+            return
+
+        print(f"\n{'='*60}")
+        print(f"Drift report ({len(self.findings)} finding(s))")
+        print(f"{'='*60}")
+        if not self.findings:
+            print(f"  {Colors.GREEN}✓{Colors.RESET} Host matches the state store")
+            return
+        current = object()
+        for f in self.findings:
+            if f['vpc'] != current:
+                current = f['vpc']
+                print(f"\n• {current if current else 'Not owned by any VPC'}")
+            mark = f"{Colors.GREEN}✓{Colors.RESET}" if repaired and f['repairable'] else f"{Colors.YELLOW}⚠{Colors.RESET}"
+            note = '' if f['repairable'] else ' (manual)'
+            print(f"  {mark} {f['kind']:<18} {f['resource']}: {f['detail']}{note}")
+        print()
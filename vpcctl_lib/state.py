@@ -1,7 +1,64 @@
+import atexit
+import contextvars
 import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import fcntl
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from vpcctl_lib.trace import span, current_operation
 
-STATE_DIR = Path("/var/lib/vpcctl")
+STATE_DIR = Path(os.environ.get('VPCCTL_STATE_DIR', '/var/lib/vpcctl'))
+STATE_DB = 'state.db'
+GLOBAL_LOCK = '.global'
+# Record mode plans against a throwaway copy of the state unless this is 'keep'
+RECORD_STATE = os.environ.get('VPCCTL_RECORD_STATE', 'scratch')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vpcs (
+    name TEXT PRIMARY KEY,
+    cidr TEXT NOT NULL,
+    bridge TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    revision TEXT
+);
+CREATE TABLE IF NOT EXISTS subnets (
+    vpc TEXT NOT NULL REFERENCES vpcs(name) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    cidr TEXT NOT NULL,
+    type TEXT,
+    namespace TEXT NOT NULL,
+    veth_br TEXT,
+    gateway_ip TEXT,
+    namespace_ip TEXT,
+    PRIMARY KEY (vpc, name)
+);
+CREATE INDEX IF NOT EXISTS subnets_namespace ON subnets(namespace);
+CREATE INDEX IF NOT EXISTS subnets_veth ON subnets(veth_br);
+CREATE TABLE IF NOT EXISTS peerings (
+    vpc TEXT NOT NULL REFERENCES vpcs(name) ON DELETE CASCADE,
+    peer TEXT NOT NULL,
+    veth TEXT,
+    PRIMARY KEY (vpc, peer)
+);
+CREATE INDEX IF NOT EXISTS peerings_peer ON peerings(peer);
+CREATE TABLE IF NOT EXISTS pool (
+    namespace TEXT PRIMARY KEY,
+    veth_br TEXT NOT NULL,
+    veth_ns TEXT NOT NULL,
+    queues INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    changed REAL NOT NULL
+);
+"""
 
 class Colors:
     GREEN = '\033[92m'
@@ -10,38 +67,296 @@ class Colors:
     RED = '\033[91m'
     RESET = '\033[0m'
 
+LOG_FORMATS = ('text', 'json')
+_log_format = contextvars.ContextVar('vpcctl_log_format',
+                                     default=os.environ.get('VPCCTL_LOG_FORMAT', 'text'))
+
+def set_log_format(log_format):
+    """text: coloured lines; json: one object per line with timestamp and operation"""
+    if log_format not in LOG_FORMATS:
+        raise ValueError(f"Unknown log format {log_format}")
+    _log_format.set(log_format)
+
+_log_to_stderr = contextvars.ContextVar('vpcctl_log_to_stderr', default=False)
+
+def set_log_stderr(enabled):
+    """Write log lines to stderr, leaving stdout to a command's machine-readable output"""
+    _log_to_stderr.set(enabled)
+
 def log(level, message):
-    colors = {'INFO': Colors.BLUE, 'SUCCESS': Colors.GREEN, 
+    stream = sys.stderr if _log_to_stderr.get() else sys.stdout
+    if _log_format.get() == 'json':
+        print(json.dumps({'ts': round(time.time(), 6), 'level': level, 'message': message,
+                          'operation': current_operation()}), file=stream)
+        return
+    colors = {'INFO': Colors.BLUE, 'SUCCESS': Colors.GREEN,
               'WARNING': Colors.YELLOW, 'ERROR': Colors.RED}
     color = colors.get(level, '')
-    print(f"{color}[{level}]{Colors.RESET} {message}")
+    print(f"{color}[{level}]{Colors.RESET} {message}", file=stream)
+
+_output = contextvars.ContextVar('vpcctl_output', default=None)
+
+def route_output(sink):
+    """Send this thread's console output to sink (None restores the process streams)"""
+    _output.set(sink)
+
+def current_output():
+    return _output.get()
+
+def _inherit(context):
+    for var, value in context.items():
+        var.set(value)
+
+def worker_pool(max_workers):
+    """ThreadPoolExecutor whose threads inherit the caller's output routing, log format and operation"""
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=_inherit,
+                              initargs=(contextvars.copy_context(),))
+
+def use_scratch_state():
+    """Point every StateManager at a throwaway copy of STATE_DIR, removed at exit.
+
+    The record backend plans against the real VPCs this way without saving
+    what it planned. Returns the scratch directory.
+    """
+    global STATE_DIR
+    source = STATE_DIR
+    scratch = Path(tempfile.mkdtemp(prefix='vpcctl-record-'))
+    atexit.register(shutil.rmtree, scratch, True)
+    db_path = source / STATE_DB
+    if db_path.exists():
+        try:
+            src = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            dst = sqlite3.connect(scratch / STATE_DB)
+            try:
+                src.backup(dst)
+            finally:
+                src.close()
+                dst.close()
+        except sqlite3.Error as e:
+            log('WARNING', f"Cannot read {db_path} ({e}), planning against empty state")
+    # Legacy per-VPC files are imported on first use, so the copy needs them too
+    for state_file in source.glob('*.json'):
+        shutil.copy2(state_file, scratch)
+    STATE_DIR = scratch
+    return scratch
+
+_local = threading.local()
 
 class StateManager:
+    """VPC state in a single SQLite database (WAL mode) under STATE_DIR.
+
+    Each VPC is stored as its JSON document plus indexed subnet and peering
+    rows, so listings and lookups do not have to parse every document.
+    Legacy per-VPC JSON files are imported on first use.
+    """
+
     def __init__(self):
         self.state_dir = STATE_DIR
         self.state_dir.mkdir(parents=True, exist_ok=True)
-    
+        self.db_path = self.state_dir / STATE_DB
+        self.conn = self._connect()
+
+    def _connect(self):
+        connections = getattr(_local, 'connections', None)
+        if connections is None:
+            connections = _local.connections = {}
+            _local.depths = {}
+        key = self.key = str(self.db_path)
+        if key not in connections:
+            conn = sqlite3.connect(key, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            conn.executescript(SCHEMA)
+            self._add_columns(conn)
+            connections[key] = conn
+            _local.depths[key] = 0
+            self.conn = conn
+            self.migrate_json()
+        return connections[key]
+
+    @staticmethod
+    def _add_columns(conn):
+        """Bring databases created by older versions up to SCHEMA"""
+        if 'revision' in {row[1] for row in conn.execute('PRAGMA table_info(vpcs)')}:
+            return
+        try:
+            conn.execute('ALTER TABLE vpcs ADD COLUMN revision TEXT')
+        except sqlite3.OperationalError:
+            pass  # added by a concurrent run
+
+    @contextmanager
+    def transaction(self):
+        """Group several saves/deletes into one atomic write transaction"""
+        depths = _local.depths
+        if depths[self.key] == 0:
+            self.conn.execute('BEGIN IMMEDIATE')
+        depths[self.key] += 1
+        try:
+            yield self
+        except BaseException:
+            depths[self.key] -= 1
+            if depths[self.key] == 0:
+                self.conn.execute('ROLLBACK')
+            raise
+        depths[self.key] -= 1
+        if depths[self.key] == 0:
+            self.conn.execute('COMMIT')
+
+    @contextmanager
+    def lock(self, *vpc_names, exclusive=False):
+        """Serialise CLI runs touching the same VPCs.
+
+        Per-VPC operations hold a shared global lock plus an exclusive lock
+        per VPC (taken in sorted order); exclusive=True locks out everyone.
+        """
+        lock_dir = self.state_dir / 'locks'
+        lock_dir.mkdir(exist_ok=True)
+        handles = []
+        try:
+            names = [GLOBAL_LOCK] + sorted(set(vpc_names))
+            with span('lock', 'lock', vpcs=names[1:], exclusive=exclusive):
+                for name in names:
+                    f = open(lock_dir / f"{name}.lock", 'a')
+                    handles.append(f)
+                    shared = name == GLOBAL_LOCK and not exclusive
+                    fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+        finally:
+            for f in reversed(handles):
+                f.close()
+
     def save(self, vpc_name, data):
-        state_file = self.state_dir / f"{vpc_name}.json"
-        with open(state_file, 'w') as f:
-            json.dump(data, f, indent=2)
-        log('SUCCESS', f"State saved: {state_file}")
-    
+        """Store a VPC document; returns its new revision"""
+        revision = uuid.uuid4().hex
+        with span('state save', 'state', vpc=vpc_name), self.transaction():
+            self.conn.execute(
+                'INSERT INTO vpcs (name, cidr, bridge, doc, revision) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET cidr = excluded.cidr, '
+                'bridge = excluded.bridge, doc = excluded.doc, revision = excluded.revision',
+                (vpc_name, data['cidr'], data['bridge'], json.dumps(data), revision))
+            self.conn.execute('DELETE FROM subnets WHERE vpc = ?', (vpc_name,))
+            self.conn.executemany(
+                'INSERT INTO subnets (vpc, name, cidr, type, namespace, veth_br, gateway_ip, namespace_ip) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(vpc_name, name, s['cidr'], s.get('type'), s['namespace'], s.get('veth_br'),
+                  s.get('gateway_ip'), s.get('namespace_ip'))
+                 for name, s in data.get('subnets', {}).items()])
+            self.conn.execute('DELETE FROM peerings WHERE vpc = ?', (vpc_name,))
+            self.conn.executemany(
+                'INSERT INTO peerings (vpc, peer, veth) VALUES (?, ?, ?)',
+                [(vpc_name, peer, p.get('veth')) for peer, p in data.get('peerings', {}).items()])
+        log('SUCCESS', f"State saved: {vpc_name}")
+        return revision
+
     def load(self, vpc_name):
-        state_file = self.state_dir / f"{vpc_name}.json"
-        if not state_file.exists():
+        row = self.conn.execute('SELECT doc FROM vpcs WHERE name = ?', (vpc_name,)).fetchone()
+        if row is None:
             return None
-        with open(state_file, 'r') as f:
-            return json.load(f)
-    
+        return json.loads(row[0])
+
+    def revision(self, vpc_name):
+        """Changes on every save of the VPC; None for unknown VPCs and pre-revision rows"""
+        row = self.conn.execute('SELECT revision FROM vpcs WHERE name = ?', (vpc_name,)).fetchone()
+        return row[0] if row else None
+
     def delete(self, vpc_name):
-        state_file = self.state_dir / f"{vpc_name}.json"
-        if state_file.exists():
-            state_file.unlink()
-            log('SUCCESS', f"State deleted: {state_file}")
-    
+        with self.transaction():
+            deleted = self.conn.execute('DELETE FROM vpcs WHERE name = ?', (vpc_name,)).rowcount
+        if deleted:
+            log('SUCCESS', f"State deleted: {vpc_name}")
+
     def exists(self, vpc_name):
-        return (self.state_dir / f"{vpc_name}.json").exists()
-    
+        return self.conn.execute('SELECT 1 FROM vpcs WHERE name = ?', (vpc_name,)).fetchone() is not None
+
     def list_all(self):
-        return [f.stem for f in self.state_dir.glob("*.json")]
\ No newline at end of file
+        return [row[0] for row in self.conn.execute('SELECT name FROM vpcs ORDER BY name')]
+
+    def summaries(self):
+        """Name, CIDR, bridge and subnet count of every VPC, without loading documents"""
+        return [{'name': name, 'cidr': cidr, 'bridge': bridge, 'subnet_count': count}
+                for name, cidr, bridge, count in self.conn.execute(
+                    'SELECT v.name, v.cidr, v.bridge, COUNT(s.name) FROM vpcs v '
+                    'LEFT JOIN subnets s ON s.vpc = v.name GROUP BY v.name ORDER BY v.name')]
+
+    def subnets(self, vpc_name=None):
+        """Indexed subnet rows, optionally for a single VPC"""
+        query = ('SELECT vpc, name, cidr, type, namespace, veth_br, gateway_ip, namespace_ip '
+                 'FROM subnets')
+        params = ()
+        if vpc_name is not None:
+            query += ' WHERE vpc = ?'
+            params = (vpc_name,)
+        columns = ('vpc', 'name', 'cidr', 'type', 'namespace', 'veth_br', 'gateway_ip', 'namespace_ip')
+        return [dict(zip(columns, row)) for row in self.conn.execute(query + ' ORDER BY vpc, name', params)]
+
+    def find_namespace(self, ns_name):
+        """Return (vpc, subnet) owning a namespace, or None"""
+        return self.conn.execute('SELECT vpc, name FROM subnets WHERE namespace = ?',
+                                 (ns_name,)).fetchone()
+
+    def peers_of(self, vpc_name):
+        """VPCs that hold a peering towards vpc_name"""
+        return [row[0] for row in self.conn.execute(
+            'SELECT vpc FROM peerings WHERE peer = ? ORDER BY vpc', (vpc_name,))]
+
+    POOL_COLUMNS = ('namespace', 'veth_br', 'veth_ns', 'queues', 'status', 'created', 'changed')
+
+    def pool_entries(self):
+        """Pre-warmed namespaces, oldest first"""
+        return [dict(zip(self.POOL_COLUMNS, row)) for row in self.conn.execute(
+            f"SELECT {', '.join(self.POOL_COLUMNS)} FROM pool ORDER BY created")]
+
+    def pool_reserve(self, entries):
+        """Record entries about to be created; they are claimable once marked ready"""
+        with self.transaction():
+            self.conn.executemany(
+                "INSERT INTO pool (namespace, veth_br, veth_ns, queues, status, created, changed) "
+                "VALUES (?, ?, ?, ?, 'creating', ?, ?)",
+                [(e['namespace'], e['veth_br'], e['veth_ns'], e['queues'], e['created'], e['created'])
+                 for e in entries])
+
+    def pool_ready(self, namespace):
+        with self.transaction():
+            self.conn.execute("UPDATE pool SET status = 'ready', changed = ? WHERE namespace = ?",
+                              (time.time(), namespace))
+
+    def pool_claim(self, queues):
+        """Mark the oldest ready entry with this many veth queues claimed and return it, or None.
+
+        The claimer removes the row once the namespace carries its new name.
+        """
+        with self.transaction():
+            row = self.conn.execute(
+                f"SELECT {', '.join(self.POOL_COLUMNS)} FROM pool WHERE status = 'ready' AND queues = ? "
+                'ORDER BY created LIMIT 1', (queues,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE pool SET status = 'claimed', changed = ? WHERE namespace = ?",
+                              (time.time(), row[0]))
+        return dict(zip(self.POOL_COLUMNS, row), status='claimed')
+
+    def pool_remove(self, namespaces):
+        """Remove entries; returns the namespaces that were still recorded"""
+        removed = []
+        with self.transaction():
+            for namespace in namespaces:
+                if self.conn.execute('DELETE FROM pool WHERE namespace = ?', (namespace,)).rowcount:
+                    removed.append(namespace)
+        return removed
+
+    def migrate_json(self):
+        """Import legacy <vpc>.json files, keeping them as <vpc>.json.migrated"""
+        if not any(self.state_dir.glob('*.json')):
+            return 0
+        migrated = []
+        with self.transaction():
+            # Another process may have migrated them while we waited for the lock
+            for state_file in sorted(self.state_dir.glob('*.json')):
+                with open(state_file, 'r') as f:
+                    self.save(state_file.stem, json.load(f))
+                state_file.rename(state_file.with_name(state_file.name + '.migrated'))
+                migrated.append(state_file)
+        if migrated:
+            log('SUCCESS', f"Migrated {len(migrated)} VPC state file(s) into {self.db_path}")
+        return len(migrated)
@@ -0,0 +1,209 @@
+import json
+import re
+import sys
+import time
+from vpcctl_lib.state import StateManager, log, Colors, worker_pool
+from vpcctl_lib.backend import capture
+from vpcctl_lib.nft import firewall_of
+from vpcctl_lib.policy import NftPolicyCompiler
+
+SYSFS_NET = '/sys/class/net'
+COUNTERS = ('rx_bytes', 'rx_packets', 'rx_dropped', 'tx_bytes', 'tx_packets', 'tx_dropped')
+# One bulk dump of the filter rules, with counters, per namespace
+SAVERS = {'iptables': ['iptables-save', '-c', '-t', 'filter'],
+          'nft': ['nft', 'list', 'table', 'ip', NftPolicyCompiler.TABLE]}
+
+_SAVE_RULE_RE = re.compile(r'^\[(\d+):(\d+)\] (-A .*)$')
+_SAVE_POLICY_RE = re.compile(r'^:(\S+) (ACCEPT|DROP) \[(\d+):(\d+)\]$')
+_NFT_RULE_RE = re.compile(r'^(.*?)\s*counter packets (\d+) bytes (\d+)\s*(.*)$')
+
+def read_counters(dev):
+    """Byte, packet and drop counters of a host link from sysfs; None if it does not exist"""
+    counters = {}
+    for name in COUNTERS:
+        try:
+            with open(f"{SYSFS_NET}/{dev}/statistics/{name}", 'rb') as f:
+                counters[name] = int(f.read())
+        except (OSError, ValueError):
+            return None
+    return counters
+
+def parse_iptables_save(text):
+    """(rule, packets, bytes) for every filter rule and chain policy in iptables-save -c output"""
+    hits = []
+    for line in text.splitlines():
+        rule = _SAVE_RULE_RE.match(line)
+        if rule:
+            hits.append((rule.group(3), int(rule.group(1)), int(rule.group(2))))
+            continue
+        policy = _SAVE_POLICY_RE.match(line)
+        if policy and policy.group(1) in ('INPUT', 'FORWARD', 'OUTPUT'):
+            hits.append((f"{policy.group(1)} policy {policy.group(2)}", int(policy.group(3)),
+                         int(policy.group(4))))
+    return hits
+
+def parse_nft_table(text):
+    """(rule, packets, bytes) for every rule with a counter in `nft list table` output"""
+    hits, chain = [], None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('chain '):
+            chain = line.split()[1]
+            continue
+        match = _NFT_RULE_RE.match(line)
+        if match:
+            rule = ' '.join(part for part in (match.group(1), match.group(4)) if part)
+            hits.append((f"{chain}: {rule}", int(match.group(2)), int(match.group(3))))
+    return hits
+
+def human(value, unit='B'):
+    for prefix in ('', 'K', 'M', 'G', 'T'):
+        if abs(value) < 1000 or prefix == 'T':
+            return f"{value:.0f} {prefix}{unit}" if not prefix else f"{value:.1f} {prefix}{unit}"
+        value /= 1000.0
+
+class StatsCollector:
+    """Traffic and policy rule-hit counters for every VPC, subnet and peering.
+
+    Interface counters of the host-side veths (and bridges) recorded in
+    state are read straight from sysfs, without forking. Rule hits take
+    one bulk dump per namespace that has a policy, in parallel. Rates
+    come from the difference between two samples.
+    """
+
+    @staticmethod
+    def interfaces(states):
+        rows = []
+        for vpc_name, state in sorted(states.items()):
+            devices = [('bridge', '', state['bridge'])]
+            devices += [('subnet', name, s['veth_br']) for name, s in sorted(state['subnets'].items())]
+            devices += [('peering', peer, p['veth']) for peer, p in sorted(state.get('peerings', {}).items())]
+            for kind, name, dev in devices:
+                counters = read_counters(dev)
+                row = {'vpc': vpc_name, 'kind': kind, 'name': name, 'dev': dev, 'present': counters is not None}
+                row.update(counters or dict.fromkeys(COUNTERS, 0))
+                rows.append(row)
+        return rows
+
+    @staticmethod
+    def _rule_hits(vpc_name, subnet_name, subnet, engine):
+        result = capture(['ip', 'netns', 'exec', subnet['namespace']] + SAVERS[engine])
+        if result.returncode != 0:
+            return []
+        parse = parse_iptables_save if engine == 'iptables' else parse_nft_table
+        return [{'vpc': vpc_name, 'subnet': subnet_name, 'engine': engine, 'index': index, 'rule': rule,
+                 'packets': packets, 'bytes': nbytes}
+                for index, (rule, packets, nbytes) in enumerate(parse(result.stdout or ''))]
+
+    @staticmethod
+    def rule_hits(states, workers=8):
+        jobs = [(vpc_name, subnet_name, subnet, firewall_of(state))
+                for vpc_name, state in sorted(states.items())
+                for subnet_name, subnet in sorted(state['subnets'].items()) if subnet.get('policies')]
+        if not jobs:
+            return []
+        with worker_pool(min(workers, len(jobs))) as pool:
+            results = pool.map(lambda job: StatsCollector._rule_hits(*job), jobs)
+            return [hit for hits in results for hit in hits]
+
+    @staticmethod
+    def load_states(vpc_names=None):
+        manager = StateManager()
+        names = vpc_names or manager.list_all()
+        states = {}
+        for name in names:
+            state = manager.load(name)
+            if state is None:
+                log('ERROR', f"VPC {name} not found")
+                return None
+            states[name] = state
+        return states
+
+    @staticmethod
+    def sample(states, rules=True):
+        sample = {'ts': time.time(), 'interfaces': StatsCollector.interfaces(states)}
+        if rules:
+            sample['rules'] = StatsCollector.rule_hits(states)
+        return sample
+
+    @staticmethod
+    def rates(previous, current):
+        """Add per-second rates to current from the counters in previous"""
+        elapsed = current['ts'] - previous['ts']
+        if elapsed <= 0:
+            return current
+        before = {(r['vpc'], r['dev']): r for r in previous['interfaces']}
+        for row in current['interfaces']:
+            old = before.get((row['vpc'], row['dev']))
+            for name in COUNTERS:
+                row[f"{name}_per_s"] = round(max(row[name] - old[name], 0) / elapsed, 1) if old else None
+        before = {(h['vpc'], h['subnet'], h['index'], h['rule']): h for h in previous.get('rules', [])}
+        for hit in current.get('rules', []):
+            old = before.get((hit['vpc'], hit['subnet'], hit['index'], hit['rule']))
+            for name in ('packets', 'bytes'):
+                hit[f"{name}_per_s"] = round(max(hit[name] - old[name], 0) / elapsed, 1) if old else None
+        current['interval_s'] = round(elapsed, 3)
+        return current
+
+    @staticmethod
+    def render(sample, output_format='table'):
+        if output_format == 'json':
+            print(json.dumps(sample), flush=True)
+            return
+        rated = 'interval_s' in sample
+        print(f"\n{'='*92}")
+        title = f"every {sample['interval_s']:.1f}s, per second" if rated else 'totals since link creation'
+        print(f"Traffic ({title}; host side: rx = from the subnet or peer, tx = towards it)")
+        print(f"{'='*92}")
+        print(f"{'VPC':<14} {'RESOURCE':<22} {'DEV':<16} {'RX':>11} {'TX':>11} {'RX PKTS':>9} {'TX PKTS':>9} {'DROPS':>6}")
+        for row in sample['interfaces']:
+            resource = f"{row['kind']} {row['name']}".strip()
+            if not row['present']:
+                print(f"{row['vpc']:<14} {resource:<22} {row['dev']:<16} {Colors.YELLOW}missing{Colors.RESET}")
+                continue
+            suffix = '_per_s' if rated else ''
+            values = [row.get(f"{name}{suffix}") for name in COUNTERS]
+            if rated and values[0] is None:
+                values = [row[name] for name in COUNTERS]  # first sample of a new link
+            rx_bytes, rx_packets, rx_dropped, tx_bytes, tx_packets, tx_dropped = values
+            if rated:
+                rx, tx = human(rx_bytes * 8, 'bit/s'), human(tx_bytes * 8, 'bit/s')
+            else:
+                rx, tx = human(rx_bytes), human(tx_bytes)
+            print(f"{row['vpc']:<14} {resource:<22} {row['dev']:<16} {rx:>11} {tx:>11} "
+                  f"{rx_packets:>9.0f} {tx_packets:>9.0f} {rx_dropped + tx_dropped:>6.0f}")
+
+        rules = sample.get('rules')
+        if not rules:
+            return
+        print(f"\n{'PACKETS':>10} {'BYTES':>10}  RULE")
+        subnet = None
+        for hit in rules:
+            if (hit['vpc'], hit['subnet']) != subnet:
+                subnet = (hit['vpc'], hit['subnet'])
+                print(f"{hit['vpc']}/{hit['subnet']} ({hit['engine']})")
+            packets, nbytes = hit['packets'], hit['bytes']
+            if rated and hit.get('packets_per_s') is not None:
+                packets, nbytes = hit['packets_per_s'], hit['bytes_per_s']
+            mark = Colors.GREEN if packets else ''
+            print(f"{mark}{packets:>10.0f}{Colors.RESET if mark else ''} {human(nbytes):>10}  {hit['rule']}")
+
+    @staticmethod
+    def watch(states, interval=2.0, count=None, output_format='table', rules=True):
+        """Sample every interval seconds and print rates; count limits the number of reports"""
+        clear = output_format == 'table' and sys.stdout.isatty()
+        previous = StatsCollector.sample(states, rules=rules)
+        reports = 0
+        try:
+            while count is None or reports < count:
+                time.sleep(max(interval - (time.time() - previous['ts']), 0))
+                current = StatsCollector.sample(states, rules=rules)
+                StatsCollector.rates(previous, current)
+                if clear:
+                    sys.stdout.write('\033[H\033[J')
+                StatsCollector.render(current, output_format)
+                previous = current
+                reports += 1
+        except KeyboardInterrupt:
+            pass
+        return True
@@ -0,0 +1,274 @@
+import os
+import signal
+import time
+from vpcctl_lib.state import StateManager, log, Colors, worker_pool
+from vpcctl_lib.backend import NETNS_DIR, run_cmd, run_batch, capture, get_backend
+from vpcctl_lib.chains import VPCChains
+from vpcctl_lib.nft import NftVPC, firewall_of, vpc_firewall, replace_table, load
+from vpcctl_lib.transit import TRANSIT_SET
+from vpcctl_lib.trace import span
+from vpcctl_lib.dns import DnsManager
+
+def namespace_pids(namespaces):
+    """Map each namespace to the pids running in it, from one scan of /proc"""
+    inodes = {}
+    for ns_name in namespaces:
+        try:
+            st = os.stat(os.path.join(NETNS_DIR, ns_name))
+        except OSError:
+            continue
+        inodes[(st.st_dev, st.st_ino)] = ns_name
+
+    pids = {ns_name: [] for ns_name in inodes.values()}
+    if not inodes:
+        return pids
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            st = os.stat(f"/proc/{entry}/ns/net")
+        except OSError:
+            continue  # exited, or a kernel thread we cannot inspect
+        ns_name = inodes.get((st.st_dev, st.st_ino))
+        if ns_name is not None:
+            pids[ns_name].append(int(entry))
+    return pids
+
+def filter_ruleset(text, chains, bridges, masquerade_cidrs):
+    """Drop everything a deleted VPC owns from iptables-save output.
+
+    Removes the VPC chains and every jump to them, rules matching a deleted
+    bridge by -i/-o, and legacy POSTROUTING masquerades of deleted subnets.
+    Returns (filter and nat tables as an iptables-restore document, rules removed).
+    """
+    lines = []
+    removed = 0
+    table = None
+    for line in text.splitlines():
+        if line.startswith('*'):
+            table = line[1:].strip()
+            if table in ('filter', 'nat'):
+                lines.append(line)
+            continue
+        if table not in ('filter', 'nat') or line.startswith('#'):
+            continue
+        if line.startswith(':'):
+            if line[1:].split()[0] not in chains:
+                lines.append(line)
+            continue
+
+        # iptables-save -c prefixes each rule with its [packets:bytes] counters
+        rule = line.split(' ', 1)[1] if line.startswith('[') else line
+        tokens = rule.split()
+        if tokens[:1] == ['-A'] and _owned_rule(table, tokens, chains, bridges, masquerade_cidrs):
+            removed += 1
+            continue
+        lines.append(line)
+    return '\n'.join(lines) + '\n', removed
+
+def _owned_rule(table, tokens, chains, bridges, masquerade_cidrs):
+    if tokens[1] in chains:
+        return True
+    options = dict(zip(tokens, tokens[1:]))
+    if options.get('-j') in chains:
+        return True
+    if options.get('-i') in bridges or options.get('-o') in bridges:
+        return True
+    return (table == 'nat' and tokens[1] == 'POSTROUTING' and options.get('-j') == 'MASQUERADE'
+            and options.get('-s') in masquerade_cidrs)
+
+class Teardown:
+    """Deletes VPCs as a dependency graph.
+
+    Phases run in order (processes, namespaces, veths, peerings, bridges,
+    firewall); the steps inside a phase are independent and run on a thread
+    pool. iptables state of every deleted VPC is removed with one
+    save/filter/restore, and nftables tables (deleted ones and surviving
+    peers that lose a peer) with one `nft -f` transaction. State is only
+    dropped when every phase succeeded, so a failed teardown can be retried.
+    """
+
+    PHASES = ('processes', 'namespaces', 'veths', 'peerings', 'bridges', 'firewall')
+
+    def __init__(self, vpc_names, workers=8, manager=None):
+        self.manager = manager or StateManager()
+        self.states = {}
+        for vpc_name in vpc_names:
+            state = self.manager.load(vpc_name)
+            if state:
+                self.states[vpc_name] = state
+        self.workers = max(1, workers)
+        self.survivors = {}
+        self.timings = []
+        self.elapsed = 0.0
+
+    @property
+    def namespaces(self):
+        return [s['namespace'] for state in self.states.values() for s in state['subnets'].values()]
+
+    def run(self):
+        started = time.perf_counter()
+        for phase in self.PHASES:
+            steps = getattr(self, f"_{phase}_steps")()
+            self._run_phase(phase, steps)
+        if not self.failed_phases:
+            self._forget()
+        self.elapsed = time.perf_counter() - started
+        return not self.failed_phases
+
+    @property
+    def failed_phases(self):
+        return [phase for phase, _, failed, _ in self.timings if failed]
+
+    def _run_phase(self, phase, steps):
+        started = time.perf_counter()
+        failed = 0
+        if steps:
+            with span(f"teardown {phase}", steps=len(steps)), worker_pool(min(self.workers, len(steps))) as pool:
+                results = list(pool.map(self._run_step, steps))
+            failed = results.count(False)
+        elapsed = time.perf_counter() - started
+        self.timings.append((phase, len(steps), failed, elapsed))
+        status = f", {failed} failed" if failed else ''
+        log('INFO', f"[{phase}] {len(steps) - failed}/{len(steps)} step(s) done in {elapsed * 1000:.1f} ms{status}")
+
+    @staticmethod
+    def _run_step(step):
+        label, action = step
+        try:
+            return action() is not False
+        except Exception as e:
+            log('WARNING', f"{label}: {e}")
+            return False
+
+    @staticmethod
+    def _delete_link(name):
+        return run_cmd(['ip', 'link', 'del', name], check=False, quiet=True)
+
+    def _processes_steps(self):
+        # DNS forwarders run on the host and bind the gateways, so they go with the VPC too
+        steps = [(f"stop dns {vpc_name}", lambda vpc_name=vpc_name, state=state: DnsManager.stop(vpc_name, state))
+                 for vpc_name, state in self.states.items() if 'dns' in state]
+        if not get_backend().live:
+            return steps
+        return steps + [(f"kill {ns_name}", lambda pids=pids: self._kill(pids))
+                        for ns_name, pids in namespace_pids(self.namespaces).items() if pids]
+
+    @staticmethod
+    def _kill(pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def _namespaces_steps(self):
+        present = get_backend().namespace_names()
+        return [(f"netns del {ns_name}",
+                 lambda ns_name=ns_name: run_cmd(['ip', 'netns', 'del', ns_name], check=False, quiet=True))
+                for ns_name in self.namespaces if ns_name in present]
+
+    def _veths_steps(self):
+        # Deleting a namespace usually takes its veth pair with it
+        links = get_backend().link_table()
+        return [(f"link del {s['veth_br']}", lambda name=s['veth_br']: self._delete_link(name))
+                for state in self.states.values() for s in state['subnets'].values()
+                if s.get('veth_br') in links]
+
+    def _peerings_steps(self):
+        links = get_backend().link_table()
+        steps = []
+        seen = set()
+        routes = {}
+        for vpc_name, state in self.states.items():
+            for peer_vpc, peering in state.get('peerings', {}).items():
+                pair = frozenset((peering.get('veth'), peering.get('peer_veth')))
+                if pair not in seen:
+                    seen.add(pair)
+                    veth = next((v for v in pair if v in links), None)
+                    if veth:
+                        steps.append((f"link del {veth}", lambda name=veth: self._delete_link(name)))
+                if peer_vpc in self.states:
+                    continue
+                peer_state = self.survivors.get(peer_vpc) or self.manager.load(peer_vpc)
+                if not peer_state:
+                    continue
+                self.survivors[peer_vpc] = peer_state
+                peer_state.get('peerings', {}).pop(vpc_name, None)
+                if firewall_of(peer_state) == 'nft':
+                    firewall = vpc_firewall(peer_vpc, peer_state)
+                    firewall.peers.discard(state['bridge'])
+                    peer_state['nft'] = firewall.as_state()
+                for subnet in peer_state['subnets'].values():
+                    if subnet.get('gateway_ip'):
+                        routes.setdefault(subnet['namespace'], []).append(
+                            f"route del {state['cidr']} via {subnet['gateway_ip']}")
+
+        for state in self.states.values():
+            if 'transit' in state:
+                steps.append((f"transit {state['cidr']}",
+                              lambda cidr=state['cidr']: run_cmd(['ipset', 'del', TRANSIT_SET, cidr, '-exist'],
+                                                                 check=False, quiet=True)))
+
+        # Surviving peers lose their routes towards the deleted VPCs, one batch per namespace
+        for ns_name, lines in routes.items():
+            steps.append((f"routes {ns_name}",
+                          lambda ns_name=ns_name, lines=lines: run_batch(lines, netns=ns_name, check=False)))
+        return steps
+
+    def _bridges_steps(self):
+        links = get_backend().link_table()
+        return [(f"link del {state['bridge']}", lambda name=state['bridge']: self._delete_link(name))
+                for state in self.states.values() if state['bridge'] in links]
+
+    def _firewall_steps(self):
+        steps = [('iptables', self._filter_firewall)] if self.states else []
+        document = []
+        for vpc_name, state in self.states.items():
+            if firewall_of(state) == 'nft':
+                document += replace_table(state['nft']['table'])
+        for peer_vpc, peer_state in self.survivors.items():
+            if firewall_of(peer_state) == 'nft':
+                document += NftVPC(peer_vpc, peer_state['bridge'], peer_state['nft']).document()
+        if document:
+            steps.append(('nft', lambda: load(document)))
+        return steps
+
+    def _filter_firewall(self):
+        chains = set()
+        bridges = set()
+        cidrs = set()
+        for vpc_name, state in self.states.items():
+            vpc_chains = VPCChains(vpc_name, state['bridge'])
+            chains.update((vpc_chains.fwd_chain, vpc_chains.nat_chain))
+            bridges.add(state['bridge'])
+            cidrs.update(s['cidr'] for s in state['subnets'].values() if s.get('type') == 'public')
+
+        saved = capture(['iptables-save', '-c'])
+        if saved.returncode != 0:
+            log('WARNING', "Could not read the current ruleset; leaving iptables untouched")
+            return False
+        if '*filter' not in saved.stdout and '*nat' not in saved.stdout:
+            return True  # no tables loaded, so nothing of ours either
+        document, removed = filter_ruleset(saved.stdout, chains, bridges, cidrs)
+        if not removed and not any(f":{chain} " in saved.stdout for chain in chains):
+            return True
+        return run_cmd(['iptables-restore', '-c'], input=document, check=False, quiet=True)
+
+    def _forget(self):
+        """Drop deleted VPCs and their peerings from state in one transaction"""
+        with self.manager.transaction():
+            for peer_vpc, peer_state in self.survivors.items():
+                self.manager.save(peer_vpc, peer_state)
+            for vpc_name in self.states:
+                self.manager.delete(vpc_name)
+
+    def print_summary(self):
+        print(f"\n{'='*60}")
+        print(f"Teardown of {len(self.states)} VPC(s) with {self.workers} worker(s)")
+        print(f"{'='*60}")
+        for phase, steps, failed, elapsed in self.timings:
+            mark = f"{Colors.RED}✗{Colors.RESET}" if failed else f"{Colors.GREEN}✓{Colors.RESET}"
+            note = f" ({failed} failed)" if failed else ''
+            print(f"  {mark} {phase:<11} {steps:>4} step(s) {elapsed * 1000:>9.1f} ms{note}")
+        print(f"  {'total':>13} {sum(t[1] for t in self.timings):>9} step(s) {self.elapsed * 1000:>9.1f} ms\n")
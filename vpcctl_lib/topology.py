@@ -0,0 +1,287 @@
+import ipaddress
+import json
+import os
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from vpcctl_lib.state import StateManager, log, Colors, worker_pool
+from vpcctl_lib.validators import Validators
+from vpcctl_lib.policy import PolicyCompiler, COMPILERS
+from vpcctl_lib.nft import get_firewall, firewall_of
+from vpcctl_lib.trace import span
+from vpcctl_lib.tuning import Tuning, PROFILES, DEFAULT_PROFILE
+
+# Actions a plan can contain, in the order they are listed
+ACTIONS = ('delete-vpc', 'create-vpc', 'add-subnet', 'peer', 'apply-policy')
+
+def load_topology(path):
+    """Read and validate a topology file.
+
+    {"vpcs": {"<vpc>": {"cidr": "...", "subnets": {"<subnet>": {"cidr" or
+    "size", "type", "policy": "<policy file>"}}}}, "peerings": [["a", "b"]]}
+
+    Policy paths are relative to the topology file. Returns None when the
+    file is invalid.
+    """
+    try:
+        with open(path, 'r') as f:
+            topology = json.load(f)
+    except Exception as e:
+        log('ERROR', f"Failed to load topology file: {e}")
+        return None
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    vpcs = topology.get('vpcs', {})
+    if not isinstance(vpcs, dict):
+        log('ERROR', "Topology 'vpcs' must be an object keyed by VPC name")
+        return None
+
+    for vpc_name, vpc in vpcs.items():
+        if not Validators.validate_vpc_name(vpc_name) or not Validators.validate_cidr(vpc.get('cidr', '')):
+            return None
+        if vpc.get('profile', DEFAULT_PROFILE) not in PROFILES:
+            log('ERROR', f"VPC {vpc_name} profile must be one of {', '.join(PROFILES)}")
+            return None
+        for subnet_name, subnet in vpc.setdefault('subnets', {}).items():
+            if not Validators.validate_subnet_name(subnet_name):
+                return None
+            if ('cidr' in subnet) == ('size' in subnet):
+                log('ERROR', f"Subnet {vpc_name}/{subnet_name} needs exactly one of 'cidr' or 'size'")
+                return None
+            if 'cidr' in subnet and not (Validators.validate_cidr(subnet['cidr']) and
+                                         Validators.validate_subnet_within_vpc(vpc['cidr'], subnet['cidr'])):
+                return None
+            if subnet.setdefault('type', 'private') not in ('public', 'private'):
+                log('ERROR', f"Subnet {vpc_name}/{subnet_name} type must be public or private")
+                return None
+            if subnet.get('policy'):
+                subnet['policy'] = os.path.join(base_dir, subnet['policy'])
+
+    peerings = []
+    for pair in topology.get('peerings', []):
+        if len(pair) != 2 or pair[0] == pair[1] or any(name not in vpcs for name in pair):
+            log('ERROR', f"Invalid peering {pair}: both VPCs must be defined in the topology")
+            return None
+        peerings.append(tuple(pair))
+    topology['peerings'] = peerings
+    return topology
+
+class Step:
+    """One node of the plan graph"""
+
+    def __init__(self, action, target, args, vpcs, detail='', deps=()):
+        self.action = action
+        self.target = target
+        self.args = args
+        self.vpcs = tuple(sorted(set(vpcs)))
+        self.detail = detail
+        self.deps = set(deps)
+        self.status = 'pending'
+        self.elapsed = None
+
+    @property
+    def key(self):
+        return f"{self.action}:{self.target}"
+
+    def as_dict(self):
+        return {'action': self.action, 'target': self.target, 'detail': self.detail,
+                'deps': sorted(self.deps), 'status': self.status, 'elapsed_ms':
+                None if self.elapsed is None else round(self.elapsed * 1000, 1)}
+
+class TopologyPlan:
+    """Minimal set of steps that brings the state store in line with a topology"""
+
+    def __init__(self, topology, manager=None, prune=False):
+        self.topology = topology
+        self.manager = manager or StateManager()
+        self.prune = prune
+        self.steps = {}
+        self.conflicts = []
+        self._diff()
+
+    def _add(self, step):
+        self.steps[step.key] = step
+        return step.key
+
+    def _diff(self):
+        states = {name: self.manager.load(name) for name in self.manager.list_all()}
+        desired = self.topology['vpcs']
+        deletes = []
+
+        if self.prune:
+            for vpc_name in sorted(set(states) - set(desired)):
+                # Teardown rewrites the shared iptables tables, so deletes run before anything else
+                deletes.append(self._add(Step('delete-vpc', vpc_name, (vpc_name,),
+                                              [vpc_name] + self.manager.peers_of(vpc_name), 'prune',
+                                              deps=deletes[-1:])))
+
+        subnet_steps = {}
+        for vpc_name, vpc in desired.items():
+            state = states.get(vpc_name)
+            vpc_deps = list(deletes)
+            if state is None:
+                profile = vpc.get('profile', DEFAULT_PROFILE)
+                detail = vpc['cidr'] if profile == DEFAULT_PROFILE else f"{vpc['cidr']}, profile {profile}"
+                vpc_deps.append(self._add(Step('create-vpc', vpc_name, (vpc_name, vpc['cidr'], profile), [vpc_name],
+                                               detail, deps=deletes)))
+                state = {'cidr': vpc['cidr'], 'subnets': {}, 'peerings': {}, 'firewall': get_firewall()}
+            elif ipaddress.ip_network(state['cidr']) != ipaddress.ip_network(vpc['cidr']):
+                self.conflicts.append(f"{vpc_name}: CIDR is {state['cidr']} but the topology wants "
+                                      f"{vpc['cidr']}; delete the VPC to change it")
+                continue
+            elif 'profile' in vpc and Tuning.of(state).profile != vpc['profile']:
+                self.conflicts.append(f"{vpc_name}: tuning profile is {Tuning.of(state).profile} but the "
+                                      f"topology wants {vpc['profile']}; delete the VPC to change it")
+                continue
+
+            subnet_steps[vpc_name] = []
+            for subnet_name, subnet in vpc['subnets'].items():
+                target = f"{vpc_name}/{subnet_name}"
+                existing = state['subnets'].get(subnet_name)
+                policy_deps = list(vpc_deps)
+                if existing is None:
+                    key = self._add(Step('add-subnet', target,
+                                         (vpc_name, subnet_name, subnet.get('cidr'), subnet['type'],
+                                          subnet.get('size')),
+                                         [vpc_name], f"{subnet.get('cidr') or subnet['size']}, {subnet['type']}",
+                                         deps=vpc_deps))
+                    subnet_steps[vpc_name].append(key)
+                    policy_deps.append(key)
+                else:
+                    if subnet.get('cidr') and (ipaddress.ip_network(subnet['cidr']) !=
+                                               ipaddress.ip_network(existing['cidr'])):
+                        self.conflicts.append(f"{target}: CIDR is {existing['cidr']} but the topology "
+                                              f"wants {subnet['cidr']}")
+                    if existing.get('type', 'private') != subnet['type']:
+                        self.conflicts.append(f"{target}: type is {existing.get('type', 'private')} but "
+                                              f"the topology wants {subnet['type']}")
+
+                if subnet.get('policy'):
+                    wanted = self._policy_digest(subnet['policy'], firewall_of(state))
+                    if wanted is None:
+                        self.conflicts.append(f"{target}: cannot read policy {subnet['policy']}")
+                    elif existing is None or existing.get('policy_hash') != wanted:
+                        self._add(Step('apply-policy', target, (vpc_name, subnet_name, subnet['policy']),
+                                       [vpc_name], os.path.basename(subnet['policy']), deps=policy_deps))
+
+        for vpc1, vpc2 in self.topology['peerings']:
+            state1 = states.get(vpc1) or {}
+            if vpc2 in state1.get('peerings', {}) or vpc1 not in subnet_steps or vpc2 not in subnet_steps:
+                continue
+            # Peering installs routes in existing namespaces, so it waits for new subnets on both sides
+            deps = set(deletes) | set(subnet_steps[vpc1]) | set(subnet_steps[vpc2])
+            deps |= {f"create-vpc:{name}" for name in (vpc1, vpc2) if f"create-vpc:{name}" in self.steps}
+            self._add(Step('peer', f"{vpc1}<->{vpc2}", (vpc1, vpc2), [vpc1, vpc2], deps=deps))
+
+    @staticmethod
+    def _policy_digest(path, engine):
+        try:
+            with open(path, 'r') as f:
+                return PolicyCompiler.digest(COMPILERS[engine].compile(json.load(f)))
+        except Exception:
+            return None
+
+    def ordered(self):
+        return sorted(self.steps.values(), key=lambda s: (ACTIONS.index(s.action), s.target))
+
+    def render(self, output_format='table'):
+        if output_format == 'json':
+            print(json.dumps({'steps': [s.as_dict() for s in self.ordered()],
+                              'conflicts': self.conflicts}, indent=2))
+            return
+
+        print(f"\n{'='*60}")
+        print(f"Plan: {len(self.steps)} step(s), {len(self.conflicts)} conflict(s)")
+        print(f"{'='*60}")
+        if not self.steps and not self.conflicts:
+            print(f"  {Colors.GREEN}✓{Colors.RESET} State already matches the topology")
+        for step in self.ordered():
+            sign = f"{Colors.RED}-{Colors.RESET}" if step.action == 'delete-vpc' else f"{Colors.GREEN}+{Colors.RESET}"
+            detail = f" ({step.detail})" if step.detail else ''
+            print(f"  {sign} {step.action:<13} {step.target}{detail}")
+        for conflict in self.conflicts:
+            print(f"  {Colors.RED}!{Colors.RESET} conflict      {conflict}")
+        print()
+
+class TopologyApplier:
+    """Executes a plan graph.
+
+    A step starts once its dependencies succeeded; steps touching the same
+    VPC serialise on a per-VPC lock, so independent VPCs proceed in parallel.
+    `actions` maps each action name to a callable returning success.
+    """
+
+    def __init__(self, plan, actions, workers=8):
+        self.plan = plan
+        self.actions = actions
+        self.workers = max(1, workers)
+        self.locks = {}
+        self.elapsed = 0.0
+
+    def _lock(self, vpc_name):
+        return self.locks.setdefault(vpc_name, threading.Lock())
+
+    def _execute(self, step):
+        locks = [self._lock(name) for name in step.vpcs]
+        for lock in locks:
+            lock.acquire()
+        started = time.perf_counter()
+        try:
+            with span(f"{step.action} {step.target}", 'step'):
+                ok = self.actions[step.action](*step.args)
+        except Exception as e:
+            log('ERROR', f"{step.action} {step.target}: {e}")
+            ok = False
+        finally:
+            step.elapsed = time.perf_counter() - started
+            for lock in reversed(locks):
+                lock.release()
+        return ok is not False
+
+    def run(self):
+        started = time.perf_counter()
+        steps = self.plan.steps
+        pending = dict(steps)
+        running = {}
+        # Locks are created up front so worker threads never race on the dict
+        for step in steps.values():
+            for name in step.vpcs:
+                self._lock(name)
+
+        with worker_pool(self.workers) as pool:
+            while pending or running:
+                for key, step in list(pending.items()):
+                    statuses = [steps[d].status for d in step.deps]
+                    if any(status in ('failed', 'skipped') for status in statuses):
+                        step.status = 'skipped'
+                        del pending[key]
+                    elif all(status == 'done' for status in statuses):
+                        step.status = 'running'
+                        running[pool.submit(self._execute, step)] = step
+                        del pending[key]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    step.status = 'done' if future.result() else 'failed'
+                    log('INFO' if step.status == 'done' else 'ERROR',
+                        f"[{step.action}] {step.target} {step.status} in {step.elapsed * 1000:.1f} ms")
+
+        self.elapsed = time.perf_counter() - started
+        return all(step.status == 'done' for step in steps.values())
+
+    def print_summary(self, output_format='table'):
+        if output_format == 'json':
+            print(json.dumps({'elapsed_ms': round(self.elapsed * 1000, 1),
+                              'steps': [s.as_dict() for s in self.plan.ordered()]}, indent=2))
+            return
+
+        print(f"\n{'='*60}")
+        print(f"Applied {len(self.plan.steps)} step(s) with {self.workers} worker(s)")
+        print(f"{'='*60}")
+        for step in self.plan.ordered():
+            mark = f"{Colors.GREEN}✓{Colors.RESET}" if step.status == 'done' else f"{Colors.RED}✗{Colors.RESET}"
+            elapsed = f"{step.elapsed * 1000:>9.1f} ms" if step.elapsed is not None else f"{'-':>12}"
+            print(f"  {mark} {step.action:<13} {step.target:<28} {elapsed}  {step.status}")
+        print(f"  {'total':>15} {'':<28} {self.elapsed * 1000:>9.1f} ms\n")
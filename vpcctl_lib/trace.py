@@ -0,0 +1,250 @@
+import contextvars
+import fcntl
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+# Operation (top-level command) the current thread works for, inherited by worker pools
+_operation = contextvars.ContextVar('vpcctl_operation', default=None)
+_op_ids = itertools.count(1)
+
+_tracer = None
+_metrics = None
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def configure(trace=False, metrics=False):
+    """Start collecting spans (for a Chrome trace) and/or metrics; both are off by default"""
+    global _tracer, _metrics
+    _tracer = Tracer() if trace else None
+    _metrics = Metrics() if metrics else None
+
+def enabled():
+    return _tracer is not None or _metrics is not None
+
+def current_operation():
+    op = _operation.get()
+    return op[0] if op else None
+
+def command_label(cmd):
+    """Metric label for an argv: the program, with the ip object or -batch, past any netns exec.
+
+    Netlink calls are labelled by the ip command they replace, prefixed with netlink.
+    """
+    cmd = list(cmd)
+    if cmd[:1] == ['netlink']:
+        return f"netlink {command_label(cmd[1:])}".rstrip()
+    while cmd[:3] == ['ip', 'netns', 'exec'] and len(cmd) > 4:
+        cmd = cmd[4:]
+    if cmd[:1] == ['ip'] and len(cmd) > 1:
+        if '-batch' in cmd:
+            return 'ip -batch'
+        words = [c for c in cmd[1:] if not c.startswith('-')]
+        return f"ip {words[0]}" if words else 'ip'
+    return os.path.basename(cmd[0]) if cmd else ''
+
+class _NullSpan:
+    args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ('name', 'cat', 'args', 'start')
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and 'error' not in self.args:
+            self.args['error'] = exc_type.__name__
+        record(self.name, self.cat, self.start, time.perf_counter(), self.args)
+        return False
+
+def span(name, cat='step', **args):
+    """Time a block; the span's args dict may be filled in while it runs"""
+    if _tracer is None and _metrics is None:
+        return _NULL_SPAN
+    return _Span(name, cat, args)
+
+def record(name, cat, start, end, args=None):
+    """Record a finished span (perf_counter timestamps) under the current operation"""
+    if _tracer is None and _metrics is None:
+        return
+    op = _operation.get()
+    args = dict(args or {})
+    if op:
+        args.setdefault('operation', op[0])
+        args.setdefault('op', op[1])
+    if _tracer is not None:
+        _tracer.add(name, cat, start, end, args)
+    if _metrics is not None:
+        _metrics.observe(name, cat, end - start, args)
+
+def record_command(cmd, start, end, returncode, stderr=''):
+    """Span for one executed command (subprocess, netlink batch or recorded)"""
+    if _tracer is None and _metrics is None:
+        return
+    args = {'cmd': ' '.join(cmd)[:300], 'rc': returncode, 'command': command_label(cmd)}
+    if stderr:
+        args['stderr'] = stderr.strip()[:500]
+    record(args['command'], 'exec', start, end, args)
+
+class operation:
+    """Top-level span (create, subnet-add, ...) that every nested span is grouped under.
+
+    A non-zero SystemExit, as raised by the CLI dispatcher, counts as a failure.
+    """
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.token = _operation.set((self.name, next(_op_ids)))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        failed = exc_type is not None and not (exc_type is SystemExit and exc.code in (None, 0))
+        args = dict(self.args, status='failed' if failed else 'ok')
+        record(self.name, 'operation', self.start, time.perf_counter(), args)
+        _operation.reset(self.token)
+        return False
+
+class Tracer:
+    """Spans kept in memory and written as a Chrome trace (chrome://tracing, Perfetto)"""
+
+    def __init__(self):
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, cat, start, end, args):
+        thread = threading.current_thread()
+        with self.lock:
+            tid = self.threads.setdefault(thread.ident, (len(self.threads) + 1, thread.name))[0]
+            self.events.append({'name': name, 'cat': cat, 'ph': 'X', 'ts': round(start * 1e6, 1),
+                                'dur': round((end - start) * 1e6, 1), 'pid': os.getpid(), 'tid': tid,
+                                'args': args})
+
+    def write(self, path):
+        with self.lock:
+            events = list(self.events)
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                      'args': {'name': name}} for tid, name in self.threads.values()]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': names + events, 'displayTimeUnit': 'ms'}, f)
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+_LE_RE = re.compile(r',?le="([^"]+)"')
+
+def _sample_order(item):
+    # Histogram buckets in ascending order of their bound, after the series they belong to
+    (name, labels), _ = item
+    match = _LE_RE.search(labels)
+    return name, _LE_RE.sub('', labels), float(match.group(1)) if match else 0.0
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metrics:
+    """Operation and command counters/latencies in the Prometheus text format.
+
+    Values are merged into the existing textfile, so repeated CLI runs (or
+    a daemon flushing after each request) accumulate rather than overwrite.
+    """
+
+    FAMILIES = (
+        ('vpcctl_operations_total', 'counter', 'Top-level operations run'),
+        ('vpcctl_operation_failures_total', 'counter', 'Top-level operations that failed'),
+        ('vpcctl_operation_duration_seconds', 'histogram', 'Top-level operation latency'),
+        ('vpcctl_commands_total', 'counter', 'Commands and kernel calls issued'),
+        ('vpcctl_command_failures_total', 'counter', 'Commands and kernel calls that failed'),
+        ('vpcctl_command_duration_seconds', 'summary', 'Command and kernel call latency'),
+    )
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def _add(self, name, labels, value):
+        key = (name, labels)
+        self.samples[key] = self.samples.get(key, 0) + value
+
+    def observe(self, name, cat, seconds, args):
+        with self.lock:
+            if cat == 'operation':
+                labels = f'{{operation="{name}"}}'
+                self._add('vpcctl_operations_total', labels, 1)
+                self._add('vpcctl_operation_failures_total', labels, args.get('status') == 'failed')
+                for bound in BUCKETS:
+                    self._add('vpcctl_operation_duration_seconds_bucket',
+                              f'{{operation="{name}",le="{bound}"}}', seconds <= bound)
+                self._add('vpcctl_operation_duration_seconds_bucket', f'{{operation="{name}",le="+Inf"}}', 1)
+                self._add('vpcctl_operation_duration_seconds_sum', labels, seconds)
+                self._add('vpcctl_operation_duration_seconds_count', labels, 1)
+            elif cat == 'exec':
+                labels = f'{{command="{args["command"]}"}}'
+                self._add('vpcctl_commands_total', labels, 1)
+                self._add('vpcctl_command_failures_total', labels, args.get('rc') != 0)
+                self._add('vpcctl_command_duration_seconds_sum', labels, seconds)
+                self._add('vpcctl_command_duration_seconds_count', labels, 1)
+
+    @staticmethod
+    def _read(path):
+        samples = {}
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    match = _SAMPLE_RE.match(line.strip())
+                    if match:
+                        samples[(match.group(1), match.group(2) or '')] = float(match.group(3))
+        except FileNotFoundError:
+            pass
+        return samples
+
+    def flush(self, path):
+        """Merge what was observed since the last flush into the textfile (atomically, under a lock)"""
+        with self.lock:
+            pending, self.samples = self.samples, {}
+        if not pending:
+            return
+        with open(f"{path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            samples = self._read(path)
+            for key, value in pending.items():
+                samples[key] = samples.get(key, 0) + value
+            lines = []
+            for family, kind, help_text in self.FAMILIES:
+                lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"]
+                for (name, labels), value in sorted(samples.items(), key=_sample_order):
+                    if name == family or (kind != 'counter' and name.startswith(family + '_')):
+                        lines.append(f"{name}{labels} {_format_value(value)}")
+            tmp = f"{path}.tmp"
+            with open(tmp, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp, path)
+
+def write_trace(path):
+    if _tracer is not None:
+        _tracer.write(path)
+
+def flush_metrics(path):
+    if _metrics is not None and path:
+        _metrics.flush(path)
@@ -0,0 +1,110 @@
+import ipaddress
+from vpcctl_lib.state import StateManager, log, Colors
+from vpcctl_lib.backend import run_cmd, run_batch
+from vpcctl_lib.chains import VPCChains
+
+TRANSIT_SET = 'vpcctl-transit'
+TRANSIT_CHAIN = 'VPC-TRANSIT'
+DEFAULT_AGGREGATE = '10.0.0.0/8'
+# The one rule that lets attached VPCs reach each other
+TRANSIT_RULE = ['-m', 'set', '--match-set', TRANSIT_SET, 'src',
+                '-m', 'set', '--match-set', TRANSIT_SET, 'dst', '-j', 'ACCEPT']
+
+class TransitHub:
+    """Any-to-any connectivity between attached VPCs through the host.
+
+    The host already routes between VPC bridges, so the hub is the host
+    itself: membership is one entry per VPC in the TRANSIT_SET ipset and a
+    single FORWARD rule matches set-to-set traffic. Each subnet namespace
+    gets one aggregate route towards its gateway. Attaching a VPC costs the
+    same no matter how many are already attached.
+    """
+
+    @staticmethod
+    def ensure():
+        """Create the membership set, the transit chain and its rule (idempotent)"""
+        run_cmd(['ipset', 'create', TRANSIT_SET, 'hash:net', '-exist'])
+        run_cmd(['iptables', '-t', 'filter', '-N', TRANSIT_CHAIN], check=False, quiet=True)
+        VPCChains._ensure_rule('filter', 'FORWARD', ['-j', TRANSIT_CHAIN])
+        VPCChains._ensure_rule('filter', TRANSIT_CHAIN, TRANSIT_RULE)
+
+    @staticmethod
+    def route_lines(state, action='replace'):
+        """Aggregate route for every subnet namespace of an attached VPC, keyed by namespace"""
+        aggregate = state['transit']['aggregate']
+        return {s['namespace']: [f"route {action} {aggregate} via {s['gateway_ip']}"]
+                for s in state['subnets'].values() if s.get('gateway_ip')}
+
+    @staticmethod
+    def attach(vpc_name, aggregate=DEFAULT_AGGREGATE):
+        manager = StateManager()
+        state = manager.load(vpc_name)
+        if not state:
+            log('ERROR', f"VPC {vpc_name} not found")
+            return False
+
+        if 'transit' in state:
+            log('WARNING', f"VPC {vpc_name} is already attached to the transit hub")
+            return True
+
+        try:
+            network = ipaddress.ip_network(aggregate)
+        except ValueError as e:
+            log('ERROR', f"Invalid aggregate: {e}")
+            return False
+        if not ipaddress.ip_network(state['cidr']).subnet_of(network):
+            log('ERROR', f"Aggregate {aggregate} does not cover VPC CIDR {state['cidr']}")
+            return False
+
+        log('INFO', f"Attaching {vpc_name} ({state['cidr']}) to the transit hub")
+        try:
+            TransitHub.ensure()
+            run_cmd(['ipset', 'add', TRANSIT_SET, state['cidr'], '-exist'])
+
+            state['transit'] = {'aggregate': aggregate}
+            for ns_name, lines in TransitHub.route_lines(state).items():
+                run_batch(lines, netns=ns_name)
+
+            manager.save(vpc_name, state)
+            log('SUCCESS', f"VPC {vpc_name} attached to the transit hub")
+            return True
+
+        except Exception as e:
+            log('ERROR', f"Failed to attach to the transit hub: {e}")
+            run_cmd(['ipset', 'del', TRANSIT_SET, state['cidr'], '-exist'], check=False)
+            return False
+
+    @staticmethod
+    def detach(vpc_name):
+        manager = StateManager()
+        state = manager.load(vpc_name)
+        if not state:
+            log('ERROR', f"VPC {vpc_name} not found")
+            return False
+
+        if 'transit' not in state:
+            log('WARNING', f"VPC {vpc_name} is not attached to the transit hub")
+            return True
+
+        log('INFO', f"Detaching {vpc_name} from the transit hub")
+        run_cmd(['ipset', 'del', TRANSIT_SET, state['cidr'], '-exist'], check=False)
+        for ns_name, lines in TransitHub.route_lines(state, action='del').items():
+            run_batch(lines, netns=ns_name, check=False)
+
+        del state['transit']
+        manager.save(vpc_name, state)
+        log('SUCCESS', f"VPC {vpc_name} detached from the transit hub")
+        return True
+
+    @staticmethod
+    def list_attachments():
+        manager = StateManager()
+        attached = [(name, state) for name, state in
+                    ((name, manager.load(name)) for name in manager.list_all()) if 'transit' in state]
+
+        print(f"\n{'='*60}")
+        print(f"Transit hub ({TRANSIT_SET}): {len(attached)} VPC(s) attached")
+        print(f"{'='*60}")
+        for name, state in attached:
+            print(f"  {Colors.GREEN}•{Colors.RESET} {name} ({state['cidr']}) aggregate {state['transit']['aggregate']}")
+        print()
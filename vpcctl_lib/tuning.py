@@ -0,0 +1,230 @@
+import os
+from vpcctl_lib.state import log
+from vpcctl_lib.backend import run_cmd, run_batch, get_backend
+
+SYSFS_NET = '/sys/class/net'
+DEFAULT_PROFILE = 'default'
+# MTU a link has when no profile sets one
+KERNEL_MTU = 1500
+
+# Settings per profile; a setting a profile leaves out keeps the kernel default.
+#   mtu, txqueuelen       bridge and every veth of the VPC
+#   veth_queues           tx/rx queue pairs per veth, so GRO/XDP work spreads over CPUs
+#   offloads              ethtool -K features for the veths (gro, gso, tso, ...)
+#   stp, forward_delay    bridge spanning tree; off with no delay lets ports forward at once
+#   multicast_snooping    bridge IGMP/MLD snooping
+#   bridge_netfilter      pass bridged (intra-VPC) frames through iptables via br_netfilter;
+#                         policies live in the namespaces, so the VPC does not need it
+PROFILES = {
+    DEFAULT_PROFILE: {},
+    'throughput': {
+        'mtu': 9000,
+        'txqueuelen': 10000,
+        'veth_queues': 4,
+        'offloads': {'gro': 'on', 'gso': 'on', 'tso': 'on'},
+        'stp': False,
+        'forward_delay': 0,
+        'multicast_snooping': False,
+        'bridge_netfilter': False,
+    },
+    'low-latency': {
+        'txqueuelen': 256,
+        'offloads': {'gro': 'off', 'gso': 'off', 'tso': 'off'},
+        'stp': False,
+        'forward_delay': 0,
+        'multicast_snooping': False,
+        'bridge_netfilter': False,
+    },
+}
+
+SETTINGS = ('mtu', 'txqueuelen', 'veth_queues', 'offloads', 'stp', 'forward_delay',
+            'multicast_snooping', 'bridge_netfilter')
+
+# Bridge settings and the sysfs attribute under /sys/class/net/<bridge>/bridge/ holding each
+_BRIDGE_OPTIONS = (
+    ('stp', 'stp_state'),
+    ('forward_delay', 'forward_delay'),
+    ('multicast_snooping', 'multicast_snooping'),
+    ('bridge_netfilter', 'nf_call_iptables'),
+)
+
+def _sysfs_value(setting, value):
+    if setting == 'forward_delay':
+        return str(int(value * 100))  # clock ticks of 1/100 s
+    return str(int(value))
+
+def _display(value):
+    if isinstance(value, bool):
+        return 'on' if value else 'off'
+    if isinstance(value, dict):
+        return ' '.join(f"{k} {v}" for k, v in sorted(value.items()))
+    return str(value)
+
+def _read_sysfs(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+class Tuning:
+    """Data-plane settings of one VPC's bridge and veths, from a named profile.
+
+    The resolved settings are stored in the VPC state, so the bridge and
+    veths created later (recreated bridges, new subnets, peerings) get the
+    same settings even if the profile definition has changed since.
+    """
+
+    def __init__(self, profile=DEFAULT_PROFILE, settings=None):
+        if settings is None:
+            if profile not in PROFILES:
+                raise ValueError(f"Unknown tuning profile {profile} (choose from {', '.join(PROFILES)})")
+            settings = PROFILES[profile]
+        self.profile = profile
+        self.settings = dict(settings)
+
+    @classmethod
+    def of(cls, state):
+        """Tuning a VPC was created with; VPCs predating profiles use kernel defaults"""
+        tuning = state.get('tuning')
+        if not tuning:
+            return cls()
+        return cls(tuning['profile'], tuning['settings'])
+
+    def as_state(self):
+        return {'profile': self.profile, 'settings': self.settings}
+
+    @property
+    def mtu(self):
+        return self.settings.get('mtu')
+
+    @staticmethod
+    def peer_mtu(a, b):
+        """MTU for a veth joining two VPCs: the smaller one, so neither bridge drops its frames"""
+        if a.mtu is None and b.mtu is None:
+            return None
+        return min(a.mtu or KERNEL_MTU, b.mtu or KERNEL_MTU)
+
+    def _attrs(self, mtu=None):
+        attrs = []
+        mtu = mtu or self.mtu
+        if mtu:
+            attrs.append(f"mtu {mtu}")
+        if 'txqueuelen' in self.settings:
+            attrs.append(f"txqueuelen {self.settings['txqueuelen']}")
+        return attrs
+
+    def bridge_lines(self, bridge):
+        """ip batch lines setting the bridge's MTU and queue length.
+
+        They are set after the bridge exists rather than at `link add`, so
+        the kernel keeps the MTU as configured when smaller ports join.
+        """
+        return self.link_lines(bridge)
+
+    def link_lines(self, name, mtu=None):
+        """ip batch lines giving an existing link the profile's MTU and queue length"""
+        attrs = self._attrs(mtu)
+        return [f"link set {name} {' '.join(attrs)}"] if attrs else []
+
+    @classmethod
+    def peering(cls, a, b):
+        """Settings for the veth pair joining two VPCs' bridges"""
+        settings = {}
+        mtu = cls.peer_mtu(a, b)
+        if mtu:
+            settings['mtu'] = mtu
+        for key in ('txqueuelen', 'veth_queues'):
+            values = [t.settings[key] for t in (a, b) if key in t.settings]
+            if values:
+                settings[key] = max(values)
+        return cls('peering', settings)
+
+    def apply_bridge(self, bridge):
+        """Bring an existing bridge to the profile: one ip batch, then sysfs"""
+        lines = self.bridge_lines(bridge)
+        if lines:
+            run_batch(lines)
+        return self.tune_bridge(bridge)
+
+    def veth_add(self, name, peer, mtu=None):
+        """ip batch line creating a veth pair, both ends carrying the profile's attributes"""
+        attrs = self._attrs(mtu)
+        queues = self.settings.get('veth_queues')
+        if queues:
+            attrs.append(f"numtxqueues {queues} numrxqueues {queues}")
+        attrs = ''.join(f" {a}" for a in attrs)
+        return f"link add {name}{attrs} type veth peer name {peer}{attrs}"
+
+    def tune_bridge(self, bridge):
+        """Spanning tree, snooping and br_netfilter options, written to sysfs without forking"""
+        ok = True
+        for setting, option in _BRIDGE_OPTIONS:
+            if setting not in self.settings:
+                continue
+            path = f"{SYSFS_NET}/{bridge}/bridge/{option}"
+            try:
+                get_backend().write_file(path, _sysfs_value(setting, self.settings[setting]) + '\n')
+            except OSError as e:
+                log('WARNING', f"Could not set {option} on {bridge}: {e.strerror}")
+                ok = False
+        return ok
+
+    def tune_offloads(self, dev, netns=None):
+        """Apply the profile's offload features to a veth with ethtool"""
+        offloads = self.settings.get('offloads')
+        if not offloads:
+            return True
+        cmd = ['ethtool', '-K', dev] + [word for item in sorted(offloads.items()) for word in item]
+        if netns:
+            cmd = ['ip', 'netns', 'exec', netns] + cmd
+        try:
+            ok = run_cmd(cmd, check=False)
+        except OSError as e:
+            ok = False
+            log('WARNING', f"Could not run ethtool: {e.strerror}")
+        if not ok:
+            log('WARNING', f"Offload settings not applied to {dev}")
+        return ok
+
+    def report(self, bridge, veth=None, live=True):
+        """(setting, configured, on the host) rows for show; host values are None when not read.
+
+        Offloads are only reported as configured, reading them back would fork ethtool.
+        """
+        host = {}
+        if live:
+            link = self.effective_link(bridge) or {}
+            host.update(mtu=link.get('mtu'), txqueuelen=link.get('txqueuelen'))
+            if veth:
+                host['veth_queues'] = (self.effective_link(veth) or {}).get('veth_queues')
+            host.update(self.effective_bridge(bridge))
+        return [(key, _display(self.settings[key]) if key in self.settings else 'kernel default',
+                 None if host.get(key) is None else str(host[key])) for key in SETTINGS]
+
+    @staticmethod
+    def effective_link(name):
+        """Live mtu, txqueuelen and queue count of a host link, read from sysfs"""
+        base = f"{SYSFS_NET}/{name}"
+        if not os.path.isdir(base):
+            return None
+        try:
+            queues = len([q for q in os.listdir(f"{base}/queues") if q.startswith('tx-')])
+        except OSError:
+            queues = None
+        return {'mtu': _read_sysfs(f"{base}/mtu"), 'txqueuelen': _read_sysfs(f"{base}/tx_queue_len"),
+                'veth_queues': queues}
+
+    @staticmethod
+    def effective_bridge(bridge):
+        """Live bridge options, in the units the profiles use"""
+        values = {}
+        for setting, option in _BRIDGE_OPTIONS:
+            raw = _read_sysfs(f"{SYSFS_NET}/{bridge}/bridge/{option}")
+            if raw is None:
+                continue
+            if setting == 'forward_delay':
+                values[setting] = int(raw) // 100
+            else:
+                values[setting] = 'on' if raw != '0' else 'off'
+        return values
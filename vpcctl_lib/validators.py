@@ -1,6 +1,7 @@
 import ipaddress
 import re
 from vpcctl_lib.state import log
+from vpcctl_lib.ipam import IPAM
 
 class Validators:
     
@@ -86,19 +87,18 @@ class Validators:
             return False
     
     @staticmethod
-    def check_subnet_overlap(existing_subnets, new_subnet_cidr):
+    def check_subnet_overlap(existing_subnets, new_subnet_cidr, vpc_cidr=None):
         """Check if new subnet overlaps with existing subnets"""
         try:
             new_network = ipaddress.ip_network(new_subnet_cidr)
+            scope = vpc_cidr or ('0.0.0.0/0' if new_network.version == 4 else '::/0')
             
-            for subnet_name, subnet_data in existing_subnets.items():
-                existing_network = ipaddress.ip_network(subnet_data['cidr'])
-                
-                if new_network.overlaps(existing_network):
-                    log('ERROR', f"Subnet {new_subnet_cidr} overlaps with existing subnet {subnet_name} ({subnet_data['cidr']})")
-                    return False
+            clash = IPAM(scope, existing_subnets).find_overlap(new_network)
+            if clash is not None:
+                log('ERROR', f"Subnet {new_subnet_cidr} overlaps with existing subnet {clash} ({existing_subnets[clash]['cidr']})")
+                return False
             
             return True
         except Exception as e:
             log('ERROR', f"Overlap check error: {e}")
-            return False
\ No newline at end of file
+            return False